@@ -0,0 +1,250 @@
+import os
+import glob
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """Файл в кэше аудио"""
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+
+class MemoryCacheIndex:
+    """Индекс кэша аудио в памяти процесса: файлы в порядке использования
+    (давно не использовавшиеся - в начале) и число защит каждого от вытеснения"""
+
+    shared = False  # Индекс видит только этот процесс
+
+    def __init__(self):
+        self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, digest: str) -> Optional[CacheEntry]:
+        return self._entries.get(digest)
+
+    def add(self, digest: str, entry: CacheEntry, used_at: Optional[float] = None):
+        """Добавляет файл (или заменяет прежний) как только что использованный"""
+        self.remove(digest)
+        self._entries[digest] = entry
+        self.total_bytes += entry.size
+
+    def touch(self, digest: str):
+        self._entries.move_to_end(digest)
+
+    def remove(self, digest: str, unpinned_only: bool = False) -> Optional[CacheEntry]:
+        """Убирает файл из индекса (unpinned_only - только если он не защищен) и возвращает его"""
+        if unpinned_only and self.pinned(digest):
+            return None
+        entry = self._entries.pop(digest, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+        return entry
+
+    def pin(self, digest: str):
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest: str):
+        refs = self._pins.pop(digest, 0) - 1
+        if refs > 0:
+            self._pins[digest] = refs
+
+    def pinned(self, digest: str) -> bool:
+        return digest in self._pins
+
+    def pinned_count(self) -> int:
+        return sum(1 for digest in self._pins if digest in self._entries)
+
+    def lru(self) -> List[Tuple[str, CacheEntry]]:
+        """Файлы от давно не использовавшихся к недавним"""
+        return list(self._entries.items())
+
+    def close(self):
+        pass
+
+
+class AudioCache:
+    """Общий кэш скачанных треков на диске.
+
+    Файлы называются по хэшу ссылки на трек и профиля формата, поэтому один
+    трек хранится один раз для всех пользователей. Запись атомарная (запись во
+    временный файл и переименование), при превышении бюджета вытесняются давно
+    не использовавшиеся файлы. Файлы, которые сейчас отправляются (защищенные
+    acquire() или put() до release()), не вытесняются. Размер, порядок
+    вытеснения и защиты хранит индекс: в памяти процесса (MemoryCacheIndex) или
+    общий для всех процессов бота (SqliteCacheIndex при STATE_BACKEND = 'sqlite').
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, format_profile: str = '', index=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.format_profile = format_profile
+        self.index = index if index is not None else MemoryCacheIndex()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    @property
+    def total_bytes(self) -> int:
+        return self.index.total_bytes
+
+    def _digest(self, track_key: str) -> str:
+        return hashlib.sha1(f"{track_key}|{self.format_profile}".encode('utf-8')).hexdigest()
+
+    def _scan(self):
+        """Сверяет индекс с файлами на диске (новые файлы - в начале очереди на вытеснение, по времени доступа)"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not os.path.isfile(path):
+                continue
+            if name.endswith('.tmp'):
+                # Недописанный файл после сбоя; в общем кэше его может дописывать
+                # другой процесс - такие файлы по возрасту удаляет уборка диска
+                if not self.index.shared:
+                    self._remove_file(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_atime, name.split('.', 1)[0], path, stat.st_size))
+
+        for used_at, digest, path, size in sorted(files):
+            if self.index.get(digest) is None:
+                self.index.add(digest, CacheEntry(path, size), used_at)
+        for digest, entry in self.index.lru():
+            if not os.path.exists(entry.path):
+                self.index.remove(digest)
+
+        logger.info(f"Кэш аудио: {len(self.index)} файлов, {self.total_bytes / 1024 / 1024:.1f}MB")
+        self._evict()
+
+    def acquire(self, track_key: str) -> Optional[str]:
+        """Возвращает путь к треку из кэша и защищает файл от вытеснения до release()"""
+        digest = self._digest(track_key)
+        # Защита ставится до поиска: в общем кэше файл не вытеснят между поиском и защитой
+        self.index.pin(digest)
+        entry = self.index.get(digest) or self._adopt(digest)
+        if entry is None or not os.path.exists(entry.path):
+            self.index.unpin(digest)
+            if entry is not None:
+                self.index.remove(digest)
+            self.misses += 1
+            return None
+
+        self.index.touch(digest)
+        self.hits += 1
+        return entry.path
+
+    def _adopt(self, digest: str) -> Optional[CacheEntry]:
+        """Добавляет в индекс процесса файл, который положил в кэш другой процесс бота
+        (общий индекс о таких файлах и так знает)"""
+        if self.index.shared:
+            return None
+        for path in glob.glob(os.path.join(self.cache_dir, glob.escape(digest) + '.*')):
+            if path.endswith('.tmp'):
+                continue
+            try:
+                entry = CacheEntry(path, os.path.getsize(path))
+            except OSError:
+                continue
+            self.index.add(digest, entry)
+            return entry
+        return None
+
+    def release(self, track_key: str):
+        """Снимает защиту от вытеснения, поставленную acquire() или put()"""
+        self.index.unpin(self._digest(track_key))
+        self._evict()
+
+    def contains(self, track_key: str) -> bool:
+        """Есть ли трек в кэше"""
+        return self.index.get(self._digest(track_key)) is not None
+
+    def take(self, track_key: str) -> Optional[str]:
+        """Убирает трек из кэша, не удаляя файл, и возвращает путь к нему (файлом теперь владеет вызывающий)"""
+        entry = self.index.remove(self._digest(track_key), unpinned_only=True)
+        if entry is None or not os.path.exists(entry.path):
+            return None
+        return entry.path
+
+    def put(self, track_key: str, file_path: str) -> str:
+        """Переносит скачанный файл в кэш и возвращает новый путь (защищен от вытеснения до release())"""
+        digest = self._digest(track_key)
+        ext = os.path.splitext(file_path)[1]
+        final_path = os.path.join(self.cache_dir, digest + ext)
+        tmp_path = final_path + '.tmp'
+
+        try:
+            os.replace(file_path, tmp_path)
+        except OSError:
+            # Другая файловая система - копируем
+            shutil.copyfile(file_path, tmp_path)
+            os.remove(file_path)
+        os.replace(tmp_path, final_path)
+
+        old = self.index.get(digest)
+        if old is not None and old.path != final_path:
+            self._remove_file(old.path)
+        self.index.add(digest, CacheEntry(final_path, os.path.getsize(final_path)))
+        self.index.pin(digest)
+        self._evict()
+        return final_path
+
+    def _evict(self, max_bytes: Optional[int] = None) -> int:
+        """Удаляет давно не использовавшиеся файлы, пока кэш не уложится в бюджет; возвращает освобожденные байты"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        total_bytes = self.total_bytes
+        if total_bytes <= max_bytes:
+            return 0
+
+        freed = 0
+        for digest, entry in self.index.lru():
+            if total_bytes - freed <= max_bytes:
+                break
+            # Защищенный (в том числе другим процессом) файл не вытесняется
+            if self.index.remove(digest, unpinned_only=True) is None:
+                continue
+            self._remove_file(entry.path)
+            freed += entry.size
+            self.evictions += 1
+        return freed
+
+    def trim(self, max_bytes: int) -> int:
+        """Вытесняет давно не использовавшиеся файлы сверх max_bytes (меньше бюджета), возвращает освобожденные байты"""
+        return self._evict(max(0, max_bytes))
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка удаления файла {path}: {e}")
+
+    def stats(self) -> Dict:
+        """Статистика кэша аудио"""
+        total = self.hits + self.misses
+        return {
+            'files': len(self.index),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'pinned': self.index.pinned_count(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
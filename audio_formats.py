@@ -0,0 +1,126 @@
+import os
+import shutil
+import logging
+import threading
+import subprocess
+from typing import Optional, Dict, List
+from metrics import timed
+from config import (
+    TELEGRAM_AUDIO_EXTS, FORMAT_SIZE_MARGIN, FFMPEG_TIMEOUT_SECONDS, FFMPEG_CONCURRENCY, TRANSCODE_BITRATE_KBPS
+)
+
+logger = logging.getLogger(__name__)
+
+# Протоколы, которые скачиваются одним запросом (быстрее фрагментов HLS/DASH)
+PROGRESSIVE_PROTOCOLS = ('http', 'https')
+
+# Одновременные процессы ffmpeg (на процесс бота)
+_ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_CONCURRENCY)
+
+# Версия правил выбора формата: при их изменении файлы кэша аудио, скачанные
+# по старым правилам, перестают находиться и со временем вытесняются
+FORMAT_POLICY_VERSION = 2
+
+
+def cache_profile() -> str:
+    """Профиль формата для ключей кэша аудио: версия правил и их настройки"""
+    return f"v{FORMAT_POLICY_VERSION}|{','.join(TELEGRAM_AUDIO_EXTS)}|{TRANSCODE_BITRATE_KBPS}k"
+
+
+def format_bitrate(fmt: Dict) -> float:
+    """Битрейт аудио в KBit/s (0 если неизвестен)"""
+    return fmt.get('abr') or fmt.get('tbr') or 0
+
+
+def estimate_size(fmt: Dict, duration: Optional[float] = None) -> int:
+    """Размер формата в байтах: из yt-dlp, а если его нет (HLS) - битрейт × длительность (0 если неизвестен)"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    duration = duration or fmt.get('duration')
+    bitrate = format_bitrate(fmt)
+    if duration and bitrate:
+        return int(bitrate * 1000 / 8 * duration * FORMAT_SIZE_MARGIN)
+    return 0
+
+
+def is_audio_only(fmt: Dict) -> bool:
+    return fmt.get('acodec') != 'none' and (
+        fmt.get('vcodec') == 'none' or (fmt.get('vcodec') is None and fmt.get('ext') in TELEGRAM_AUDIO_EXTS)
+    )
+
+
+def is_playable(fmt: Dict) -> bool:
+    """Telegram воспроизводит формат как аудио без перекодирования"""
+    return is_audio_only(fmt) and fmt.get('ext') in TELEGRAM_AUDIO_EXTS
+
+
+def _rank(fmt: Dict):
+    """Порядок выбора: воспроизводимые Telegram, затем выше битрейт, предпочтительнее расширение,
+    скачивание одним запросом"""
+    ext = fmt.get('ext')
+    return (
+        not is_playable(fmt),
+        -format_bitrate(fmt),
+        TELEGRAM_AUDIO_EXTS.index(ext) if ext in TELEGRAM_AUDIO_EXTS else len(TELEGRAM_AUDIO_EXTS),
+        fmt.get('protocol') not in PROGRESSIVE_PROTOCOLS,
+    )
+
+
+def select_audio_format(info: Dict, max_bytes: int) -> Optional[Dict]:
+    """Выбирает аудиоформат из списка форматов трека до скачивания.
+
+    Предпочитаются форматы, которые Telegram воспроизводит без перекодирования
+    (TELEGRAM_AUDIO_EXTS); если лучший не укладывается в max_bytes по оценке
+    размера, берется формат с меньшим битрейтом. None - у трека нет списка
+    аудиоформатов (выбор остается за yt-dlp).
+    """
+    candidates: List[Dict] = [
+        fmt for fmt in info.get('formats') or []
+        if fmt.get('url') and fmt.get('format_id') and not fmt.get('has_drm') and is_audio_only(fmt)
+    ]
+    if not candidates:
+        return None
+
+    duration = info.get('duration')
+    for fmt in sorted(candidates, key=_rank):
+        size = estimate_size(fmt, duration)
+        if size <= max_bytes:
+            # Неизвестный размер проверяется после скачивания
+            return fmt
+    raise Exception(f"Файл слишком большой (>{max_bytes // 1024 // 1024}MB)")
+
+
+def convert_for_telegram(file_path: str, fmt: Dict) -> str:
+    """Приводит скачанный файл к формату, который Telegram воспроизводит как аудио.
+
+    AAC и MP3 только перепаковываются, остальное перекодируется в MP3. Этап
+    ограничен по времени и числу одновременных процессов ffmpeg; без ffmpeg
+    или при ошибке возвращается исходный файл.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        logger.debug(f"ffmpeg не найден, файл {file_path} отправляется как есть")
+        return file_path
+
+    acodec = (fmt.get('acodec') or '').lower()
+    if acodec.startswith(('mp4a', 'aac')):
+        codec_args, ext = ['-c:a', 'copy'], 'm4a'
+    elif acodec.startswith('mp3'):
+        codec_args, ext = ['-c:a', 'copy'], 'mp3'
+    else:
+        codec_args, ext = ['-c:a', 'libmp3lame', '-b:a', f'{TRANSCODE_BITRATE_KBPS}k'], 'mp3'
+
+    output_path = os.path.splitext(file_path)[0] + '.telegram.' + ext
+    command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-i', file_path, '-vn', *codec_args, output_path]
+    with timed('download', 'ffmpeg'), _ffmpeg_slots:
+        try:
+            subprocess.run(command, check=True, capture_output=True, timeout=FFMPEG_TIMEOUT_SECONDS)
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.warning(f"Не удалось перепаковать {file_path} для Telegram: {e}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return file_path
+
+    os.remove(file_path)
+    return output_path
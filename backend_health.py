@@ -0,0 +1,160 @@
+import math
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from typing import Optional, Dict, List, Callable, Awaitable
+from metrics import SEARCH_BACKEND_EVENTS
+from config import (
+    SEARCH_STATS_WINDOW, SEARCH_DEGRADED_ERROR_RATE, SEARCH_BREAKER_MIN_REQUESTS, SEARCH_BREAKER_ERROR_RATE,
+    SEARCH_BREAKER_COOLDOWN_SECONDS, SEARCH_BREAKER_MAX_COOLDOWN_SECONDS,
+    SEARCH_HEDGE_MIN_SAMPLES, SEARCH_HEDGE_DEFAULT_SECONDS, SEARCH_HEDGE_MIN_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Состояния предохранителя бэкенда
+CLOSED = 'closed'  # Бэкенд опрашивается
+OPEN = 'open'  # Бэкенд отключен до конца паузы
+HALF_OPEN = 'half_open'  # Идет пробный запрос
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # Для метрики состояния
+
+
+class BackendStats:
+    """Скользящая статистика одного бэкенда поиска и состояние его предохранителя"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=SEARCH_STATS_WINDOW)  # Длительности успешных запросов (сек.)
+        self.outcomes = deque(maxlen=SEARCH_STATS_WINDOW)  # True - ответ, False - ошибка или таймаут
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.cooldown = SEARCH_BREAKER_COOLDOWN_SECONDS
+        self.probe: Optional[asyncio.Task] = None
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def p95(self) -> Optional[float]:
+        """95-й перцентиль задержки (None, пока ответов мало)"""
+        if len(self.latencies) < SEARCH_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[math.ceil(0.95 * len(latencies)) - 1]
+
+
+class BackendHealth:
+    """Состояние бэкендов поиска: порядок опроса, предохранители и задержка хеджирования.
+
+    По каждому бэкенду хранится скользящее окно задержек и исходов запросов.
+    Бэкенд с долей ошибок не меньше SEARCH_BREAKER_ERROR_RATE отключается:
+    запросы пользователей его пропускают, а по окончании паузы probe(name)
+    проверяет его в фоне. Удачная проверка включает бэкенд, неудачная
+    удваивает паузу. Переходы пишутся в журнал и в SEARCH_BACKEND_EVENTS.
+    """
+
+    def __init__(self, names: List[str], probe: Callable[[str], Awaitable]):
+        self.names = list(names)
+        self.probe = probe
+        self.backends: Dict[str, BackendStats] = {name: BackendStats(name) for name in names}
+
+    def _event(self, name: str, event: str):
+        SEARCH_BACKEND_EVENTS.inc(backend=name, event=event)
+
+    def record(self, name: str, seconds: float, ok: bool):
+        """Учитывает завершенный запрос к бэкенду (отмененные не учитываются)"""
+        backend = self.backends[name]
+        backend.outcomes.append(ok)
+        if ok:
+            backend.latencies.append(seconds)
+
+        if backend.state == HALF_OPEN:
+            if ok:
+                self._close(backend)
+            else:
+                self._open(backend, min(backend.cooldown * 2, SEARCH_BREAKER_MAX_COOLDOWN_SECONDS))
+        elif (backend.state == CLOSED and len(backend.outcomes) >= SEARCH_BREAKER_MIN_REQUESTS
+                and backend.error_rate >= SEARCH_BREAKER_ERROR_RATE):
+            self._open(backend, SEARCH_BREAKER_COOLDOWN_SECONDS)
+
+    def _open(self, backend: BackendStats, cooldown: float):
+        backend.state = OPEN
+        backend.opened_at = time.monotonic()
+        backend.cooldown = cooldown
+        self._event(backend.name, 'opened')
+        logger.warning(
+            f"Бэкенд поиска {backend.name} отключен на {cooldown:.0f} сек. "
+            f"(ошибок {backend.error_rate:.0%} из {len(backend.outcomes)} запросов)"
+        )
+
+    def _close(self, backend: BackendStats):
+        backend.state = CLOSED
+        backend.cooldown = SEARCH_BREAKER_COOLDOWN_SECONDS
+        # Прежние ошибки не должны сразу отключить бэкенд снова
+        backend.outcomes.clear()
+        self._event(backend.name, 'closed')
+        logger.info(f"Бэкенд поиска {backend.name} снова включен")
+
+    def available(self, name: str) -> bool:
+        """Можно ли отправить запрос пользователя; по окончании паузы запускает фоновую проверку"""
+        backend = self.backends[name]
+        if backend.state == OPEN and time.monotonic() - backend.opened_at >= backend.cooldown:
+            backend.state = HALF_OPEN
+            # Пустой контекст: проверка не попадает в разбивку запроса, который ее запустил
+            backend.probe = asyncio.create_task(self._probe(backend), context=contextvars.Context())
+        return backend.state == CLOSED
+
+    async def _probe(self, backend: BackendStats):
+        self._event(backend.name, 'probe')
+        logger.info(f"Проверка бэкенда поиска {backend.name}")
+        try:
+            await self.probe(backend.name)
+        except Exception as e:
+            logger.debug(f"Проверка бэкенда поиска {backend.name} не удалась: {e}")
+        finally:
+            backend.probe = None
+            if backend.state == HALF_OPEN:
+                # Исход проверки не учтен (например, она отменена) - ждем следующей паузы
+                self._open(backend, backend.cooldown)
+
+    def order(self) -> List[str]:
+        """Включенные бэкенды в порядке опроса: сначала исправные по приоритету, затем с частыми ошибками.
+
+        Если отключены все, возвращаются все - пусть лучше запрос подождет, чем останется без результатов.
+        """
+        available = [name for name in self.names if self.available(name)]
+        if not available:
+            self._event('all', 'all_open')
+            logger.warning("Все бэкенды поиска отключены, опрашиваем все")
+            return list(self.names)
+        return sorted(available, key=lambda name: self.backends[name].error_rate >= SEARCH_DEGRADED_ERROR_RATE)
+
+    def hedge_delay(self, name: str) -> float:
+        """Сколько ждать ответа бэкенда, прежде чем параллельно запустить следующий"""
+        p95 = self.backends[name].p95()
+        return max(SEARCH_HEDGE_MIN_SECONDS, p95 if p95 is not None else SEARCH_HEDGE_DEFAULT_SECONDS)
+
+    def hedged(self, name: str):
+        """Учитывает запуск следующего бэкенда из-за медленного ответа name"""
+        self._event(name, 'hedged')
+
+    def stats(self) -> Dict[str, Dict]:
+        """Состояние и статистика каждого бэкенда"""
+        return {
+            name: {
+                'state': backend.state,
+                'requests': len(backend.outcomes),
+                'error_rate': backend.error_rate,
+                'p95_seconds': backend.p95(),
+            }
+            for name, backend in self.backends.items()
+        }
+
+    def close(self):
+        """Отменяет фоновые проверки"""
+        for backend in self.backends.values():
+            if backend.probe is not None:
+                backend.probe.cancel()
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+from typing import Optional, Dict, List, Tuple, Callable
+from telegram import Bot, InputMediaAudio
+from telegram.error import BadRequest
+from file_id_cache import canonical_track_key, is_file_id_error
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Готовый трек: (file_id, путь к файлу) - заполнено одно из двух
+ReadyTrack = Tuple[Optional[str], Optional[str]]
+
+# Сколько медиагрупп пакета готовится заранее (текущая и следующая): скачанные, но
+# еще не отправленные файлы защищены в кэше от вытеснения и занимают диск
+PREPARED_GROUPS = 2
+
+
+class BatchDownload:
+    """Пакетное скачивание (страница результатов или сет SoundCloud).
+
+    Треки качаются одновременно через общий планировщик: не больше concurrency
+    для пакета и с приоритетом priority, чтобы одиночные скачивания других
+    пользователей шли раньше. Отправляются они медиагруппами строго по порядку,
+    по мере готовности очередной группы; скачиваются только треки ближайших
+    PREPARED_GROUPS групп, следующая группа начинает качаться после отправки
+    очередной. Треки с сохраненным file_id не скачиваются. on_progress вызывается при каждом изменении общего прогресса.
+    """
+
+    def __init__(self, bot: Bot, scheduler, file_cache, chat_id: int, user_id: int, tracks: List[Dict],
+                 concurrency: int, priority: int, group_size: int,
+                 filename: Callable[[Dict, str], str], on_progress: Callable[['BatchDownload'], None]):
+        self.bot = bot
+        self.scheduler = scheduler
+        self.file_cache = file_cache
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.tracks = tracks
+        self.concurrency = concurrency
+        self.priority = priority
+        self.group_size = group_size
+        self.filename = filename
+        self.on_progress = on_progress
+        self.progress = [0] * len(tracks)  # Процент скачивания каждого трека
+        self.sent = 0
+        self._failed = set()
+        self._ready: List[Optional[asyncio.Future]] = [None] * len(tracks)
+        self._released = [asyncio.Event() for _ in tracks]  # Трек отправлен - файл можно отпустить
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def total(self) -> int:
+        return len(self.tracks)
+
+    @property
+    def failed(self) -> int:
+        return len(self._failed)
+
+    @property
+    def percentage(self) -> int:
+        """Общий процент готовности пакета"""
+        return int(sum(self.progress) / self.total) if self.total else 100
+
+    @property
+    def finished(self) -> int:
+        """Сколько треков скачано (или не удалось скачать)"""
+        return sum(1 for percentage in self.progress if percentage >= 100)
+
+    def _set_progress(self, index: int, percentage: int):
+        self.progress[index] = percentage
+        self.on_progress(self)
+
+    def _prepare(self, index: int):
+        """Отдает трек по file_id или запускает его скачивание"""
+        future = self._ready[index] = asyncio.get_running_loop().create_future()
+        file_id = self.file_cache.get(canonical_track_key(self.tracks[index]['url']))
+        if file_id:
+            self.progress[index] = 100
+            future.set_result((file_id, None))
+            return
+        self._tasks.append(asyncio.create_task(self._fetch(index, future)))
+
+    def _prepare_group(self, group: List[int]):
+        for index in group:
+            self._prepare(index)
+
+    async def _fetch(self, index: int, future: asyncio.Future):
+        """Скачивает трек и держит файл в кэше, пока трек не отправлен"""
+        track = self.tracks[index]
+        try:
+            async with self.scheduler.lease(
+                track['url'], self.user_id, priority=self.priority, user_limit=self.concurrency,
+                on_progress=lambda percentage: self._set_progress(index, percentage)
+            ) as file_path:
+                future.set_result((None, file_path))
+                await self._released[index].wait()
+        except Exception as e:
+            logger.warning(f"Не удалось скачать трек пакета {track['url']}: {e}")
+        if not future.done():
+            # Трек не скачался - группа отправится без него
+            self._failed.add(index)
+            self._set_progress(index, 100)
+            future.set_result((None, None))
+
+    async def run(self) -> int:
+        """Скачивает и отправляет все треки, возвращает число отправленных"""
+        groups = [
+            list(range(start, min(start + self.group_size, self.total)))
+            for start in range(0, self.total, self.group_size)
+        ]
+        for group in groups[:PREPARED_GROUPS]:
+            self._prepare_group(group)
+        self.on_progress(self)
+
+        try:
+            for number, group in enumerate(groups):
+                await self._send_group(group)
+                if number + PREPARED_GROUPS < len(groups):
+                    self._prepare_group(groups[number + PREPARED_GROUPS])
+        finally:
+            for released in self._released:
+                released.set()
+            for task in self._tasks:
+                if not task.done():
+                    task.cancel()
+        return self.sent
+
+    async def _send_group(self, group: List[int], retry_stale: bool = True):
+        """Дожидается треков группы и отправляет их одной медиагруппой"""
+        results: List[ReadyTrack] = await asyncio.gather(*(self._ready[index] for index in group))
+        items = [
+            (index, file_id, file_path)
+            for index, (file_id, file_path) in zip(group, results)
+            if file_id or file_path
+        ]
+        if not items:
+            self.on_progress(self)
+            return
+
+        try:
+            with timed('batch', 'upload'):
+                messages = await self._send_items(items)
+        except BadRequest as e:
+            stale = [index for index, file_id, _ in items if file_id]
+            if not retry_stale or not stale or not is_file_id_error(e):
+                raise
+            # Telegram отклонил сохраненный file_id - скачиваем такие треки и отправляем группу заново
+            logger.warning(f"Устаревшие file_id в пакете, скачиваем заново: {e}")
+            for index in stale:
+                self.file_cache.invalidate(canonical_track_key(self.tracks[index]['url']))
+                self.progress[index] = 0
+                self._prepare(index)
+            await self._send_group(group, retry_stale=False)
+            return
+
+        for (index, file_id, _), message in zip(items, messages):
+            sent_file = message.audio or message.document
+            if not file_id and sent_file:
+                self.file_cache.set(canonical_track_key(self.tracks[index]['url']), sent_file.file_id)
+            self._released[index].set()
+        self.sent += len(items)
+        self.on_progress(self)
+
+    async def _send_items(self, items: List[Tuple[int, Optional[str], Optional[str]]]) -> list:
+        """Отправляет треки медиагруппой (один трек - обычным аудио)"""
+        files = []
+        try:
+            audios = []
+            for index, file_id, file_path in items:
+                track = self.tracks[index]
+                audio = file_id
+                if audio is None:
+                    audio = open(file_path, 'rb')
+                    files.append(audio)
+                audios.append(dict(
+                    audio=audio,
+                    filename=self.filename(track, file_path) if file_path else None,
+                    title=track['title'],
+                    performer=track['uploader'],
+                    caption=f"🎵 {track['title']}\n👤 {track['uploader']}",
+                ))
+
+            if len(audios) == 1:
+                return [await self.bot.send_audio(chat_id=self.chat_id, **audios[0])]
+            media = [InputMediaAudio(media=audio.pop('audio'), **audio) for audio in audios]
+            return list(await self.bot.send_media_group(chat_id=self.chat_id, media=media))
+        finally:
+            for audio in files:
+                audio.close()
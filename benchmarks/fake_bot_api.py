@@ -0,0 +1,153 @@
+import re
+import json
+import time
+import asyncio
+import itertools
+import threading
+from collections import Counter
+from typing import Optional, Dict, Callable
+from urllib.parse import parse_qs
+
+# Поля multipart/form-data без файлов: name="chat_id"\r\n\r\n123
+MULTIPART_FIELD_RE = re.compile(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', re.S)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark Bot', 'username': 'benchmark_bot'}
+
+
+class FakeBotAPI:
+    """Локальный сервер, отвечающий как Telegram Bot API.
+
+    Работает в отдельном потоке со своим event loop, чтобы не искажать
+    измерения бота. На каждый вызов метода API вызывает on_call(method, params)
+    из потока сервера.
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.on_call: Optional[Callable[[str, Dict], None]] = None
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        """Адрес для Application.builder().base_url(...)"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, self.host, self.port, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """HTTP/1.1 с keep-alive: по одному запросу за раз на соединение"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = path.rstrip('/').rsplit('/', 1)[-1]
+                params = self._parse_params(headers.get('content-type', ''), body)
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                result = self._result(method, params)
+                self.calls[method] += 1
+                if self.on_call:
+                    self.on_call(method, params)
+
+                payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> Dict:
+        """Параметры вызова API (файлы в multipart не разбираются)"""
+        if not body:
+            return {}
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        if content_type.startswith('multipart/form-data'):
+            return {
+                name.decode(): value.decode('utf-8', 'replace')
+                for name, value in MULTIPART_FIELD_RE.findall(body)
+                if len(value) < 65536
+            }
+        return {name: values[0] for name, values in parse_qs(body.decode('utf-8')).items()}
+
+    def _message(self, params: Dict, **fields) -> Dict:
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        message.update(fields)
+        return message
+
+    def _audio_message(self, params: Dict) -> Dict:
+        file_number = next(self._file_ids)
+        audio = {'file_id': f"bench-audio-{file_number}", 'file_unique_id': f"bench-{file_number}", 'duration': 0}
+        return self._message(params, audio=audio)
+
+    def _result(self, method: str, params: Dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            return self._message(params)
+        if method == 'sendAudio':
+            return self._audio_message(params)
+        if method == 'sendMediaGroup':
+            media = json.loads(params.get('media') or '[]')
+            return [self._audio_message(params) for _ in media]
+        return True
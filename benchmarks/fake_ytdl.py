@@ -0,0 +1,160 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from typing import Optional, Dict, List, Callable
+
+# Шаблон ссылки поиска yt-dlp: scsearch25:запрос, ytsearch25:запрос
+SEARCH_URL_RE = re.compile(r'^(scsearch|ytsearch)(\d*):(.*)$')
+
+
+class FakeYoutubeDL:
+    """Заглушка yt_dlp.YoutubeDL для бенчмарка: готовые результаты поиска
+    и сгенерированные аудиофайлы с настраиваемыми задержками.
+
+    Задержки имитируются через time.sleep, то есть блокируют поток исполнителя,
+    как настоящие сетевые запросы yt-dlp.
+    """
+
+    search_latency = 0.3  # Задержка одного поиска (сек.)
+    info_latency = 0.1  # Задержка извлечения информации о треке (сек.)
+    download_latency = 0.5  # Длительность скачивания (сек.)
+    progress_steps = 5  # Сколько раз за скачивание вызывается progress hook
+    audio_bytes = 256 * 1024  # Размер сгенерированного файла
+    results_per_search = 25  # Сколько треков возвращает один поиск
+
+    # Счетчики вызовов (общие для всех экземпляров)
+    calls: Dict[str, int] = {'search': 0, 'info': 0, 'download': 0}
+    _calls_lock = threading.Lock()
+
+    def __init__(self, params: Optional[Dict] = None):
+        self.params = dict(params or {})
+        outtmpl = self.params.get('outtmpl') or '%(title)s.%(ext)s'
+        self.params['outtmpl'] = dict(outtmpl) if isinstance(outtmpl, dict) else {'default': outtmpl}
+        self._progress_hooks: List[Callable[[Dict], None]] = []
+        self.format_selector: Optional[Callable[[Dict], List[Dict]]] = None  # Как у YoutubeDL: выбор формата бота
+
+    @classmethod
+    def configure(cls, **settings):
+        """Меняет задержки и размеры для всех экземпляров"""
+        for name, value in settings.items():
+            if not hasattr(cls, name):
+                raise AttributeError(f"Неизвестная настройка заглушки yt-dlp: {name}")
+            setattr(cls, name, value)
+
+    @classmethod
+    def _count(cls, kind: str):
+        with cls._calls_lock:
+            cls.calls[kind] += 1
+
+    def add_progress_hook(self, hook: Callable[[Dict], None]):
+        self._progress_hooks.append(hook)
+
+    def get_info_extractor(self, ie_key: str):
+        return None
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _slug(text: str) -> str:
+        return '-'.join(''.join(ch if ch.isalnum() else ' ' for ch in text.lower()).split()) or 'track'
+
+    def _track_info(self, url: str) -> Dict:
+        """Полная информация о треке (как после извлечения страницы трека)"""
+        slug = url.rstrip('/').rsplit('/', 1)[-1].split('=')[-1]
+        track_id = hashlib.md5(url.encode('utf-8')).hexdigest()[:12]
+        return {
+            'id': track_id,
+            'title': slug.replace('-', ' ').title(),
+            'uploader': 'Benchmark Artist',
+            'duration': 180,
+            'webpage_url': url,
+            'extractor': 'soundcloud',
+            'formats': [{
+                'format_id': 'http_mp3_128',
+                'url': f'https://example.invalid/{track_id}.mp3',
+                'ext': 'mp3',
+                'acodec': 'mp3',
+                'vcodec': 'none',
+                'abr': 128,
+                'filesize': self.audio_bytes,
+            }],
+        }
+
+    def _search(self, backend: str, limit: int, query: str) -> Dict:
+        """Результаты поиска; все бэкенды возвращают одни и те же треки (разные ссылки)"""
+        slug = self._slug(query.replace(' soundcloud', ''))
+        entries = []
+        for index in range(min(limit or 1, self.results_per_search)):
+            if backend == 'scsearch':
+                url = f'https://soundcloud.com/benchmark/{slug}-{index}'
+            else:
+                url = f'https://www.youtube.com/watch?v={slug}-{index}'
+            entry = {
+                'id': f'{slug}-{index}',
+                'title': f'{query} {index}',
+                'uploader': 'Benchmark Artist',
+                'duration': 180,
+                'url': url,
+                'webpage_url': url,
+            }
+            if not self.params.get('extract_flat'):
+                entry = dict(self._track_info(url), **entry)
+            entries.append(entry)
+        return {'_type': 'playlist', 'id': query, 'title': query, 'entries': entries}
+
+    def extract_info(self, url: str, download: bool = True, **kwargs) -> Dict:
+        match = SEARCH_URL_RE.match(url)
+        if match:
+            self._count('search')
+            time.sleep(self.search_latency)
+            return self._search(match.group(1), int(match.group(2) or 1), match.group(3))
+
+        self._count('info')
+        time.sleep(self.info_latency)
+        info = self._track_info(url)
+        return self.process_ie_result(info, download=download)
+
+    def process_ie_result(self, info: Dict, download: bool = True, **kwargs) -> Dict:
+        info = dict(info)
+        if info.get('formats') and 'format_id' not in info:
+            selected = self.format_selector({'formats': info['formats']}) if self.format_selector else None
+            info.update((selected or info['formats'])[-1])
+        if download:
+            info['requested_downloads'] = [{'filepath': self._download(info)}]
+        return info
+
+    def _download(self, info: Dict) -> str:
+        """Имитирует скачивание трека: пишет файл нужного размера, вызывая progress hooks"""
+        self._count('download')
+        title = self._slug(info.get('title', 'track'))
+        path = self.params['outtmpl']['default'] % {'title': title, 'ext': info.get('ext', 'mp3'), 'id': info.get('id', '')}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        total = self.audio_bytes
+        steps = max(self.progress_steps, 1)
+        chunk = b'\0' * (total // steps)
+        with open(path + '.part', 'wb') as f:
+            for step in range(1, steps + 1):
+                time.sleep(self.download_latency / steps)
+                f.write(chunk)
+                self._hook({'status': 'downloading', 'downloaded_bytes': step * len(chunk),
+                            'total_bytes': total, 'filename': path})
+        os.replace(path + '.part', path)
+        self._hook({'status': 'finished', 'downloaded_bytes': total, 'total_bytes': total, 'filename': path})
+        return path
+
+    def _hook(self, status: Dict):
+        for hook in self._progress_hooks:
+            hook(status)
+
+
+def install(**settings):
+    """Подменяет yt_dlp.YoutubeDL заглушкой (до создания SoundCloudDownloader)"""
+    import yt_dlp
+    FakeYoutubeDL.configure(**settings)
+    yt_dlp.YoutubeDL = FakeYoutubeDL
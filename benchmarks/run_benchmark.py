@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк бота: поиск и скачивание при 1, 10, 100 и 1000 одновременных пользователях.
+
+Бот работает с локальным фейковым Bot API и заглушкой yt-dlp, сеть не нужна.
+Пример: python benchmarks/run_benchmark.py --users 1 10 100 --json results.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+import itertools
+from collections import defaultdict
+from typing import Optional, Dict, List, Callable, Tuple
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import fake_ytdl  # noqa: E402
+from fake_bot_api import FakeBotAPI, BOT_USER  # noqa: E402
+
+Predicate = Callable[[str, Dict], bool]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по ближайшему рангу (0 для пустого списка)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered)))) - 1
+    return ordered[index]
+
+
+def current_rss() -> int:
+    """Текущий RSS процесса в байтах"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # На Linux ru_maxrss в KB; это пик, а не текущее значение
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ApiWaiters:
+    """Ожидание вызовов фейкового Bot API для конкретного чата"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._waiters: Dict[int, List[Tuple[Predicate, asyncio.Future]]] = defaultdict(list)
+
+    def expect(self, chat_id: int, predicate: Predicate) -> asyncio.Future:
+        future = self.loop.create_future()
+        self._waiters[chat_id].append((predicate, future))
+        return future
+
+    def on_call(self, method: str, params: Dict):
+        """Вызывается из потока фейкового сервера"""
+        self.loop.call_soon_threadsafe(self._dispatch, method, params)
+
+    def _dispatch(self, method: str, params: Dict):
+        try:
+            chat_id = int(params.get('chat_id') or 0)
+        except ValueError:
+            return
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        for waiter in list(waiters):
+            predicate, future = waiter
+            if future.done():
+                waiters.remove(waiter)
+            elif predicate(method, params):
+                waiters.remove(waiter)
+                future.set_result((method, params))
+
+
+def search_finished(method: str, params: Dict) -> bool:
+    """Результаты поиска (клавиатура с треками) или ошибка поиска"""
+    return method == 'editMessageText' and (bool(params.get('reply_markup')) or params.get('text', '').startswith('❌'))
+
+
+def download_finished(method: str, params: Dict) -> bool:
+    """Трек отправлен или скачивание завершилось ошибкой"""
+    return method == 'sendAudio' or (method == 'editMessageText' and params.get('text', '').startswith('❌'))
+
+
+class LevelStats:
+    """Измерения одного уровня нагрузки"""
+
+    def __init__(self, users: int):
+        self.users = users
+        self.search_latencies: List[float] = []
+        self.download_latencies: List[float] = []
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.completed = 0
+        self.loop_lags: List[float] = []
+        self.peak_rss = 0
+        self.api_calls = 0
+        self.wall_time = 0.0
+
+    def report(self) -> Dict:
+        ms = lambda value: round(value * 1000, 1)
+        return {
+            'users': self.users,
+            'completed': self.completed,
+            'failures': dict(self.failures),
+            'wall_time_s': round(self.wall_time, 2),
+            'throughput_flows_per_s': round(self.completed / self.wall_time, 2) if self.wall_time else 0.0,
+            'api_calls_per_s': round(self.api_calls / self.wall_time, 1) if self.wall_time else 0.0,
+            'search_ms': {f'p{p}': ms(percentile(self.search_latencies, p)) for p in (50, 95, 99)},
+            'download_to_send_ms': {f'p{p}': ms(percentile(self.download_latencies, p)) for p in (50, 95, 99)},
+            'loop_lag_ms': {
+                'p50': ms(percentile(self.loop_lags, 50)),
+                'p99': ms(percentile(self.loop_lags, 99)),
+                'max': ms(max(self.loop_lags, default=0.0)),
+            },
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1),
+        }
+
+
+class BenchmarkRunner:
+    """Подает боту синтетические обновления и измеряет время до ответа в фейковом Bot API"""
+
+    def __init__(self, application, api: FakeBotAPI, waiters: ApiWaiters, timeout: float, shared_queries: int):
+        self.application = application
+        self.api = api
+        self.waiters = waiters
+        self.timeout = timeout
+        self.shared_queries = shared_queries
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    async def _send(self, data: Dict):
+        from telegram import Update
+        data['update_id'] = next(self._update_ids)
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    async def _wait(self, future: asyncio.Future) -> Optional[Tuple[str, Dict]]:
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def user_flow(self, user_id: int, query: str, stats: LevelStats):
+        """Поиск, затем скачивание первого трека из результатов"""
+        chat = {'id': user_id, 'type': 'private'}
+        search_done = self.waiters.expect(user_id, search_finished)
+        started = time.perf_counter()
+        await self._send({'message': {
+            'message_id': 1, 'date': int(time.time()), 'chat': chat, 'from': self._user(user_id), 'text': query,
+        }})
+        call = await self._wait(search_done)
+        if call is None:
+            stats.failures['search_timeout'] += 1
+            return
+        params = call[1]
+        if not params.get('reply_markup'):
+            stats.failures['search_error'] += 1
+            return
+        stats.search_latencies.append(time.perf_counter() - started)
+
+        download_done = self.waiters.expect(user_id, download_finished)
+        started = time.perf_counter()
+        await self._send({'callback_query': {
+            'id': str(user_id), 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': 'download_0',
+            'message': {
+                'message_id': int(params['message_id']), 'date': int(time.time()), 'chat': chat,
+                'from': BOT_USER, 'text': params.get('text', ''),
+            },
+        }})
+        call = await self._wait(download_done)
+        if call is None:
+            stats.failures['download_timeout'] += 1
+            return
+        if call[0] != 'sendAudio':
+            stats.failures['download_error'] += 1
+            return
+        stats.download_latencies.append(time.perf_counter() - started)
+        stats.completed += 1
+
+    async def _sample(self, stats: LevelStats, interval: float = 0.01):
+        """Задержка event loop и пиковый RSS"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            stats.loop_lags.append(max(0.0, loop.time() - started - interval))
+            stats.peak_rss = max(stats.peak_rss, current_rss())
+
+    async def run_level(self, level: int, users: int) -> LevelStats:
+        stats = LevelStats(users)
+        sampler = asyncio.create_task(self._sample(stats))
+        api_calls_before = sum(self.api.calls.values())
+        base_id = (level + 1) * 1_000_000
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                self.user_flow(base_id + index, self._query(level, index), stats) for index in range(users)
+            ))
+        finally:
+            stats.wall_time = time.perf_counter() - started
+            sampler.cancel()
+        stats.api_calls = sum(self.api.calls.values()) - api_calls_before
+        return stats
+
+    def _query(self, level: int, index: int) -> str:
+        """Запрос пользователя: уникальный или из общего набора (проверка кэшей и объединения скачиваний)"""
+        if self.shared_queries:
+            return f"benchmark shared {index % self.shared_queries}"
+        return f"benchmark level {level} user {index}"
+
+
+def print_table(reports: List[Dict]):
+    header = (f"{'users':>6} {'ok':>6} {'fail':>5} {'flows/s':>8} "
+              f"{'search p50/p95/p99 ms':>24} {'download p50/p95/p99 ms':>26} {'lag p99/max ms':>15} {'RSS MB':>7}")
+    print(header)
+    print('-' * len(header))
+    for r in reports:
+        s, d, lag = r['search_ms'], r['download_to_send_ms'], r['loop_lag_ms']
+        print(f"{r['users']:>6} {r['completed']:>6} {sum(r['failures'].values()):>5} {r['throughput_flows_per_s']:>8} "
+              f"{s['p50']:>8}/{s['p95']}/{s['p99']:<8} {d['p50']:>9}/{d['p95']}/{d['p99']:<9} "
+              f"{lag['p99']:>7}/{lag['max']:<7} {r['peak_rss_mb']:>7}")
+
+
+async def run(args) -> List[Dict]:
+    import soundcloud_downloader
+    from bot import MusicBot
+
+    # Заглушка yt-dlp подменяется только в этом процессе
+    soundcloud_downloader.EXTRACTION_BACKEND = 'thread'
+
+    api = FakeBotAPI(latency=args.api_latency)
+    api.start()
+    waiters = ApiWaiters(asyncio.get_running_loop())
+    api.on_call = waiters.on_call
+
+    bot = MusicBot()
+    application = bot.build_application(base_url=api.base_url)
+    await application.initialize()
+    await application.start()
+    await bot.post_init(application)
+
+    runner = BenchmarkRunner(application, api, waiters, args.timeout, args.shared_queries)
+    reports = []
+    try:
+        for level, users in enumerate(args.users):
+            stats = await runner.run_level(level, users)
+            report = stats.report()
+            reports.append(report)
+            logging.getLogger('benchmark').warning(f"Уровень {users}: {json.dumps(report, ensure_ascii=False)}")
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot.post_shutdown(application)
+        api.stop()
+
+    reports_calls = dict(fake_ytdl.FakeYoutubeDL.calls)
+    for report in reports:
+        report['ytdl_calls_total'] = reports_calls
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк Telegram Music Bot')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='Уровни одновременных пользователей')
+    parser.add_argument('--search-latency', type=float, default=0.3, help='Задержка поиска yt-dlp (сек.)')
+    parser.add_argument('--info-latency', type=float, default=0.1, help='Задержка извлечения трека (сек.)')
+    parser.add_argument('--download-latency', type=float, default=0.5, help='Длительность скачивания (сек.)')
+    parser.add_argument('--audio-kb', type=int, default=256, help='Размер сгенерированного аудиофайла (KB)')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='Задержка ответа фейкового Bot API (сек.)')
+    parser.add_argument('--shared-queries', type=int, default=0,
+                        help='Пользователи выбирают из N общих запросов (0 - у каждого свой запрос)')
+    parser.add_argument('--timeout', type=float, default=600, help='Таймаут одной операции пользователя (сек.)')
+    parser.add_argument('--json', help='Сохранить результаты в JSON')
+    parser.add_argument('--log-level', default='WARNING', help='Уровень логирования бота')
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    fake_ytdl.install(
+        search_latency=args.search_latency,
+        info_latency=args.info_latency,
+        download_latency=args.download_latency,
+        audio_bytes=args.audio_kb * 1024,
+    )
+
+    # Бот пишет загрузки и кэши в относительные папки - работаем во временной
+    os.chdir(tempfile.mkdtemp(prefix='musicbot-bench-'))
+    import bot  # noqa: F401 - настраивает логирование
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    reports = asyncio.run(run(args))
+    print_table(reports)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
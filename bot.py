@@ -1,11 +1,48 @@
+import time
+
+# Отсчет этапов запуска - до импорта остальных модулей, чтобы учесть и его
+STARTED = time.perf_counter()
+
 import logging
 import os
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import hashlib
+from typing import Optional, Dict
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultCachedAudio, InlineQueryResultArticle,
+    InlineQueryResultsButton, InputTextMessageContent
+)
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, filters, ContextTypes
+)
 from telegram.constants import ParseMode
-from soundcloud_downloader import SoundCloudDownloader
-from config import TELEGRAM_BOT_TOKEN, MAX_FILE_SIZE_MB
+from telegram.error import BadRequest
+from soundcloud_downloader import SoundCloudDownloader, soundcloud_link_kind
+from file_id_cache import canonical_track_key, is_file_id_error
+from update_processor import PerUserUpdateProcessor
+from download_scheduler import DownloadScheduler
+from audio_cache import AudioCache
+from audio_formats import cache_profile
+from disk_janitor import DiskJanitor, DiskQuotaExceeded
+from prefetcher import Prefetcher
+from backend_health import STATE_VALUES
+from batch_download import BatchDownload
+from state_backend import create_state_backend
+from message_editor import MessageEditCoalescer
+from metrics import REGISTRY, StartupTimer, request_trace, timed, count_error
+from webhook_server import WebhookServer, MetricsHandler, ReadinessHandler
+from config import (
+    TELEGRAM_BOT_TOKEN, MAX_FILE_SIZE_MB, MAX_CONCURRENT_UPDATES,
+    MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_USER, PROGRESS_EDIT_INTERVAL_SECONDS, SEARCH_EDIT_INTERVAL_SECONDS,
+    ENRICH_VISIBLE_PAGE,
+    AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB, STATE_BACKEND, DOWNLOAD_LOCK_POLL_SECONDS, METRICS_PATH, READY_PATH,
+    SEARCH_RESULTS_LIMIT, INLINE_DEBOUNCE_SECONDS, INLINE_CACHE_TIME_SECONDS,
+    PREFETCH_ENABLED, PREFETCH_TOP_N, PREFETCH_DOWNLOAD, PREFETCH_CONCURRENCY, PREFETCH_BANDWIDTH_KBPS,
+    PREFETCH_MAX_TRACK_MB, PREFETCH_DIR, PREFETCH_DISK_MB,
+    BATCH_CONCURRENCY, BATCH_MAX_TRACKS, BATCH_PRIORITY, BATCH_POLL_SECONDS, MEDIA_GROUP_MAX_ITEMS,
+    DOWNLOADS_DIR, TEMP_DIR, DISK_QUOTA_MB, DISK_RESERVE_MB, JANITOR_INTERVAL_SECONDS,
+    JANITOR_PARTIAL_MAX_AGE_SECONDS, JANITOR_ORPHAN_MAX_AGE_SECONDS
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,9 +53,118 @@ logger = logging.getLogger(__name__)
 
 class MusicBot:
     def __init__(self):
+        self.startup = StartupTimer(STARTED)
+        self.startup.mark('imports')
         self.downloader = SoundCloudDownloader()
-        self.user_searches = {}  # Хранение результатов поиска для каждого пользователя
+        # Состояние, общее для всех процессов бота (при STATE_BACKEND = 'sqlite')
+        self.state = create_state_backend(STATE_BACKEND)
+        self.file_cache = self.state.file_ids  # file_id уже отправленных треков
+        self.user_searches = self.state.sessions  # Результаты поиска пользователей
+        self.audio_cache = AudioCache(
+            AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024, cache_profile(),
+            self.state.audio_cache_index(AUDIO_CACHE_DIR)
+        )
+        # Уборка брошенных файлов и лимит места под downloads/ и temp/
+        self.janitor = DiskJanitor(
+            [DOWNLOADS_DIR, TEMP_DIR], [self.audio_cache],
+            DISK_QUOTA_MB * 1024 * 1024 if DISK_QUOTA_MB is not None else None, DISK_RESERVE_MB * 1024 * 1024,
+            MAX_CONCURRENT_DOWNLOADS, JANITOR_INTERVAL_SECONDS, JANITOR_PARTIAL_MAX_AGE_SECONDS,
+            JANITOR_ORPHAN_MAX_AGE_SECONDS
+        )
+        self.scheduler = DownloadScheduler(
+            self.downloader, self.audio_cache, MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_USER,
+            locks=self.state.download_locks, lock_poll_interval=DOWNLOAD_LOCK_POLL_SECONDS, disk=self.janitor
+        )
+        # Упреждающая загрузка треков, которые пользователь, вероятно, выберет
+        self.prefetcher = Prefetcher(
+            self.downloader, self.scheduler, self.audio_cache, PREFETCH_TOP_N, PREFETCH_DOWNLOAD, PREFETCH_CONCURRENCY,
+            PREFETCH_BANDWIDTH_KBPS * 1024, PREFETCH_MAX_TRACK_MB * 1024 * 1024, PREFETCH_DIR, PREFETCH_DISK_MB * 1024 * 1024,
+            scratch_index=self.state.audio_cache_index(PREFETCH_DIR) if PREFETCH_DOWNLOAD else None
+        ) if PREFETCH_ENABLED else None
+        if self.prefetcher and self.prefetcher.scratch:
+            self.janitor.add_cache(self.prefetcher.scratch)
+        self.update_processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+        self._inline_tasks: Dict[int, asyncio.Task] = {}  # Текущий встроенный поиск каждого пользователя
+        self._batch_tasks: Dict[int, asyncio.Task] = {}  # Идущее пакетное скачивание каждого пользователя
         self.TRACKS_PER_PAGE = 5  # Количество треков на странице
+        self.register_metrics()
+        self.startup.mark('init')
+    
+    def register_metrics(self):
+        """Регистрирует метрики состояния бота (значения читаются при запросе метрик)"""
+        REGISTRY.gauge(
+            'musicbot_executor_queue_depth', 'Задачи yt-dlp, ожидающие свободного потока или процесса', ('executor',),
+            collect=lambda: {(name,): depth for name, depth in self.downloader.queue_depths().items()}
+        )
+        REGISTRY.gauge(
+            'musicbot_active_downloads', 'Выполняющиеся скачивания',
+            collect=lambda: {(): self.scheduler.active_downloads}
+        )
+        REGISTRY.gauge(
+            'musicbot_download_queue_size', 'Скачивания, ожидающие в очереди',
+            collect=lambda: {(): self.scheduler.queue_size}
+        )
+        REGISTRY.gauge(
+            'musicbot_active_users', 'Пользователи, чьи обновления обрабатываются сейчас',
+            collect=lambda: {(): self.update_processor.active_users}
+        )
+        REGISTRY.gauge(
+            'musicbot_search_backend_state', 'Состояние бэкенда поиска: 0 - включен, 1 - проверяется, 2 - отключен',
+            ('backend',),
+            collect=lambda: {
+                (name,): STATE_VALUES[stats['state']] for name, stats in self.downloader.backend_health.stats().items()
+            }
+        )
+        REGISTRY.gauge(
+            'musicbot_search_backend_error_rate', 'Доля ошибок и таймаутов бэкенда поиска в скользящем окне',
+            ('backend',),
+            collect=lambda: {
+                (name,): stats['error_rate'] for name, stats in self.downloader.backend_health.stats().items()
+            }
+        )
+        REGISTRY.gauge(
+            'musicbot_search_backend_p95_seconds', 'p95 задержки бэкенда поиска в скользящем окне',
+            ('backend',),
+            collect=lambda: {
+                (name,): stats['p95_seconds'] for name, stats in self.downloader.backend_health.stats().items()
+                if stats['p95_seconds'] is not None
+            }
+        )
+        REGISTRY.gauge(
+            'musicbot_sessions', 'Пользователи с сохраненными результатами поиска',
+            collect=lambda: {(): self.user_searches.stats()['sessions']}
+        )
+        REGISTRY.gauge(
+            'musicbot_session_memory_bytes',
+            'Объем сохраненных результатов поиска пользователей (оценка памяти; при STATE_BACKEND = sqlite - объем в базе)',
+            collect=lambda: {(): self.user_searches.stats()['memory_bytes']}
+        )
+        REGISTRY.gauge(
+            'musicbot_search_cache_entries', 'Запросы в кэше результатов поиска (в памяти)',
+            collect=lambda: {(): self.downloader.search_cache.stats()['entries']}
+        )
+        REGISTRY.gauge(
+            'musicbot_search_cache_memory_bytes', 'Память, занятая кэшем результатов поиска (оценка)',
+            collect=lambda: {(): self.downloader.search_cache.stats()['memory_bytes']}
+        )
+        REGISTRY.gauge(
+            'musicbot_search_cache_hit_rate', 'Доля поисков, ответ на которые найден в кэше (в памяти или на диске)',
+            collect=lambda: {(): self.downloader.search_cache.stats()['hit_rate']}
+        )
+        if self.prefetcher and self.prefetcher.scratch:
+            REGISTRY.gauge(
+                'musicbot_prefetch_scratch_bytes', 'Размер черновой папки упреждающих скачиваний',
+                collect=lambda: {(): self.prefetcher.scratch.total_bytes}
+            )
+        REGISTRY.gauge(
+            'musicbot_disk_usage_bytes', 'Место, занятое downloads/ и temp/ (по последней уборке и размеру кэшей)',
+            collect=lambda: {(): self.janitor.usage_bytes} if self.janitor.usage_bytes is not None else {}
+        )
+        if self.janitor.quota_bytes is not None:
+            REGISTRY.gauge(
+                'musicbot_disk_quota_bytes', 'Лимит места под downloads/ и temp/',
+                collect=lambda: {(): self.janitor.quota_bytes}
+            )
     
     def create_progress_bar(self, percentage: int, length: int = 20) -> str:
         """Создает красивый прогресс-бар"""
@@ -26,8 +172,8 @@ class MusicBot:
         bar = "█" * filled + "░" * (length - filled)
         return f"[{bar}] {percentage}%"
     
-    async def update_download_progress(self, query, track_title: str, track_uploader: str, percentage: int):
-        """Обновляет прогресс скачивания"""
+    def update_download_progress(self, editor: MessageEditCoalescer, track_title: str, track_uploader: str, percentage: int):
+        """Обновляет прогресс скачивания (частые правки объединяются редактором сообщения)"""
         progress_bar = self.create_progress_bar(percentage)
         
         if percentage < 100:
@@ -35,13 +181,65 @@ class MusicBot:
         else:
             text = f"✅ Скачивание завершено!\n\n🎵 {track_title}\n👤 {track_uploader}\n\n{progress_bar}\n\n📤 Отправляю файл..."
         
+        editor.update(text)
+    
+    def update_queue_position(self, editor: MessageEditCoalescer, track_title: str, track_uploader: str, position: int):
+        """Показывает позицию трека в очереди на скачивание"""
+        text = f"🕒 Трек в очереди на скачивание\n\n🎵 {track_title}\n👤 {track_uploader}\n\n📋 Позиция в очереди: {position}"
+        editor.update(text)
+    
+    @staticmethod
+    def audio_filename(track: dict, file_path: str) -> str:
+        """Имя файла для Telegram (в кэше файлы называются по хэшу)"""
+        name = f"{track['uploader']} - {track['title']}"
+        name = ''.join(ch for ch in name if ch not in '\\/:*?"<>|').strip()[:100] or 'track'
+        return name + os.path.splitext(file_path)[1]
+    
+    async def send_cached_audio(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, track_key: str,
+                                track: Optional[dict] = None) -> bool:
+        """Отправляет трек по сохраненному file_id, без скачивания и загрузки
+        (без track - без подписи, название и исполнитель сохранены в самом файле)"""
+        file_id = self.file_cache.get(track_key)
+        if not file_id:
+            return False
+        
         try:
-            await query.edit_message_text(text)
-        except Exception:
-            pass  # Игнорируем ошибки обновления (слишком частые запросы)
+            if track is None:
+                await context.bot.send_audio(chat_id=chat_id, audio=file_id)
+            else:
+                await context.bot.send_audio(
+                    chat_id=chat_id,
+                    audio=file_id,
+                    title=track['title'],
+                    performer=track['uploader'],
+                    caption=f"🎵 {track['title']}\n👤 {track['uploader']}"
+                )
+        except BadRequest as e:
+            if not is_file_id_error(e):
+                # Ошибка не связана с файлом - сохраненный file_id остается верным
+                raise
+            # Telegram отклонил file_id - удаляем его и скачиваем трек заново
+            logger.warning(f"Устаревший file_id для {track_key}: {e}")
+            self.file_cache.invalidate(track_key)
+            return False
+        
+        logger.info(f"Трек {track_key} отправлен из кэша file_id ({self.file_cache.stats()})")
+        return True
+    
+    @staticmethod
+    def track_tag(track: dict) -> str:
+        """Короткая метка трека в кнопке: по ней находится трек, если список результатов изменился"""
+        return hashlib.sha1(canonical_track_key(track['url']).encode('utf-8')).hexdigest()[:8]
     
-    def create_tracks_keyboard(self, tracks: list, page: int = 0, user_id: int = None) -> InlineKeyboardMarkup:
-        """Создает клавиатуру с треками и пагинацией"""
+    def results_text(self, query_text: str, tracks: list) -> str:
+        """Заголовок списка треков: результаты поиска или треки сета по ссылке"""
+        if soundcloud_link_kind(query_text) == 'set':
+            return f"💿 Треков в сете: {len(tracks)}"
+        return f"🎵 Найдено {len(tracks)} треков по запросу: {query_text}"
+    
+    def create_tracks_keyboard(self, tracks: list, page: int = 0, user_id: int = None,
+                               download_all: bool = False) -> InlineKeyboardMarkup:
+        """Создает клавиатуру с треками и пагинацией (download_all - кнопка скачивания всего списка)"""
         keyboard = []
         
         # Вычисляем диапазон треков для текущей страницы
@@ -62,7 +260,7 @@ class MusicBot:
             # Только одна кнопка с названием трека для скачивания
             button_text = f"{source_icon} {title} - {uploader} • ⏱ {duration}"
             
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"download_{track_idx}")])
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"download_{track_idx}_{self.track_tag(track)}")])
         
         # Добавляем кнопки навигации
         nav_buttons = []
@@ -77,6 +275,12 @@ class MusicBot:
         if page < total_pages - 1:
             nav_buttons.append(InlineKeyboardButton("Далее ➡️", callback_data=f"page_{page+1}"))
         
+        # Скачивание всего списка или страницы одним пакетом
+        if download_all and len(tracks) > 1:
+            keyboard.append([InlineKeyboardButton(f"📥 Скачать все ({len(tracks)})", callback_data="download_all")])
+        if len(current_tracks) > 1:
+            keyboard.append([InlineKeyboardButton("📥 Скачать страницу", callback_data=f"download_page_{page}")])
+        
         if nav_buttons:
             keyboard.append(nav_buttons)
         
@@ -85,6 +289,168 @@ class MusicBot:
         
         return InlineKeyboardMarkup(keyboard)
     
+    async def send_track(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, track: dict,
+                         editor: MessageEditCoalescer, claim_prefetch: bool = True):
+        """Отправляет трек по file_id или скачивает его и отправляет файл, показывая прогресс"""
+        # Показываем сообщение о начале скачивания
+        title = track['title'].replace('*', '').replace('_', '').replace('`', '')
+        uploader = track['uploader'].replace('*', '').replace('_', '').replace('`', '')
+        final_text = f"✅ Трек успешно отправлен!\n\n🎵 {title}\n👤 {uploader}\n\n🎉 Наслаждайтесь музыкой!"
+        
+        # Трек уже загружался в Telegram - отправляем по file_id
+        track_key = canonical_track_key(track['url'])
+        with timed('download', 'file_id_send'):
+            sent_from_cache = await self.send_cached_audio(context, chat_id, track_key, track)
+        if sent_from_cache:
+            await editor.finish(final_text)
+            return
+        
+        # Заранее скачанный файл переносится в общий кэш аудио
+        if self.prefetcher and claim_prefetch:
+            self.prefetcher.claim(user_id, track['url'])
+        
+        # Начальный прогресс
+        self.update_download_progress(editor, title, uploader, 0)
+        
+        async def on_queue_position(position: int):
+            self.update_queue_position(editor, title, uploader, position)
+        
+        def on_download_progress(percentage: int):
+            self.update_download_progress(editor, title, uploader, percentage)
+        
+        # Скачиваем трек через планировщик (общая очередь и единое скачивание одинаковых треков)
+        async with self.scheduler.lease(track['url'], user_id, on_position=on_queue_position,
+                                        on_progress=on_download_progress) as file_path:
+            # Завершаем прогресс
+            self.update_download_progress(editor, title, uploader, 100)
+            
+            if file_path and os.path.exists(file_path):
+                # Отправляем файл
+                with timed('download', 'upload'), open(file_path, 'rb') as audio_file:
+                    message = await context.bot.send_audio(
+                        chat_id=chat_id,
+                        audio=audio_file,
+                        filename=self.audio_filename(track, file_path),
+                        title=track['title'],
+                        performer=track['uploader'],
+                        caption=f"🎵 {track['title']}\n👤 {track['uploader']}"
+                    )
+                
+                # Запоминаем file_id, чтобы не скачивать трек повторно
+                sent_file = message.audio or message.document
+                if sent_file:
+                    self.file_cache.set(track_key, sent_file.file_id)
+                
+                # Финальное сообщение с красивым оформлением
+                await editor.finish(final_text)
+            else:
+                error_text = f"❌ Не удалось скачать трек\n\n🎵 {title}\n👤 {uploader}\n\n💡 Попробуйте другой трек или повторите попытку позже."
+                await editor.finish(error_text)
+    
+    async def report_download_error(self, editor: MessageEditCoalescer, user_id: int, e: Exception):
+        """Сообщает пользователю об ошибке скачивания и удаляет его временные файлы"""
+        logger.error(f"Ошибка скачивания для пользователя {user_id}: {e}")
+        count_error('download', e)
+        error_msg = "❌ Ошибка при скачивании."
+        if "слишком большой" in str(e):
+            error_msg += f" Файл превышает лимит {MAX_FILE_SIZE_MB}MB."
+        elif isinstance(e, DiskQuotaExceeded):
+            error_msg += " На сервере не хватает места, попробуйте позже."
+        await editor.finish(error_msg)
+        
+        # Очищаем файлы пользователя при ошибке
+        self.downloader.cleanup_user_files(user_id)
+    
+    def batch_progress_text(self, batch: BatchDownload) -> str:
+        """Общий прогресс пакетного скачивания"""
+        text = (
+            f"⬇️ Скачиваю треки: {batch.finished}/{batch.total}\n\n{self.create_progress_bar(batch.percentage)}\n\n"
+            f"📤 Отправлено: {batch.sent}"
+        )
+        if batch.failed:
+            text += f"\n❌ Ошибок: {batch.failed}"
+        return text
+    
+    async def download_batch(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, tracks: list,
+                             editor: MessageEditCoalescer):
+        """Скачивает треки пакетом и отправляет их медиагруппами, показывая общий прогресс"""
+        batch = BatchDownload(
+            context.bot, self.scheduler, self.file_cache, chat_id, user_id, tracks[:BATCH_MAX_TRACKS],
+            BATCH_CONCURRENCY, BATCH_PRIORITY, MEDIA_GROUP_MAX_ITEMS,
+            filename=self.audio_filename, on_progress=lambda batch: editor.update(self.batch_progress_text(batch))
+        )
+        try:
+            sent = await batch.run()
+            logger.info(f"Пакет пользователя {user_id}: отправлено {sent} из {batch.total} треков")
+            text = f"✅ Отправлено треков: {sent} из {batch.total}"
+            if batch.failed:
+                text += f"\n❌ Не удалось скачать: {batch.failed}"
+            await editor.finish(text)
+        except asyncio.CancelledError:
+            logger.info(f"Пакет пользователя {user_id} отменен: отправлено {batch.sent} из {batch.total} треков")
+            await editor.finish(f"❌ Пакетное скачивание отменено. Отправлено треков: {batch.sent} из {batch.total}")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка пакетного скачивания для пользователя {user_id}: {e}")
+            count_error('batch', e)
+            await editor.finish(f"❌ Ошибка при пакетном скачивании. Отправлено треков: {batch.sent} из {batch.total}")
+    
+    async def run_batch(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, tracks: list,
+                        editor: MessageEditCoalescer):
+        """Пакетное скачивание в фоне (обновления пользователя обрабатываются, пока оно идет)"""
+        # /cancel может прийти в другой процесс бота - он отмечает отмену в общем состоянии
+        watcher = None
+        if self.state.batches.shared:
+            watcher = asyncio.create_task(self.watch_batch(user_id, asyncio.current_task()))
+        try:
+            with request_trace('batch', user_id):
+                await self.download_batch(context, chat_id, user_id, tracks, editor)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            if self._batch_tasks.get(user_id) is asyncio.current_task():
+                del self._batch_tasks[user_id]
+                self.state.batches.finish(user_id)
+    
+    async def watch_batch(self, user_id: int, batch: asyncio.Task):
+        """Продлевает отметку пакета в общем состоянии и отменяет пакет по просьбе другого процесса"""
+        while True:
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            if self.state.batches.poll(user_id):
+                logger.info(f"Пакет пользователя {user_id} отменен из другого процесса бота")
+                batch.cancel()
+                return
+    
+    def cancel_batch(self, user_id: int) -> bool:
+        """Отменяет пакетное скачивание пользователя, в том числе идущее в другом процессе (False - его не было)"""
+        task = self._batch_tasks.pop(user_id, None)
+        if task is None:
+            return self.state.batches.request_cancel(user_id)
+        self.state.batches.finish(user_id)
+        task.cancel()
+        return True
+    
+    def enrich_page(self, context: ContextTypes.DEFAULT_TYPE, tracks: list, page: int):
+        """Фоново извлекает полную информацию о треках видимой страницы"""
+        if not ENRICH_VISIBLE_PAGE:
+            return
+        start_idx = page * self.TRACKS_PER_PAGE
+        context.application.create_task(
+            self.downloader.enrich_tracks(tracks[start_idx:start_idx + self.TRACKS_PER_PAGE])
+        )
+    
+    def prefetch_page(self, user_id: int, tracks: list, page: int):
+        """Заранее загружает первые треки видимой страницы (прежняя загрузка пользователя отменяется)"""
+        if not self.prefetcher:
+            return
+        start_idx = page * self.TRACKS_PER_PAGE
+        self.prefetcher.schedule(user_id, tracks[start_idx:start_idx + self.TRACKS_PER_PAGE])
+    
+    def cancel_prefetch(self, user_id: int):
+        """Отменяет упреждающую загрузку пользователя и забывает загруженное для прежнего поиска"""
+        if self.prefetcher:
+            self.prefetcher.cancel(user_id, forget=True)
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         welcome_text = """
@@ -134,6 +500,7 @@ class MusicBot:
 • Отправьте название трека: "Imagine Dragons Believer"
 • Отправьте имя исполнителя: "The Weeknd"
 • Используйте комбинации: "artist - song name"
+• Отправьте ссылку на трек или сет SoundCloud - без поиска
 
 **Примеры запросов:**
 • `Billie Eilish bad guy`
@@ -155,8 +522,9 @@ class MusicBot:
         user_id = update.effective_user.id
         
         # Очищаем данные пользователя
-        if user_id in self.user_searches:
-            del self.user_searches[user_id]
+        self.user_searches.pop(user_id)
+        self.cancel_prefetch(user_id)
+        self.cancel_batch(user_id)
         
         # Очищаем файлы пользователя
         self.downloader.cleanup_user_files(user_id)
@@ -172,37 +540,160 @@ class MusicBot:
             await update.message.reply_text("❌ Запрос слишком короткий. Введите название трека или исполнителя.")
             return
         
-        # Отправляем сообщение о поиске
-        search_message = await update.message.reply_text(f"🔍 Ищу: *{query}*...", parse_mode=ParseMode.MARKDOWN)
+        # Ссылка на трек или сет SoundCloud - без поиска
+        link = await self.downloader.parse_link(query) if 'soundcloud.com' in query.lower() else None
+        if link:
+            kind, url = link
+            if kind == 'set':
+                await self.show_set(update, context, url)
+            else:
+                await self.download_link(update, context, url)
+            return
         
-        try:
-            # Выполняем поиск
-            logger.info(f"Начинаем поиск для пользователя {user_id}: '{query}'")
-            tracks = await self.downloader.search_tracks(query, limit=25)
-            logger.info(f"Поиск завершен, найдено треков: {len(tracks)}")
+        with request_trace('search', user_id):
+            # Новый поиск - упреждающая загрузка для прежних результатов больше не нужна
+            self.cancel_prefetch(user_id)
+            
+            # Отправляем сообщение о поиске
+            search_message = await update.message.reply_text(f"🔍 Ищу: *{query}*...", parse_mode=ParseMode.MARKDOWN)
             
+            # Результаты показываются по мере ответов бэкендов, правки - с ограничением частоты
+            editor = MessageEditCoalescer(search_message.edit_text, SEARCH_EDIT_INTERVAL_SECONDS)
+            try:
+                # Выполняем поиск
+                logger.info(f"Начинаем поиск для пользователя {user_id}: '{query}'")
+                tracks = []
+                async for tracks in self.downloader.search_tracks_iter(query, limit=SEARCH_RESULTS_LIMIT):
+                    editor.update(
+                        f"🎵 Найдено {len(tracks)} треков по запросу: {query}\n⏳ Ищу еще...",
+                        self.create_tracks_keyboard(tracks, page=0, user_id=user_id)
+                    )
+                logger.info(f"Поиск завершен, найдено треков: {len(tracks)}")
+                
+                if not tracks:
+                    await editor.finish("❌ Ничего не найдено. Попробуйте другой запрос.")
+                    return
+                
+                # Сохраняем результаты для пользователя с информацией о текущей странице
+                session = self.user_searches.set(user_id, query, tracks)
+                
+                # Создаем клавиатуру с пагинацией
+                reply_markup = self.create_tracks_keyboard(session.tracks, page=0, user_id=user_id)
+                
+                # Простое сообщение без лишнего текста
+                results_text = self.results_text(query, tracks)
+                
+                await editor.finish(results_text, reply_markup)
+                self.enrich_page(context, session.tracks, 0)
+                self.prefetch_page(user_id, session.tracks, 0)
+                
+            except Exception as e:
+                logger.error(f"Ошибка поиска для пользователя {user_id}: {e}")
+                count_error('search', e)
+                await editor.finish("❌ Произошла ошибка при поиске. Попробуйте позже.")
+    
+    async def download_link(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
+        """Ссылка на трек: отправка по file_id или скачивание с одним извлечением информации"""
+        user_id = update.effective_user.id
+        chat_id = update.effective_chat.id
+        with request_trace('download', user_id):
+            # Трек уже загружался в Telegram - отправляем сразу, даже без извлечения информации
+            with timed('download', 'file_id_send'):
+                if await self.send_cached_audio(context, chat_id, canonical_track_key(url)):
+                    return
+            
+            status_message = await update.message.reply_text("🔍 Получаю информацию о треке...")
+            editor = MessageEditCoalescer(status_message.edit_text, PROGRESS_EDIT_INTERVAL_SECONDS)
+            try:
+                track = await self.downloader.get_track_info(url)
+                if track is None:
+                    await editor.finish("❌ Не удалось получить трек по этой ссылке.")
+                    return
+                await self.send_track(context, chat_id, user_id, track, editor, claim_prefetch=False)
+            except Exception as e:
+                await self.report_download_error(editor, user_id, e)
+    
+    async def show_set(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
+        """Ссылка на сет SoundCloud: список треков сета с кнопкой скачивания всех"""
+        user_id = update.effective_user.id
+        with request_trace('search', user_id):
+            self.cancel_prefetch(user_id)
+            status_message = await update.message.reply_text("🔍 Получаю список треков...")
+            tracks = await self.downloader.get_playlist_tracks(url, BATCH_MAX_TRACKS)
             if not tracks:
-                await search_message.edit_text("❌ Ничего не найдено. Попробуйте другой запрос.")
+                await status_message.edit_text("❌ Не удалось получить треки по этой ссылке.")
                 return
             
-            # Сохраняем результаты для пользователя с информацией о текущей странице
-            self.user_searches[user_id] = {
-                'tracks': tracks,
-                'current_page': 0,
-                'query': query
-            }
-            
-            # Создаем клавиатуру с пагинацией
-            reply_markup = self.create_tracks_keyboard(tracks, page=0, user_id=user_id)
+            # Сет сохраняется как результаты поиска: выбор трека и страницы работают как обычно
+            session = self.user_searches.set(user_id, url, tracks)
+            reply_markup = self.create_tracks_keyboard(session.tracks, page=0, user_id=user_id, download_all=True)
+            await status_message.edit_text(self.results_text(url, tracks), reply_markup=reply_markup)
+            self.prefetch_page(user_id, session.tracks, 0)
+    
+    async def inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик встроенных запросов (@bot запрос в любом чате)"""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+        
+        # Новый запрос пользователя отменяет его предыдущий, еще не отвеченный
+        previous = self._inline_tasks.pop(user_id, None)
+        if previous is not None:
+            previous.cancel()
+        
+        query = inline_query.query.strip()
+        if len(query) < 2:
+            return
+        
+        task = asyncio.create_task(self.answer_inline_query(inline_query, query))
+        self._inline_tasks[user_id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.debug(f"Встроенный запрос пользователя {user_id} '{query}' устарел")
+        finally:
+            if self._inline_tasks.get(user_id) is task:
+                del self._inline_tasks[user_id]
+    
+    async def answer_inline_query(self, inline_query, query: str):
+        """Ищет треки (с паузой, пока пользователь печатает) и отвечает на встроенный запрос"""
+        with request_trace('inline', inline_query.from_user.id):
+            if not self.downloader.search_cache.contains(query, SEARCH_RESULTS_LIMIT):
+                await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
             
-            # Простое сообщение без лишнего текста
-            results_text = f"🎵 Найдено {len(tracks)} треков по запросу: {query}"
+            tracks = await self.downloader.search_tracks(query, limit=SEARCH_RESULTS_LIMIT)
+            try:
+                await inline_query.answer(
+                    self.inline_results(tracks),
+                    cache_time=INLINE_CACHE_TIME_SECONDS,
+                    button=InlineQueryResultsButton(text="🎵 Скачать в боте", start_parameter="inline"),
+                )
+            except BadRequest as e:
+                # Telegram уже не ждет ответа (пользователь ввел другой запрос)
+                logger.debug(f"Не удалось ответить на встроенный запрос '{query}': {e}")
+    
+    def inline_results(self, tracks: list) -> list:
+        """Результаты встроенного режима: уже загруженные в Telegram треки - сразу аудио по file_id,
+        остальные - карточки со ссылкой на трек"""
+        cached, articles = [], []
+        for track in tracks:
+            track_key = canonical_track_key(track['url'])
+            result_id = hashlib.sha1(track_key.encode('utf-8')).hexdigest()
+            caption = f"🎵 {track['title']}\n👤 {track['uploader']}"
             
-            await search_message.edit_text(results_text, reply_markup=reply_markup)
+            file_id = self.file_cache.get(track_key)
+            if file_id:
+                cached.append(InlineQueryResultCachedAudio(id=f"a{result_id}", audio_file_id=file_id, caption=caption))
+                continue
             
-        except Exception as e:
-            logger.error(f"Ошибка поиска для пользователя {user_id}: {e}")
-            await search_message.edit_text("❌ Произошла ошибка при поиске. Попробуйте позже.")
+            duration = self.downloader.format_duration(track.get('duration', 0))
+            articles.append(InlineQueryResultArticle(
+                id=f"t{result_id}",
+                title=track['title'],
+                description=f"{track['uploader']} • ⏱ {duration}",
+                input_message_content=InputTextMessageContent(f"{caption}\n🔗 {track['url']}"),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Открыть трек", url=track['url'])]]),
+            ))
+        return cached + articles
     
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
@@ -213,8 +704,9 @@ class MusicBot:
         data = query.data
         
         if data == "cancel_search":
-            if user_id in self.user_searches:
-                del self.user_searches[user_id]
+            self.user_searches.pop(user_id)
+            self.cancel_prefetch(user_id)
+            self.cancel_batch(user_id)
             await query.edit_message_text("❌ Поиск отменен.")
             return
         
@@ -223,20 +715,25 @@ class MusicBot:
             try:
                 new_page = int(data.split("_")[1])
                 
-                if user_id not in self.user_searches:
+                session = self.user_searches.get(user_id)
+                if session is None:
                     await query.edit_message_text("❌ Данные поиска не найдены. Выполните новый поиск.")
                     return
                 
                 # Обновляем текущую страницу
-                self.user_searches[user_id]['current_page'] = new_page
-                tracks = self.user_searches[user_id]['tracks']
-                query_text = self.user_searches[user_id]['query']
+                self.user_searches.set_page(user_id, new_page)
+                tracks = session.tracks
+                query_text = session.query
                 
                 # Создаем новую клавиатуру
-                reply_markup = self.create_tracks_keyboard(tracks, page=new_page, user_id=user_id)
-                results_text = f"🎵 Найдено {len(tracks)} треков по запросу: {query_text}"
+                reply_markup = self.create_tracks_keyboard(
+                    tracks, page=new_page, user_id=user_id, download_all=soundcloud_link_kind(query_text) == 'set'
+                )
+                results_text = self.results_text(query_text, tracks)
                 
                 await query.edit_message_text(results_text, reply_markup=reply_markup)
+                self.enrich_page(context, tracks, new_page)
+                self.prefetch_page(user_id, tracks, new_page)
                 return
                 
             except Exception as e:
@@ -247,73 +744,65 @@ class MusicBot:
         if data == "current_page":
             return
         
-        if data.startswith("download_"):
+        if data == "download_all" or data.startswith("download_page_"):
+            session = self.user_searches.get(user_id)
+            if session is None:
+                await query.edit_message_text("❌ Данные поиска не найдены. Выполните новый поиск.")
+                return
+            
+            # Один пакет на пользователя во всех процессах бота
+            if user_id in self._batch_tasks or not self.state.batches.start(user_id):
+                await query.message.reply_text("⏳ Предыдущий пакет еще скачивается. Отменить его - /cancel")
+                return
+            
+            tracks = session.tracks
+            if data != "download_all":
+                start_idx = int(data.split("_")[2]) * self.TRACKS_PER_PAGE
+                tracks = tracks[start_idx:start_idx + self.TRACKS_PER_PAGE]
+            # Прогресс пакета - отдельным сообщением, результаты поиска остаются
             try:
-                track_index = int(data.split("_")[1])
-                
-                if user_id not in self.user_searches:
-                    await query.edit_message_text("❌ Данные поиска не найдены. Выполните новый поиск.")
-                    return
-                
-                tracks = self.user_searches[user_id]['tracks']
-                if track_index >= len(tracks):
-                    await query.edit_message_text("❌ Неверный выбор трека.")
-                    return
-                
-                track = tracks[track_index]
-                
-                # Показываем сообщение о начале скачивания
-                title = track['title'].replace('*', '').replace('_', '').replace('`', '')
-                uploader = track['uploader'].replace('*', '').replace('_', '').replace('`', '')
-                
-                # Начальный прогресс
-                await self.update_download_progress(query, title, uploader, 0)
-                
-                # Показываем прогресс поэтапно
-                for progress in [10, 25, 40, 60, 75, 90]:
-                    await asyncio.sleep(0.3)  # Небольшая задержка для визуального эффекта
-                    await self.update_download_progress(query, title, uploader, progress)
-                
-                # Скачиваем трек
-                file_path = await self.downloader.download_track(track['url'], user_id)
-                
-                # Завершаем прогресс
-                await self.update_download_progress(query, title, uploader, 100)
-                
-                if file_path and os.path.exists(file_path):
-                    # Отправляем файл
-                    with open(file_path, 'rb') as audio_file:
-                        await context.bot.send_audio(
-                            chat_id=query.message.chat_id,
-                            audio=audio_file,
-                            title=track['title'],
-                            performer=track['uploader'],
-                            caption=f"🎵 {track['title']}\n👤 {track['uploader']}"
-                        )
+                status_message = await query.message.reply_text(f"⬇️ Скачиваю треки: 0/{len(tracks)}")
+            except Exception:
+                self.state.batches.finish(user_id)
+                raise
+            editor = MessageEditCoalescer(status_message.edit_text, PROGRESS_EDIT_INTERVAL_SECONDS)
+            # Пакет идет в фоне и не держит очередь обновлений пользователя: он может листать
+            # результаты, искать и отменить пакет. Не через application.create_task: остановка
+            # приложения ждала бы такие задачи до конца пакета
+            self._batch_tasks[user_id] = asyncio.create_task(
+                self.run_batch(context, query.message.chat_id, user_id, tracks, editor)
+            )
+            return
+        
+        if data.startswith("download_"):
+            with request_trace('download', user_id):
+                # Все правки сообщения о скачивании идут через один редактор с ограничением частоты
+                editor = MessageEditCoalescer(query.edit_message_text, PROGRESS_EDIT_INTERVAL_SECONDS)
+                try:
+                    parts = data.split("_")
+                    track_index = int(parts[1])
                     
-                    # Удаляем временный файл
-                    os.remove(file_path)
+                    session = self.user_searches.get(user_id)
+                    if session is None:
+                        await query.edit_message_text("❌ Данные поиска не найдены. Выполните новый поиск.")
+                        return
                     
-                    # Финальное сообщение с красивым оформлением
-                    final_text = f"✅ Трек успешно отправлен!\n\n🎵 {title}\n👤 {uploader}\n\n🎉 Наслаждайтесь музыкой!"
-                    await query.edit_message_text(final_text)
-                else:
-                    error_text = f"❌ Не удалось скачать трек\n\n🎵 {title}\n👤 {uploader}\n\n💡 Попробуйте другой трек или повторите попытку позже."
-                    await query.edit_message_text(error_text)
-                
-                # Не очищаем результаты поиска, чтобы пользователь мог скачать еще треки
-                # if user_id in self.user_searches:
-                #     del self.user_searches[user_id]
-                
-            except Exception as e:
-                logger.error(f"Ошибка скачивания для пользователя {user_id}: {e}")
-                error_msg = "❌ Ошибка при скачивании."
-                if "слишком большой" in str(e):
-                    error_msg += f" Файл превышает лимит {MAX_FILE_SIZE_MB}MB."
-                await query.edit_message_text(error_msg)
-                
-                # Очищаем файлы пользователя при ошибке
-                self.downloader.cleanup_user_files(user_id)
+                    tracks = session.tracks
+                    track = tracks[track_index] if track_index < len(tracks) else None
+                    if len(parts) > 2 and (track is None or self.track_tag(track) != parts[2]):
+                        # Кнопка из промежуточных результатов поиска - ищем трек по метке
+                        track = next((t for t in tracks if self.track_tag(t) == parts[2]), None)
+                    if track is None:
+                        await query.edit_message_text("❌ Неверный выбор трека.")
+                        return
+                    
+                    await self.send_track(context, query.message.chat_id, user_id, track, editor)
+                    
+                    # Не очищаем результаты поиска, чтобы пользователь мог скачать еще треки
+                    # self.user_searches.pop(user_id)
+                    
+                except Exception as e:
+                    await self.report_download_error(editor, user_id, e)
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок"""
@@ -334,24 +823,75 @@ class MusicBot:
             except Exception:
                 pass  # Если не можем отправить сообщение, просто игнорируем
     
-    def run(self):
-        """Запуск бота"""
-        if not TELEGRAM_BOT_TOKEN:
-            logger.error("TELEGRAM_BOT_TOKEN не установлен!")
+    async def post_init(self, application: Application):
+        """Запускает прогрев yt-dlp и уборку диска в фоне: обновления принимаются, не дожидаясь их"""
+        application.create_task(self.report_ready(application))
+        # Не через application.create_task: остановка приложения ждет такие задачи, а уборка идет до выключения
+        self.janitor.start()
+    
+    def is_ready(self, application: Application) -> bool:
+        """Приложение обрабатывает обновления и yt-dlp прогрет"""
+        return application.running and self.downloader.ready
+    
+    async def report_ready(self, application: Application):
+        """Дожидается прогрева и запуска приложения и пишет в журнал разбивку запуска по этапам"""
+        try:
+            await self.downloader.start_warm_up()
+        except Exception as e:
+            logger.error(f"Ошибка прогрева yt-dlp: {e}")
+            count_error('startup', e)
             return
-        
-        # Создаем приложение
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        self.startup.mark('warm_up')
+        while not application.running:
+            await asyncio.sleep(0.05)
+        elapsed = self.startup.mark('ready')
+        logger.info(f"Бот готов через {elapsed:.2f} сек. после запуска ({self.startup.breakdown()})")
+    
+    async def post_shutdown(self, application: Application):
+        """Останавливает фоновые задачи, освобождает пулы потоков и YoutubeDL, закрывает хранилище состояния"""
+        if self.prefetcher:
+            self.prefetcher.close()
+        batches = list(self._batch_tasks.values())
+        for task in batches:
+            task.cancel()
+        await asyncio.gather(*batches, return_exceptions=True)
+        self.janitor.close()
+        self.downloader.close()
+        self.state.close()
+    
+    def build_application(self, base_url: Optional[str] = None) -> Application:
+        """Создает приложение с обработчиками бота (base_url - другой адрес Bot API, например для бенчмарка)"""
+        # Разные пользователи обслуживаются параллельно, обновления одного пользователя - последовательно
+        builder = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .concurrent_updates(self.update_processor)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+        )
+        if base_url:
+            builder = builder.base_url(base_url)
+        application = builder.build()
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("cancel", self.cancel_command))
         application.add_handler(CallbackQueryHandler(self.handle_callback))
+        application.add_handler(InlineQueryHandler(self.inline_query))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.search_music))
         
         # Добавляем обработчик ошибок
         application.add_error_handler(self.error_handler)
+        return application
+    
+    def run(self):
+        """Запуск бота"""
+        if not TELEGRAM_BOT_TOKEN:
+            logger.error("TELEGRAM_BOT_TOKEN не установлен!")
+            return
+        
+        application = self.build_application()
         
         # Запускаем бота
         logger.info("Бот запущен!")
@@ -364,12 +904,16 @@ class MusicBot:
         if os.environ.get('KOYEB_PUBLIC_DOMAIN'):
             # Webhook для Koyeb
             webhook_url = f"https://{os.environ.get('KOYEB_PUBLIC_DOMAIN')}/webhook"
-            application.run_webhook(
-                listen="0.0.0.0",
-                port=port,
-                webhook_url=webhook_url,
-                allowed_updates=Update.ALL_TYPES
+            # Свой сервер вместо run_webhook, чтобы на том же порту отдавать метрики
+            extra_handlers = [(METRICS_PATH, MetricsHandler, {'registry': REGISTRY})] if METRICS_PATH else []
+            if READY_PATH:
+                extra_handlers.append((READY_PATH, ReadinessHandler, {'is_ready': lambda: self.is_ready(application)}))
+            # С общим состоянием процессы бота могут слушать один порт
+            server = WebhookServer(
+                application, "0.0.0.0", port, webhook_url, extra_handlers=extra_handlers, startup=self.startup,
+                reuse_port=STATE_BACKEND == 'sqlite'
             )
+            asyncio.run(server.serve(allowed_updates=Update.ALL_TYPES))
         else:
             # Polling для локальной разработки
             application.run_polling(allowed_updates=Update.ALL_TYPES)
@@ -7,22 +7,121 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '8355254283:AAEE06P7FLtlQrR
 # Download Configuration
 MAX_DOWNLOAD_SIZE_MB = 50  # Максимальный размер файла в MB
 DOWNLOAD_TIMEOUT_SECONDS = 300  # Таймаут скачивания в секундах
+INFO_TIMEOUT_SECONDS = 30  # Таймаут извлечения информации о треке
+INFO_CACHE_TTL_SECONDS = 600  # Сколько хранить информацию о треках из поиска для скачивания без повторного извлечения
+INFO_CACHE_MAX_ENTRIES = 200  # Максимум треков с сохраненной информацией
+
+# Concurrency Configuration
+MAX_CONCURRENT_UPDATES = 64  # Сколько обновлений обрабатывается одновременно (для разных пользователей)
+MAX_CONCURRENT_DOWNLOADS = 4  # Сколько треков скачивается одновременно
+MAX_DOWNLOADS_PER_USER = 1  # Сколько треков одновременно скачивается для одного пользователя
+SEARCH_WORKERS = 6  # Потоки (и экземпляры YoutubeDL) для поиска
+INFO_WORKERS = 4  # Потоки (и экземпляры YoutubeDL) для извлечения информации о треках
+DOWNLOAD_WORKERS = MAX_CONCURRENT_DOWNLOADS  # Потоки (и экземпляры YoutubeDL) для скачивания
+EXTRACTION_BACKEND = 'thread'  # Где выполняется yt-dlp: 'thread' (пулы потоков) или 'process' (пулы процессов)
+PROCESS_MAX_TASKS_PER_CHILD = 50  # Через сколько задач перезапускать рабочий процесс (ограничение роста памяти)
+
+# Progress Configuration
+PROGRESS_EDIT_INTERVAL_SECONDS = 1.5  # Минимальный интервал между правками сообщения с прогрессом
+SEARCH_EDIT_INTERVAL_SECONDS = 1.0  # Минимальный интервал между правками сообщения с результатами, пока поиск продолжается
+
+# Metrics Configuration
+METRICS_PATH = '/metrics'  # Адрес метрик Prometheus на порту webhook (None - не отдавать)
+READY_PATH = '/ready'  # Адрес проверки готовности на порту webhook: 200 после запуска и прогрева, до этого 503 (None - не отдавать)
+SLOW_REQUEST_LOG_SECONDS = 10.0  # Запросы дольше этого пишутся в журнал с разбивкой по этапам (None - не писать)
 
 # Paths
 DOWNLOADS_DIR = 'downloads'
 TEMP_DIR = 'temp'
+CACHE_DIR = 'cache'
+
+# Disk Configuration
+DISK_QUOTA_MB = 2048  # Общий лимит места под downloads/ и temp/ в MB (None - без лимита)
+DISK_RESERVE_MB = MAX_DOWNLOAD_SIZE_MB  # Сколько места оставлять под каждое идущее скачивание
+JANITOR_INTERVAL_SECONDS = 300  # Как часто убирать брошенные файлы и пересчитывать занятое место
+JANITOR_PARTIAL_MAX_AGE_SECONDS = 600  # Через сколько секунд без записи недокачанный файл (.part, .ytdl, .tmp) считается брошенным
+JANITOR_ORPHAN_MAX_AGE_SECONDS = DOWNLOAD_TIMEOUT_SECONDS + 600  # Через сколько удаляются файлы в папках пользователей и temp/ (в кэш они не попали)
+
+# Search Configuration
+SEARCH_PARALLEL = True  # Опрашивать бэкенды поиска одновременно
+SEARCH_BACKEND_TIMEOUT_SECONDS = 15  # Таймаут одного бэкенда поиска
+SEARCH_FLAT = True  # Быстрый поиск: только метаданные, полная информация - для выбранного трека
+ENRICH_VISIBLE_PAGE = False  # Фоново извлекать полную информацию о треках видимой страницы
+ENRICH_CONCURRENCY = 2  # Сколько треков извлекается одновременно при фоновом обогащении
+SEARCH_RESULTS_LIMIT = 25  # Сколько треков запрашивать у поиска (в чате и во встроенном режиме)
+
+# Search Backend Health
+SEARCH_STATS_WINDOW = 50  # По скольким последним запросам к бэкенду считаются задержка и доля ошибок
+SEARCH_DEGRADED_ERROR_RATE = 0.2  # Доля ошибок, при которой бэкенд опрашивается после остальных
+SEARCH_BREAKER_MIN_REQUESTS = 5  # Минимум запросов в окне, чтобы предохранитель мог сработать
+SEARCH_BREAKER_ERROR_RATE = 0.5  # Доля ошибок и таймаутов, при которой бэкенд отключается
+SEARCH_BREAKER_COOLDOWN_SECONDS = 30  # Через сколько отключенный бэкенд проверяется пробным запросом
+SEARCH_BREAKER_MAX_COOLDOWN_SECONDS = 600  # Предел паузы (удваивается после каждой неудачной проверки)
+SEARCH_PROBE_QUERY = 'music'  # Запрос для фоновой проверки отключенного бэкенда
+SEARCH_HEDGE = True  # При поочередном опросе запускать следующий бэкенд, если текущий отвечает дольше своего p95
+SEARCH_HEDGE_MIN_SAMPLES = 10  # Сколько ответов нужно, чтобы доверять p95 бэкенда
+SEARCH_HEDGE_DEFAULT_SECONDS = 3.0  # Задержка перед запуском следующего бэкенда, пока p95 неизвестен
+SEARCH_HEDGE_MIN_SECONDS = 0.3  # Минимальная задержка перед запуском следующего бэкенда
+
+# Batch Configuration
+BATCH_CONCURRENCY = 3  # Сколько треков пакета (страница результатов или сет SoundCloud) скачивается одновременно
+BATCH_MAX_TRACKS = 50  # Максимум треков в одном пакете
+BATCH_PRIORITY = 1  # Приоритет пакетных скачиваний в очереди (одиночные - 0, идут раньше)
+PLAYLIST_TIMEOUT_SECONDS = 120  # Таймаут извлечения сета SoundCloud (информация о каждом треке)
+
+# Link Configuration
+SHORT_LINK_TIMEOUT_SECONDS = 10  # Таймаут раскрытия короткой ссылки on.soundcloud.com
+SHORT_LINK_CACHE_TTL_SECONDS = 86400  # Сколько помнить, куда ведет короткая ссылка
+SHORT_LINK_CACHE_MAX_ENTRIES = 10000  # Максимум коротких ссылок в кэше
+
+# Prefetch Configuration
+PREFETCH_ENABLED = False  # Упреждающая загрузка первых треков видимой страницы, пока пользователь выбирает
+PREFETCH_TOP_N = 2  # Сколько первых треков страницы загружать заранее
+PREFETCH_DOWNLOAD = False  # Заранее скачивать файлы (False - только извлекать информацию о треках)
+PREFETCH_CONCURRENCY = 1  # Сколько треков загружается заранее одновременно (для всех пользователей)
+PREFETCH_BANDWIDTH_KBPS = 1024  # Общий лимит скорости упреждающих скачиваний (KB/сек.)
+PREFETCH_MAX_TRACK_MB = 15  # Треки больше этого заранее не скачиваются
+PREFETCH_DIR = os.path.join(DOWNLOADS_DIR, 'prefetch')  # Черновая папка упреждающих скачиваний
+PREFETCH_DISK_MB = 200  # Бюджет черновой папки в MB (давно не использовавшиеся файлы вытесняются)
+
+# Inline Mode Configuration
+INLINE_DEBOUNCE_SECONDS = 0.4  # Пауза перед поиском по встроенному запросу (пока пользователь печатает)
+INLINE_CACHE_TIME_SECONDS = 300  # Сколько Telegram хранит ответ на встроенный запрос
+
+# Cache Configuration
+FILE_ID_CACHE_DB = os.path.join(CACHE_DIR, 'file_ids.sqlite3')  # Кэш file_id отправленных треков
+SEARCH_CACHE_TTL_SECONDS = 900  # Сколько хранить результаты поиска
+SEARCH_CACHE_MAX_ENTRIES = 1000  # Максимум запросов в кэше поиска
+SEARCH_CACHE_DB = None  # Путь к SQLite для кэша поиска на диске (None - только в памяти)
+SESSION_TTL_SECONDS = 6 * 3600  # Сколько хранить результаты поиска пользователя для кнопок
+SESSION_MAX_ENTRIES = 10000  # Максимум пользователей с сохраненными результатами поиска
+AUDIO_CACHE_DIR = os.path.join(DOWNLOADS_DIR, 'cache')  # Общий кэш скачанных треков
+AUDIO_CACHE_MAX_MB = 1024  # Бюджет кэша скачанных треков в MB
+
+# State Configuration
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')  # Хранилище состояния: 'memory' (один процесс) или 'sqlite' (общее для нескольких процессов)
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(CACHE_DIR, 'state.sqlite3'))  # SQLite с общим состоянием процессов
+DOWNLOAD_LOCK_TTL_SECONDS = DOWNLOAD_TIMEOUT_SECONDS + 60  # Через сколько блокировка скачивания упавшего процесса считается устаревшей
+DOWNLOAD_LOCK_POLL_SECONDS = 1.0  # Как часто проверять, докачал ли трек другой процесс
+BATCH_POLL_SECONDS = 2.0  # Как часто пакетное скачивание проверяет отмену из другого процесса
+BATCH_STALE_SECONDS = 60  # Через сколько пакет упавшего процесса перестает считаться идущим
+AUDIO_CACHE_PIN_TTL_SECONDS = 3600  # Через сколько защита файла кэша от вытеснения упавшим процессом перестает действовать
 
 # Telegram limits
 MAX_FILE_SIZE_MB = 50  # Telegram file size limit
+MEDIA_GROUP_MAX_ITEMS = 10  # Максимум файлов в одной медиагруппе
 
 # Supported formats
 SUPPORTED_FORMATS = ['mp3', 'wav', 'flac', 'm4a']
+TELEGRAM_AUDIO_EXTS = ['mp3', 'm4a']  # Форматы, которые Telegram воспроизводит без перекодирования (в порядке предпочтения)
+FORMAT_SIZE_MARGIN = 1.05  # Запас к оценке размера по битрейту и длительности (заголовки, контейнер)
+FFMPEG_TIMEOUT_SECONDS = 120  # Таймаут перепаковки или перекодирования ffmpeg
+FFMPEG_CONCURRENCY = 1  # Сколько процессов ffmpeg работает одновременно (на процесс бота)
+TRANSCODE_BITRATE_KBPS = 128  # Битрейт MP3 при перекодировании форматов, которые Telegram не воспроизводит
 
 # yt-dlp options for SoundCloud
 YTDL_OPTIONS = {
     'format': 'bestaudio/best',
-    'extractaudio': True,
-    'audioformat': 'mp3',
     'outtmpl': f'{DOWNLOADS_DIR}/%(title)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
@@ -31,4 +130,5 @@ YTDL_OPTIONS = {
     'logtostderr': False,
     'quiet': True,
     'no_warnings': True,
+    'noprogress': True,
 }
@@ -0,0 +1,240 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from collections import defaultdict
+from typing import Optional, Dict, List, Tuple, Callable
+from metrics import DISK_RECLAIMED_BYTES, timed, count_error
+
+logger = logging.getLogger(__name__)
+
+# Недокачанные файлы yt-dlp и незавершенная запись в кэш
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.tmp')
+PARTIAL_FRAGMENT = '.part-Frag'  # Фрагменты HLS/DASH: <файл>.part-Frag<N>
+
+
+class DiskQuotaExceeded(Exception):
+    """Места на диске не хватает даже после уборки"""
+
+
+def is_partial(name: str) -> bool:
+    return name.endswith(PARTIAL_SUFFIXES) or PARTIAL_FRAGMENT in name
+
+
+class DiskJanitor:
+    """Уборка downloads/ и temp/ и лимит занятого ими места.
+
+    Фоновая задача раз в interval секунд (или раньше по request_sweep()) в
+    отдельном потоке обходит папки roots и удаляет:
+    - недокачанные файлы (.part, .ytdl, .tmp), в которые давно не писали;
+    - файлы в папках пользователей и temp/, которые так и не попали в кэш
+      (например, после падения между скачиванием и переносом в кэш);
+    - опустевшие папки пользователей.
+    Файлы кэшей аудио (caches) не трогаются, кроме недописанных: ими управляют
+    сами кэши. Если занятое место вместе с запасом reserve_bytes на каждое из
+    slots скачиваний превышает quota_bytes, давно не использовавшиеся файлы
+    вытесняются из кэшей. Занятое место между обходами досчитывается по
+    изменению размера кэшей. После каждой уборки вызываются слушатели
+    (планировщик скачиваний запускает отложенные задачи).
+    """
+
+    def __init__(self, roots: List[str], caches: List, quota_bytes: Optional[int], reserve_bytes: int, slots: int,
+                 interval: float, partial_max_age: float, orphan_max_age: float):
+        self.roots = list(roots)
+        self.caches = list(caches)  # Порядок вытеснения при нехватке места
+        self.quota_bytes = quota_bytes
+        self.reserve_bytes = reserve_bytes
+        self.slots = slots
+        self.interval = interval
+        self.partial_max_age = partial_max_age
+        self.orphan_max_age = orphan_max_age
+        self._measured: Optional[int] = None  # Занятое место при последнем обходе
+        self._baseline: List[int] = []  # Размеры кэшей на момент обхода
+        self.reclaimed: Dict[str, int] = defaultdict(int)  # Освобождено байт по причинам
+        self.removed_files = 0
+        self._listeners: List[Callable[[], None]] = []
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sweeping: Optional[asyncio.Task] = None
+
+    def add_cache(self, cache):
+        """Добавляет кэш, файлы которого вытесняются раньше остальных (например, черновую папку упреждающих скачиваний)"""
+        self.caches.insert(0, cache)
+        if self._measured is not None:
+            self._baseline.insert(0, cache.total_bytes)
+
+    def add_listener(self, listener: Callable[[], None]):
+        """listener вызывается после каждой уборки"""
+        self._listeners.append(listener)
+
+    @property
+    def usage_bytes(self) -> Optional[int]:
+        """Занятое место (None до первого обхода)"""
+        if self._measured is None:
+            return None
+        return self._measured + sum(cache.total_bytes - size for cache, size in zip(self.caches, self._baseline))
+
+    def has_room(self, active: int = 0) -> bool:
+        """Хватит ли места еще на одно скачивание, когда идут active скачиваний"""
+        usage = self.usage_bytes
+        if self.quota_bytes is None or usage is None:
+            return True
+        return usage + (active + 1) * self.reserve_bytes <= self.quota_bytes
+
+    def start(self):
+        """Запускает фоновую уборку (первая - сразу)"""
+        if self._task is None:
+            # Пустой контекст: уборка не попадает в разбивку запроса
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    def request_sweep(self):
+        """Просит провести уборку, не дожидаясь интервала"""
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self.sweep()
+            # Просьбы во время уборки (в том числе от слушателей) она уже учла
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def sweep(self):
+        """Убирает брошенные файлы и пересчитывает место (одновременные вызовы ждут одну уборку)"""
+        if self._sweeping is None or self._sweeping.done():
+            self._sweeping = asyncio.create_task(self._sweep(), context=contextvars.Context())
+        await asyncio.shield(self._sweeping)
+
+    async def _sweep(self):
+        baseline = [cache.total_bytes for cache in self.caches]
+        try:
+            with timed('disk', 'sweep'):
+                usage, removed, reclaimed = await asyncio.get_running_loop().run_in_executor(None, self._sweep_files)
+        except Exception as e:
+            logger.error(f"Ошибка уборки диска: {e}")
+            count_error('disk', e)
+            return
+
+        self._measured, self._baseline = usage, baseline
+        evicted = self._trim()
+        if evicted:
+            reclaimed['evicted'] = evicted
+        for reason, size in reclaimed.items():
+            self.reclaimed[reason] += size
+            DISK_RECLAIMED_BYTES.inc(size, reason=reason)
+        self.removed_files += removed
+
+        usage_text = f"занято {self.usage_bytes / 1024 / 1024:.1f}MB"
+        if self.quota_bytes is not None:
+            usage_text += f" из {self.quota_bytes / 1024 / 1024:.0f}MB"
+        if reclaimed:
+            details = ', '.join(f"{reason}={size / 1024 / 1024:.1f}MB" for reason, size in reclaimed.items())
+            logger.info(
+                f"Уборка диска: удалено {removed} файлов, освобождено "
+                f"{sum(reclaimed.values()) / 1024 / 1024:.1f}MB ({details}), {usage_text}"
+            )
+        else:
+            logger.debug(f"Уборка диска: {usage_text}")
+        if not self.has_room():
+            logger.warning(f"Место на диске заканчивается: {usage_text}, новые скачивания откладываются")
+
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.warning(f"Ошибка слушателя уборки диска: {e}")
+
+    def _trim(self) -> int:
+        """Вытесняет файлы из кэшей, пока занятое место с запасом на скачивания не уложится в лимит"""
+        if self.quota_bytes is None:
+            return 0
+        excess = self.usage_bytes + self.slots * self.reserve_bytes - self.quota_bytes
+        freed = 0
+        for cache in self.caches:
+            if freed >= excess:
+                break
+            freed += cache.trim(cache.total_bytes - (excess - freed))
+        return freed
+
+    def _sweep_files(self) -> Tuple[int, int, Dict[str, int]]:
+        """Обходит папки и удаляет брошенные файлы (выполняется в потоке).
+        Возвращает занятое место, число удаленных файлов и освобожденные байты по причинам"""
+        now = time.time()
+        cache_dirs = {os.path.abspath(cache.cache_dir) for cache in self.caches}
+        usage, removed = 0, 0
+        reclaimed: Dict[str, int] = defaultdict(int)
+
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            # Снизу вверх: папка проверяется на пустоту после своих файлов
+            for dirpath, _, filenames in os.walk(root, topdown=False):
+                managed = os.path.abspath(dirpath) in cache_dirs
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue  # Файл уже удален или перенесен
+                    reason = self._stale_reason(name, self._age(stat, now), managed)
+                    if reason and self._remove(path):
+                        reclaimed[reason] += stat.st_size
+                        removed += 1
+                    else:
+                        usage += stat.st_size
+
+                if dirpath != root and not managed:
+                    self._remove_empty_dir(dirpath, now)
+
+        return usage, removed, dict(reclaimed)
+
+    @staticmethod
+    def _age(stat: os.stat_result, now: float) -> float:
+        # yt-dlp выставляет файлу время изменения с сервера, поэтому учитывается и ctime (время переименования)
+        return now - max(stat.st_mtime, stat.st_ctime)
+
+    def _stale_reason(self, name: str, age: float, managed: bool) -> Optional[str]:
+        """Почему файл пора удалить (None - не пора)"""
+        if is_partial(name):
+            return 'partial' if age >= self.partial_max_age else None
+        if not managed and age >= self.orphan_max_age:
+            return 'orphan'
+        return None
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.error(f"Ошибка удаления файла {path}: {e}")
+            return False
+
+    def _remove_empty_dir(self, path: str, now: float):
+        try:
+            if not os.listdir(path) and self._age(os.stat(path), now) >= self.orphan_max_age:
+                # Скачивание в эту папку создаст ее заново
+                os.rmdir(path)
+        except OSError:
+            pass  # Папка не пуста или уже удалена
+
+    def stats(self) -> Dict:
+        """Занятое место и итоги уборки"""
+        return {
+            'usage_bytes': self.usage_bytes,
+            'quota_bytes': self.quota_bytes,
+            'reclaimed_bytes': dict(self.reclaimed),
+            'removed_files': self.removed_files,
+        }
+
+    def close(self):
+        """Останавливает фоновую уборку"""
+        for task in (self._task, self._sweeping):
+            if task is not None:
+                task.cancel()
+        self._task = None
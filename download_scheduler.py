@@ -0,0 +1,288 @@
+import time
+import asyncio
+import bisect
+import itertools
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Callable, Awaitable
+from file_id_cache import canonical_track_key
+from disk_janitor import DiskQuotaExceeded
+from metrics import DISK_QUOTA_EVENTS, timed, observe_stage
+
+logger = logging.getLogger(__name__)
+
+PositionCallback = Callable[[int], Awaitable[None]]
+ProgressCallback = Callable[[int], None]
+
+
+class DownloadJob:
+    """Задача скачивания одного трека, общая для всех ожидающих пользователей"""
+    __slots__ = ('key', 'url', 'user_id', 'priority', 'seq', 'future', 'refs',
+                 'position', 'position_callbacks', 'progress_callbacks', 'progress', 'started',
+                 'enqueued_at', 'context', 'user_limit')
+
+    def __init__(self, key: str, url: str, user_id: int, priority: int, seq: int, user_limit: Optional[int] = None):
+        self.key = key
+        self.url = url
+        self.user_id = user_id  # Пользователь, в чью папку скачивается трек
+        self.user_limit = user_limit  # Свой лимит одновременных скачиваний пользователя (например, для пакета)
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+        self.refs = 0
+        self.position = 0
+        self.position_callbacks: List[PositionCallback] = []
+        self.progress_callbacks: List[ProgressCallback] = []
+        self.progress = 0
+        self.started = False
+        self.enqueued_at = time.perf_counter()
+        # Контекст создавшего задачу запроса: этапы скачивания попадут в его разбивку
+        self.context = contextvars.copy_context()
+
+    def __lt__(self, other: 'DownloadJob') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class DownloadScheduler:
+    """Планировщик скачиваний перед SoundCloudDownloader.
+
+    - ограничивает общее число скачиваний и число скачиваний одного пользователя;
+    - держит очередь с приоритетами (меньше значение - раньше), внутри приоритета FIFO;
+    - объединяет одновременные запросы одного трека в одно скачивание;
+    - отдает уже скачанные треки из общего кэша аудио;
+    - с общими блокировками (locks) не скачивает трек, который уже качает
+      другой процесс бота, а ждет его файл в кэше;
+    - с уборкой диска (disk) откладывает скачивания, пока места мало, и
+      отклоняет их, если места не хватает даже без идущих скачиваний.
+    """
+
+    def __init__(self, downloader, cache, max_concurrent: int, max_per_user: int,
+                 locks=None, lock_poll_interval: float = 1.0, disk=None):
+        self.downloader = downloader
+        self.cache = cache
+        self.disk = disk
+        if disk is not None:
+            disk.add_listener(self._on_disk_swept)
+        self.locks = locks
+        self.lock_poll_interval = lock_poll_interval
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self._inflight: Dict[str, DownloadJob] = {}
+        self._pending: List[DownloadJob] = []
+        self._active = 0
+        self._user_active: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self.deduplicated = 0
+
+    @property
+    def queue_size(self) -> int:
+        """Количество задач, ожидающих в очереди"""
+        return len(self._pending)
+
+    @property
+    def active_downloads(self) -> int:
+        """Количество выполняющихся скачиваний"""
+        return self._active
+
+    def has_disk_room(self) -> bool:
+        """Хватит ли места на диске еще на одно скачивание"""
+        return self.disk is None or self.disk.has_room(self._active)
+
+    @asynccontextmanager
+    async def lease(self, url: str, user_id: int, priority: int = 0,
+                    on_position: Optional[PositionCallback] = None,
+                    on_progress: Optional[ProgressCallback] = None,
+                    user_limit: Optional[int] = None):
+        """Скачивает трек (или присоединяется к уже идущему скачиванию) и отдает путь к файлу.
+
+        on_position получает позицию в очереди, on_progress - процент скачивания,
+        user_limit заменяет max_per_user для этого скачивания.
+        Пока файл используется, он не вытесняется из кэша аудио.
+        Если места на диске не хватает даже после уборки и без идущих скачиваний - DiskQuotaExceeded.
+        """
+        key = canonical_track_key(url)
+        cached_path = self.cache.acquire(key)
+        if cached_path:
+            try:
+                yield cached_path
+            finally:
+                self.cache.release(key)
+            return
+
+        if key not in self._inflight and self.disk is not None and not self.disk.has_room():
+            await self.disk.sweep()
+            if not self.disk.has_room() and not self._active:
+                DISK_QUOTA_EVENTS.inc(event='refused')
+                raise DiskQuotaExceeded("Недостаточно места на диске")
+
+        job = self._inflight.get(key)
+        if job is None:
+            if not self.has_disk_room():
+                DISK_QUOTA_EVENTS.inc(event='queued')
+            job = DownloadJob(key, url, user_id, priority, next(self._seq), user_limit)
+            self._inflight[key] = job
+            bisect.insort(self._pending, job)
+        else:
+            self.deduplicated += 1
+            logger.info(f"Трек {key} уже скачивается, пользователь {user_id} ждет общий результат")
+            if not job.started and priority < job.priority:
+                # Поднимаем приоритет общей задачи
+                self._pending.remove(job)
+                job.priority = priority
+                bisect.insort(self._pending, job)
+
+        job.refs += 1
+        if on_position:
+            job.position_callbacks.append(on_position)
+        if on_progress:
+            job.progress_callbacks.append(on_progress)
+            if job.progress:
+                # Присоединились к уже идущему скачиванию
+                on_progress(job.progress)
+
+        try:
+            self._pump()
+            file_path = await asyncio.shield(job.future)
+            yield file_path
+        finally:
+            job.refs -= 1
+            if on_position in job.position_callbacks:
+                job.position_callbacks.remove(on_position)
+            if on_progress in job.progress_callbacks:
+                job.progress_callbacks.remove(on_progress)
+            if job.refs == 0:
+                if not job.started:
+                    # Все отказались до начала скачивания
+                    self._pending.remove(job)
+                    self._inflight.pop(key, None)
+                    job.future.cancel()
+                    self._pump()
+                elif job.future.done():
+                    self._discard(job)
+
+    def _pump(self):
+        """Запускает задачи из очереди, пока есть свободные слоты"""
+        for job in list(self._pending):
+            if self._active >= self.max_concurrent:
+                break
+            if not self.has_disk_room():
+                # Места мало: задачи ждут, пока уборка его освободит или закончатся идущие скачивания
+                self.disk.request_sweep()
+                break
+            if self._user_active.get(job.user_id, 0) >= (job.user_limit or self.max_per_user):
+                continue
+            self._pending.remove(job)
+            job.started = True
+            self._active += 1
+            self._user_active[job.user_id] = self._user_active.get(job.user_id, 0) + 1
+            asyncio.create_task(self._run(job), context=job.context)
+
+        self._notify_positions()
+
+    def _on_disk_swept(self):
+        """После уборки диска запускает отложенные задачи или отклоняет их, если места нет совсем"""
+        if not self.disk.has_room() and not self._active:
+            # Места не хватает даже без идущих скачиваний - ожидающие его не дождутся
+            for job in list(self._pending):
+                self._pending.remove(job)
+                self._inflight.pop(job.key, None)
+                # Как у завершенной задачи: ожидающие получат исключение и удалят ее
+                job.started = True
+                job.future.set_exception(DiskQuotaExceeded("Недостаточно места на диске"))
+                job.future.exception()
+                DISK_QUOTA_EVENTS.inc(event='refused')
+        self._pump()
+
+    def _notify_positions(self):
+        """Сообщает ожидающим пользователям их позицию в очереди"""
+        for position, job in enumerate(self._pending, start=1):
+            if job.position == position:
+                continue
+            job.position = position
+            for callback in job.position_callbacks:
+                asyncio.create_task(self._call_position_callback(callback, position))
+
+    @staticmethod
+    async def _call_position_callback(callback: PositionCallback, position: int):
+        try:
+            await callback(position)
+        except Exception as e:
+            logger.warning(f"Ошибка уведомления о позиции в очереди: {e}")
+
+    @staticmethod
+    def _broadcast_progress(job: DownloadJob, percentage: int):
+        """Передает процент скачивания всем ожидающим трек"""
+        job.progress = percentage
+        for callback in list(job.progress_callbacks):
+            try:
+                callback(percentage)
+            except Exception as e:
+                logger.warning(f"Ошибка уведомления о прогрессе скачивания: {e}")
+
+    async def _run(self, job: DownloadJob):
+        """Выполняет скачивание и раздает результат всем ожидающим"""
+        observe_stage('download', 'queue', time.perf_counter() - job.enqueued_at)
+        locked = False
+        try:
+            file_path = await self._wait_for_other_worker(job)
+            locked = file_path is None
+            if locked:
+                file_path = await self.downloader.download_track(
+                    job.url, job.user_id,
+                    progress_callback=lambda percentage: self._broadcast_progress(job, percentage)
+                )
+                if file_path:
+                    # Переносим файл в общий кэш; он защищен от вытеснения, пока задача жива
+                    downloaded_path = file_path
+                    try:
+                        with timed('download', 'cache_put'):
+                            file_path = self.cache.put(job.key, downloaded_path)
+                    finally:
+                        self.downloader.release_download(downloaded_path)
+            job.future.set_result(file_path)
+        except Exception as e:
+            job.future.set_exception(e)
+            # Исключение получат ожидающие; если их нет - не логируем как "never retrieved"
+            job.future.exception()
+        finally:
+            if locked and self.locks:
+                self.locks.release(job.key)
+            self._active -= 1
+            self._user_active[job.user_id] -= 1
+            if self._user_active[job.user_id] == 0:
+                del self._user_active[job.user_id]
+            if job.refs == 0:
+                self._discard(job)
+            self._pump()
+
+    async def _wait_for_other_worker(self, job: DownloadJob) -> Optional[str]:
+        """Берет общую блокировку трека. Если трек качает другой процесс, ждет его
+        и возвращает путь из кэша (None - блокировка взята, качаем сами)"""
+        if self.locks is None:
+            return None
+
+        waited = False
+        while not self.locks.acquire(job.key):
+            if not waited:
+                waited = True
+                logger.info(f"Трек {job.key} скачивает другой процесс бота, ждем")
+            await asyncio.sleep(self.lock_poll_interval)
+
+        if waited:
+            file_path = self.cache.acquire(job.key)
+            if file_path:
+                self.locks.release(job.key)
+                self.deduplicated += 1
+                return file_path
+        return None
+
+    def _discard(self, job: DownloadJob):
+        """Удаляет завершенную задачу и снимает защиту ее файла в кэше"""
+        if self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+        if job.future.cancelled() or job.future.exception():
+            return
+        if job.future.result():
+            self.cache.release(job.key)
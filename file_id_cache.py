@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import time
+import logging
+import threading
+from typing import Optional, Dict
+from urllib.parse import urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_track_key(url: str) -> str:
+    """Приводит ссылку на трек к каноническому виду для ключа кэша"""
+    if not url:
+        return ''
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path.rstrip('/') or '/'
+    # Для YouTube идентификатор трека хранится в параметре v
+    query = ''
+    if host in ('youtube.com', 'music.youtube.com') and parts.query:
+        for param in parts.query.split('&'):
+            if param.startswith('v='):
+                query = param
+                break
+    return urlunsplit(('https', host, path, query, ''))
+
+
+# Ответы Telegram, которыми он отклоняет сам file_id (без учета регистра)
+FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'file reference expired',
+    'wrong type of file',
+)
+
+
+def is_file_id_error(error: Exception) -> bool:
+    """Telegram отклонил сам file_id (FILE_ID_ERRORS), а не запрос по другой причине
+    (файл слишком большой, чат не найден, ошибка в подписи и т.п.)"""
+    message = str(error).lower()
+    return any(fragment in message for fragment in FILE_ID_ERRORS)
+
+
+class FileIdCache:
+    """Постоянный кэш file_id загруженных в Telegram аудиофайлов (SQLite)"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            ' track_key TEXT PRIMARY KEY,'
+            ' file_id TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' last_used_at REAL NOT NULL,'
+            ' uses INTEGER NOT NULL DEFAULT 0'
+            ')'
+        )
+        self._conn.commit()
+
+    def get(self, track_key: str) -> Optional[str]:
+        """Возвращает file_id трека или None"""
+        if not track_key:
+            self.misses += 1
+            return None
+
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT file_id FROM file_ids WHERE track_key = ?', (track_key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                'UPDATE file_ids SET last_used_at = ?, uses = uses + 1 WHERE track_key = ?',
+                (time.time(), track_key)
+            )
+            self._conn.commit()
+
+        self.hits += 1
+        return row[0]
+
+    def set(self, track_key: str, file_id: str):
+        """Сохраняет file_id трека"""
+        if not track_key or not file_id:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO file_ids (track_key, file_id, created_at, last_used_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(track_key) DO UPDATE SET file_id = excluded.file_id, last_used_at = excluded.last_used_at',
+                (track_key, file_id, now, now)
+            )
+            self._conn.commit()
+
+    def invalidate(self, track_key: str):
+        """Удаляет устаревший file_id (например, если Telegram его отклонил)"""
+        with self._lock:
+            self._conn.execute('DELETE FROM file_ids WHERE track_key = ?', (track_key,))
+            self._conn.commit()
+
+        self.invalidations += 1
+        logger.info(f"file_id для {track_key} удален из кэша")
+
+    def stats(self) -> Dict:
+        """Статистика попаданий в кэш"""
+        total = self.hits + self.misses
+        with self._lock:
+            size = self._conn.execute('SELECT COUNT(*) FROM file_ids').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': size,
+        }
+
+    def close(self):
+        """Закрывает соединение с базой"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from typing import Optional, Callable, Awaitable, Tuple
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class MessageEditCoalescer:
+    """Объединяет частые правки одного сообщения.
+
+    Отправляется не больше одной правки за min_interval секунд, промежуточные
+    состояния отбрасываются (уходит только последнее). Состояние - текст и,
+    если нужно, клавиатура. Если Telegram отвечает RetryAfter, следующая правка
+    откладывается на указанное время.
+    """
+
+    def __init__(self, edit: Callable[..., Awaitable[object]], min_interval: float):
+        self._edit = edit
+        self.min_interval = min_interval
+        self._pending: Optional[Tuple[str, Optional[InlineKeyboardMarkup]]] = None
+        self._last_sent: Optional[Tuple[str, Optional[InlineKeyboardMarkup]]] = None
+        self._next_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.edits = 0
+        self.dropped = 0
+
+    def update(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Запоминает новое состояние сообщения; отправка - в фоне"""
+        if self._pending is not None:
+            self.dropped += 1
+        self._pending = (text, reply_markup)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def finish(self, text: Optional[str] = None, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Отправляет последнее состояние и дожидается его доставки"""
+        if text is not None:
+            self.update(text, reply_markup)
+        if self._task is not None:
+            await self._task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._pending is not None:
+            delay = self._next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            state, self._pending = self._pending, None
+            if state == self._last_sent:
+                continue
+            await self._send(state)
+
+    async def _send(self, state: Tuple[str, Optional[InlineKeyboardMarkup]]):
+        loop = asyncio.get_running_loop()
+        text, reply_markup = state
+        try:
+            if reply_markup is None:
+                await self._edit(text)
+            else:
+                await self._edit(text, reply_markup=reply_markup)
+        except RetryAfter as e:
+            # Слишком много запросов - ждем и повторяем, если не появилось более нового состояния
+            logger.warning(f"Telegram просит подождать {e.retry_after} сек. перед правкой сообщения")
+            self._next_at = loop.time() + float(e.retry_after)
+            if self._pending is None:
+                self._pending = state
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                self._last_sent = state
+            else:
+                logger.warning(f"Не удалось обновить сообщение: {e}")
+            self._next_at = loop.time() + self.min_interval
+            return
+        except TelegramError as e:
+            logger.warning(f"Ошибка обновления сообщения: {e}")
+            self._next_at = loop.time() + self.min_interval
+            return
+
+        self._last_sent = state
+        self.edits += 1
+        self._next_at = loop.time() + self.min_interval
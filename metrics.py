@@ -0,0 +1,296 @@
+import math
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple, Callable, Iterable
+from config import SLOW_REQUEST_LOG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности (сек.)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Базовый класс метрики с метками (значения меток передаются именованными аргументами)"""
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получено {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Metric):
+    """Текущее значение; если задан collect, значения читаются в момент выдачи метрик"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> List[str]:
+        if self.collect is not None:
+            try:
+                values = self.collect()
+            except Exception as e:
+                logger.warning(f"Ошибка чтения метрики {self.name}: {e}")
+                values = {}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """Гистограмма длительностей с накопительными корзинами, как в Prometheus"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Метки -> (счетчики корзин, сумма, количество)
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик, отдаваемых в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              collect: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Общий реестр и метрики бота
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'musicbot_stage_seconds', 'Длительность этапов обработки запросов', ('operation', 'stage')
+)
+SEARCH_BACKEND_REQUESTS = REGISTRY.counter(
+    'musicbot_search_backend_requests_total', 'Запросы к бэкендам поиска по результату', ('backend', 'result')
+)
+SEARCH_BACKEND_EVENTS = REGISTRY.counter(
+    'musicbot_search_backend_events_total', 'События бэкендов поиска (отключение, проверка, включение, хеджирование)',
+    ('backend', 'event')
+)
+PREFETCH_EVENTS = REGISTRY.counter(
+    'musicbot_prefetch_events_total', 'События упреждающей загрузки (попадания, промахи, отмены и т.п.)', ('event',)
+)
+DISK_RECLAIMED_BYTES = REGISTRY.counter(
+    'musicbot_disk_reclaimed_bytes_total', 'Место, освобожденное уборкой диска', ('reason',)
+)
+DISK_QUOTA_EVENTS = REGISTRY.counter(
+    'musicbot_disk_quota_events_total', 'Скачивания, отложенные или отклоненные из-за лимита места на диске', ('event',)
+)
+ERRORS = REGISTRY.counter(
+    'musicbot_errors_total', 'Ошибки по операциям и классам исключений', ('operation', 'error')
+)
+STARTUP_SECONDS = REGISTRY.gauge(
+    'musicbot_startup_seconds', 'Время от запуска процесса до этапа запуска', ('phase',)
+)
+
+
+class RequestTrace:
+    """Разбивка одного запроса пользователя по этапам (для журнала медленных запросов)"""
+    __slots__ = ('operation', 'user_id', 'started', 'stages')
+
+    def __init__(self, operation: str, user_id):
+        self.operation = operation
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+
+    def add(self, stage: str, seconds: float):
+        self.stages.append((stage, seconds))
+
+    def breakdown(self) -> str:
+        return ', '.join(f"{stage}={seconds:.3f}s" for stage, seconds in self.stages)
+
+
+class StartupTimer:
+    """Этапы запуска бота: сколько секунд прошло от начала запуска до каждого (для журнала и метрик)"""
+
+    def __init__(self, started: float):
+        self.started = started  # time.perf_counter() в начале запуска
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> float:
+        """Отмечает этап (повторные отметки того же этапа не учитываются)"""
+        if phase not in self.phases:
+            self.phases[phase] = time.perf_counter() - self.started
+            STARTUP_SECONDS.set(self.phases[phase], phase=phase)
+        return self.phases[phase]
+
+    def breakdown(self) -> str:
+        return ', '.join(f"{phase}={seconds:.3f}s" for phase, seconds in self.phases.items())
+
+
+# Текущий запрос; задачи asyncio наследуют его при создании
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar('musicbot_trace', default=None)
+
+
+def observe_stage(operation: str, stage: str, seconds: float):
+    """Учитывает длительность этапа: гистограмма STAGE_SECONDS и разбивка текущего запроса"""
+    STAGE_SECONDS.observe(seconds, operation=operation, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(f"{operation}.{stage}", seconds)
+
+
+@contextmanager
+def timed(operation: str, stage: str):
+    """Измеряет этап, выполняемый внутри блока with"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(operation, stage, time.perf_counter() - started)
+
+
+@contextmanager
+def request_trace(operation: str, user_id=None):
+    """Измеряет запрос пользователя целиком и пишет медленные запросы в журнал с разбивкой по этапам"""
+    trace = RequestTrace(operation, user_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        STAGE_SECONDS.observe(elapsed, operation=operation, stage='total')
+        if SLOW_REQUEST_LOG_SECONDS is not None and elapsed >= SLOW_REQUEST_LOG_SECONDS:
+            logger.warning(
+                f"Медленный запрос {operation} пользователя {user_id}: {elapsed:.2f} сек. ({trace.breakdown()})"
+            )
+
+
+def count_error(operation: str, error: BaseException):
+    """Учитывает ошибку операции по классу исключения"""
+    ERRORS.inc(operation=operation, error=type(error).__name__)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Set, Tuple
+from file_id_cache import canonical_track_key
+from audio_cache import AudioCache
+from metrics import PREFETCH_EVENTS
+
+logger = logging.getLogger(__name__)
+
+# Для скольких пользователей помнить заранее загруженные треки (для подсчета попаданий)
+MAX_TRACKED_USERS = 10000
+
+
+class Prefetcher:
+    """Упреждающая загрузка треков, которые пользователь, вероятно, выберет.
+
+    Пока пользователь читает результаты поиска, для первых треков видимой
+    страницы извлекается информация, а при download=True файл скачивается в
+    черновую папку. Бюджеты:
+    - процессор: не больше concurrency треков одновременно и только пока у
+      планировщика скачиваний и пулов yt-dlp нет очереди; появилась работа
+      пользователей - упреждающее скачивание уступает ей;
+    - сеть: общий лимит скорости делится между одновременными скачиваниями;
+    - диск: черновая папка - отдельный кэш аудио со своим бюджетом.
+    Переход на другую страницу или новый поиск отменяют загрузку для прежней.
+    При выборе трека claim() переносит готовый файл в общий кэш аудио и учитывает
+    попадание или промах.
+    """
+
+    def __init__(self, downloader, scheduler, audio_cache: AudioCache, top_n: int, download: bool,
+                 concurrency: int, bandwidth_bytes: int, max_track_bytes: int,
+                 scratch_dir: str, scratch_max_bytes: int, scratch_index=None):
+        self.downloader = downloader
+        self.scheduler = scheduler
+        self.audio_cache = audio_cache
+        self.top_n = top_n
+        self.max_track_bytes = max_track_bytes
+        # Лимит скорости одного скачивания: общий лимит делится между одновременными
+        self.ratelimit = max(1, bandwidth_bytes // max(1, concurrency))
+        self.scratch = AudioCache(
+            scratch_dir, scratch_max_bytes, audio_cache.format_profile, scratch_index
+        ) if download else None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._current: Dict[int, Tuple[str, str]] = {}  # Пользователь -> (трек, этап: 'info' или 'download')
+        self._prefetched: 'OrderedDict[int, Set[str]]' = OrderedDict()  # Заранее загруженные треки пользователя
+        self.events: Dict[str, int] = defaultdict(int)
+        self.downloaded_bytes = 0
+
+    def _count(self, event: str, amount: int = 1):
+        self.events[event] += amount
+        PREFETCH_EVENTS.inc(amount, event=event)
+
+    def busy(self) -> bool:
+        """Ждет ли работа пользователей свободных ресурсов (тогда упреждающая загрузка не идет)"""
+        if self.scheduler.queue_size or self.scheduler.active_downloads >= self.scheduler.max_concurrent:
+            return True
+        return any(self.downloader.queue_depths().values())
+
+    def schedule(self, user_id: int, tracks: List[Dict]):
+        """Запускает загрузку первых треков страницы, отменяя прежнюю загрузку пользователя"""
+        self.cancel(user_id)
+        known = self._prefetched.get(user_id, set())
+        tracks = [track for track in tracks[:self.top_n] if canonical_track_key(track['url']) not in known]
+        if not tracks:
+            return
+
+        self._count('scheduled', len(tracks))
+        # Пустой контекст: загрузка не попадает в разбивку запроса, который ее запустил
+        task = asyncio.create_task(self._prefetch(user_id, tracks), context=contextvars.Context())
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._tasks.get(user_id) is task and self._tasks.pop(user_id))
+
+    def cancel(self, user_id: int, forget: bool = False):
+        """Отменяет загрузку пользователя (forget - забыть и уже загруженные, например при новом поиске)"""
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        if forget:
+            self._prefetched.pop(user_id, None)
+
+    async def _prefetch(self, user_id: int, tracks: List[Dict]):
+        for index, track in enumerate(tracks):
+            key = canonical_track_key(track['url'])
+            async with self._semaphore:
+                if self.busy():
+                    self._count('skipped', len(tracks) - index)
+                    logger.debug(f"Упреждающая загрузка для пользователя {user_id} пропущена: бот занят")
+                    return
+
+                self._current[user_id] = (key, 'info')
+                try:
+                    completed = await self._prefetch_track(user_id, key, track)
+                except asyncio.CancelledError:
+                    self._count('cancelled')
+                    raise
+                except Exception as e:
+                    self._count('failed')
+                    logger.debug(f"Ошибка упреждающей загрузки {key}: {e}")
+                    continue
+                finally:
+                    self._current.pop(user_id, None)
+
+            if completed:
+                self._remember(user_id, key)
+                self._count('completed')
+
+    async def _prefetch_track(self, user_id: int, key: str, track: Dict) -> bool:
+        """Извлекает информацию о треке и при необходимости скачивает его в черновую папку"""
+        info = await self.downloader.get_track_info(track['url'])
+        if info is None:
+            self._count('failed')
+            return False
+        if self.scratch is None or self.scratch.contains(key) or self.audio_cache.contains(key):
+            return True
+        if info['filesize'] > self.max_track_bytes:
+            self._count('too_large')
+            return True
+        if self.busy() or not self.scheduler.has_disk_room():
+            return True
+
+        self._current[user_id] = (key, 'download')
+        yielded = []
+
+        def yield_to_users(percentage: int):
+            # Появилась работа пользователей - уступаем ей поток скачивания
+            if not yielded and self.busy():
+                yielded.append(True)
+                download.cancel()
+
+        download = asyncio.ensure_future(self.downloader.download_track(
+            track['url'], f"prefetch_{user_id}", progress_callback=yield_to_users, ratelimit=self.ratelimit
+        ))
+
+        try:
+            file_path = await download
+        except asyncio.CancelledError:
+            if not yielded:
+                raise
+            self._count('yielded')
+            return True
+
+        if file_path:
+            try:
+                self.scratch.put(key, file_path)
+            finally:
+                self.downloader.release_download(file_path)
+            self.scratch.release(key)
+            self.downloaded_bytes += info['filesize']
+        return True
+
+    def _remember(self, user_id: int, key: str):
+        keys = self._prefetched.get(user_id)
+        if keys is None:
+            keys = self._prefetched[user_id] = set()
+        keys.add(key)
+        self._prefetched.move_to_end(user_id)
+        while len(self._prefetched) > MAX_TRACKED_USERS:
+            self._prefetched.popitem(last=False)
+
+    def claim(self, user_id: int, url: str) -> bool:
+        """Пользователь выбрал трек: отдает заранее скачанный файл в общий кэш аудио
+        и учитывает попадание (True) или промах"""
+        key = canonical_track_key(url)
+        current = self._current.get(user_id)
+        if current == (key, 'download'):
+            # Упреждающее скачивание ограничено по скорости - обычное пойдет быстрее
+            self.cancel(user_id)
+        # Информация, которая извлекается сейчас, дождется скачивание
+        hit = current == (key, 'info') or key in self._prefetched.get(user_id, ())
+
+        if self.scratch is not None:
+            file_path = self.scratch.take(key)
+            if file_path:
+                self.audio_cache.put(key, file_path)
+                self.audio_cache.release(key)
+                hit = True
+
+        self._count('hit' if hit else 'miss')
+        logger.info(f"Упреждающая загрузка: {'попадание' if hit else 'промах'} для {key} ({self.stats()})")
+        return hit
+
+    def close(self):
+        """Отменяет все упреждающие загрузки"""
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+
+    def stats(self) -> Dict:
+        """Статистика упреждающей загрузки: hit_rate - доля выбранных треков, загруженных заранее,
+        used_rate - доля заранее загруженных треков, которые пригодились"""
+        hits, misses, completed = self.events['hit'], self.events['miss'], self.events['completed']
+        return {
+            'scheduled': self.events['scheduled'],
+            'completed': completed,
+            'hits': hits,
+            'misses': misses,
+            'cancelled': self.events['cancelled'],
+            'yielded': self.events['yielded'],
+            'skipped': self.events['skipped'],
+            'failed': self.events['failed'],
+            'downloaded_bytes': self.downloaded_bytes,
+            'scratch_bytes': self.scratch.total_bytes if self.scratch else 0,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'used_rate': min(1.0, hits / completed) if completed else 0.0,
+        }
@@ -0,0 +1,376 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Deque, Set, Callable
+
+logger = logging.getLogger(__name__)
+
+# Поля информации о треке, которые не нужны боту и только раздувают передачу между процессами
+HEAVY_INFO_KEYS = (
+    'thumbnails', 'description', 'subtitles', 'automatic_captions', 'heatmap',
+    'chapters', 'comments', 'tags', 'categories',
+)
+
+# Сколько ждать, пока отмененная задача скачивания остановится сама, прежде чем убить процесс
+CANCEL_GRACE_SECONDS = 2.0
+
+# Экземпляры YoutubeDL рабочего процесса (по профилю настроек)
+_worker_pools: Dict[str, object] = {}
+
+# Канал рабочего процесса к боту: задачи, прогресс, отмена
+_worker_conn = None
+
+
+class WorkerCrashed(Exception):
+    """Рабочий процесс завершился, не вернув результат (упал или убит)"""
+
+
+def trim_info(info: Optional[Dict]) -> Optional[Dict]:
+    """Готовит информацию yt-dlp к передаче между процессами: только простые типы
+    (HTTPHeaderDict и генераторы не переживают pickle) и без тяжелых полей"""
+    if not info:
+        return info
+    from yt_dlp import YoutubeDL
+    return _drop_heavy_keys(YoutubeDL.sanitize_info(info))
+
+
+def _drop_heavy_keys(info: Dict) -> Dict:
+    trimmed = {key: value for key, value in info.items() if key not in HEAVY_INFO_KEYS}
+    if trimmed.get('entries') is not None:
+        trimmed['entries'] = [_drop_heavy_keys(entry) for entry in trimmed['entries'] if entry]
+    return trimmed
+
+
+def _worker_pool(profile: str, opts: Dict):
+    """Экземпляр YoutubeDL процесса переиспользуется между задачами до перезапуска процесса"""
+    from ytdl_pool import YoutubeDLPool
+    pool = _worker_pools.get(profile)
+    if pool is None:
+        pool = _worker_pools[profile] = YoutubeDLPool(profile, opts, 1)
+    return pool
+
+
+def _worker_extract(profile: str, opts: Dict, url: str) -> Optional[Dict]:
+    """Извлечение информации (выполняется в рабочем процессе)"""
+    with _worker_pool(profile, opts).lease() as ydl:
+        return trim_info(ydl.extract_info(url, download=False))
+
+
+def _report_progress(percentage: int):
+    """Передает процент скачивания боту (вызывается в рабочем процессе)"""
+    _worker_conn.send(('progress', percentage))
+
+
+def _cancel_requested() -> bool:
+    """Просил ли бот отменить текущую задачу (вызывается в рабочем процессе)"""
+    cancelled = False
+    while _worker_conn.poll():
+        if _worker_conn.recv()[0] == 'cancel':
+            cancelled = True
+    return cancelled
+
+
+def _worker_download(opts: Dict, url: str, info: Optional[Dict], user_dir: str,
+                     ratelimit: Optional[int] = None) -> Optional[str]:
+    """Скачивание трека (выполняется в рабочем процессе); прогресс уходит боту"""
+    import yt_dlp
+    from soundcloud_downloader import SoundCloudDownloader
+
+    last_percentage = [-1]
+
+    def hook(d: Dict):
+        if _cancel_requested():
+            raise yt_dlp.utils.DownloadCancelled("Скачивание отменено")
+
+        percentage = SoundCloudDownloader._progress_percentage(d)
+        if percentage is not None and percentage != last_percentage[0]:
+            last_percentage[0] = percentage
+            _report_progress(percentage)
+
+    outtmpl = os.path.join(user_dir, '%(title)s.%(ext)s')
+    with _worker_pool('download', opts).lease(outtmpl=outtmpl, progress_hook=hook, ratelimit=ratelimit) as ydl:
+        return SoundCloudDownloader._extract_and_download(ydl, url, info, user_dir)
+
+
+def _worker_main(conn):
+    """Цикл рабочего процесса: выполняет задачи по одной, пока бот не закроет канал"""
+    global _worker_conn
+    _worker_conn = conn
+    # Ctrl+C получает бот, он и останавливает процессы
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Импорт заранее: первая задача нового процесса не ждет его
+    import yt_dlp  # noqa: F401
+    import soundcloud_downloader  # noqa: F401
+    conn.send(('ready',))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        if message[0] != 'job':
+            continue  # Отмена задачи, которая уже завершилась
+
+        _, fn, args = message
+        try:
+            conn.send(('result', fn(*args)))
+        except BaseException as e:
+            try:
+                conn.send(('error', e))
+            except Exception:
+                # Исключение не переживает pickle (например, из-за traceback в атрибутах)
+                conn.send(('error', Exception(f"{type(e).__name__}: {e}")))
+
+
+class _Worker:
+    """Рабочий процесс и канал к нему; выполняет одну задачу за раз"""
+
+    def __init__(self, context, name: str):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), name=name, daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.tasks = 0
+
+    def call(self, fn: Callable, args: tuple, on_progress: Optional[Callable[[int], None]] = None,
+             on_start: Optional[Callable[[], None]] = None):
+        """Выполняет задачу и дожидается результата (блокирующий вызов, выполняется в потоке).
+        on_start вызывается, когда новый процесс закончил импорты и получил задачу"""
+        try:
+            if not self.ready:
+                self.conn.recv()  # ('ready',)
+                self.ready = True
+            self.conn.send(('job', fn, args))
+            if on_start:
+                on_start()
+            while True:
+                kind, value = self.conn.recv()
+                if kind == 'progress':
+                    if on_progress:
+                        on_progress(value)
+                elif kind == 'error':
+                    raise value
+                else:
+                    return value
+        except (EOFError, OSError) as e:
+            raise WorkerCrashed(f"Рабочий процесс {self.process.pid} завершился: {e!r}") from None
+
+    def cancel(self):
+        """Просит процесс прервать текущую задачу (ее progress hook проверяет просьбу)"""
+        try:
+            self.conn.send(('cancel',))
+        except OSError:
+            pass
+
+    def stop(self):
+        """Завершает процесс после текущей задачи"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+
+    def kill(self):
+        """Убивает процесс (канал закрывается, когда поток ожидания получит WorkerCrashed)"""
+        try:
+            self.process.kill()
+        except Exception as e:
+            logger.debug(f"Не удалось завершить процесс {self.process.pid}: {e}")
+
+
+class ProcessExtractionBackend:
+    """Выполнение yt-dlp в наборе рабочих процессов.
+
+    Разбор страниц yt-dlp держит GIL; в отдельных процессах он не тормозит
+    event loop бота. Каждый процесс выполняет одну задачу за раз, поэтому
+    задачу, не уложившуюся в таймаут, или упавший процесс можно убрать, не
+    задев остальные: убивается только этот процесс, на его место запускается
+    новый. Отмененное скачивание сначала просят остановиться (progress hook), а
+    если оно не остановилось за CANCEL_GRACE_SECONDS - процесс убивается.
+    Отмененное извлечение дорабатывает в фоне (до своего таймаута). Процессы
+    перезапускаются после max_tasks_per_child задач, чтобы ограничить рост памяти.
+    """
+
+    def __init__(self, name: str, workers: int, max_tasks_per_child: int):
+        self.name = name
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._workers: Set[_Worker] = set()
+        self._idle: Deque[_Worker] = deque(self._spawn() for _ in range(workers))
+        self._waiters: Deque[asyncio.Future] = deque()
+        # Потоки, которые ждут ответа рабочих процессов (по одному на процесс)
+        self._calls = ThreadPoolExecutor(workers, thread_name_prefix=f'process-{name}')
+        self._closed = False
+
+    def _spawn(self) -> _Worker:
+        worker = _Worker(self._context, f'ytdl-{self.name}')
+        self._workers.add(worker)
+        return worker
+
+    def _retire(self, worker: _Worker, kill: bool = False):
+        self._workers.discard(worker)
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+
+    async def _acquire(self) -> _Worker:
+        if self._idle:
+            return self._idle.popleft()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Процесс уже выдан - возвращаем его
+                self._release(waiter.result())
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self, worker: _Worker):
+        """Возвращает исправный процесс в набор (или перезапускает его после max_tasks_per_child задач)"""
+        if self._closed:
+            self._retire(worker)
+            return
+        worker.tasks += 1
+        if worker.tasks >= self.max_tasks_per_child:
+            self._retire(worker)
+            worker = self._spawn()
+        self._hand_over(worker)
+
+    def _replace(self, worker: _Worker, call: asyncio.Future, reason: str):
+        """Убивает процесс (только его задача завершится ошибкой) и запускает новый"""
+        logger.warning(f"Перезапуск процесса {worker.process.pid} пула {self.name}: {reason}")
+        self.restarts += 1
+        self._retire(worker, kill=True)
+
+        def close(future: asyncio.Future):
+            # Поток ожидания получил WorkerCrashed - результат уже никому не нужен
+            if not future.cancelled():
+                future.exception()
+            worker.conn.close()
+
+        call.add_done_callback(close)
+        if not self._closed:
+            self._hand_over(self._spawn())
+
+    def _hand_over(self, worker: _Worker):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(worker)
+                return
+        self._idle.append(worker)
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None,
+                  on_progress: Optional[Callable[[int], None]] = None, wait_on_cancel: bool = False):
+        """Выполняет функцию в свободном процессе с таймаутом.
+
+        on_progress получает прогресс задачи (в event loop). wait_on_cancel - при
+        отмене дождаться, пока задача остановится (или процесс будет убит).
+        """
+        worker = await self._acquire()
+        loop = asyncio.get_running_loop()
+        progress = (lambda value: loop.call_soon_threadsafe(on_progress, value)) if on_progress else None
+        # Таймаут отсчитывается с начала задачи: запуск нового процесса в него не входит
+        started = loop.create_future()
+
+        def start():
+            loop.call_soon_threadsafe(started.set_result, None)
+
+        call = loop.run_in_executor(self._calls, worker.call, fn, args, progress, start)
+        try:
+            await asyncio.wait((started, asyncio.shield(call)), return_when=asyncio.FIRST_COMPLETED)
+            result = await asyncio.wait_for(asyncio.shield(call), timeout)
+        except asyncio.TimeoutError:
+            self._replace(worker, call, f"задача не завершилась за {timeout} сек.")
+            raise
+        except asyncio.CancelledError:
+            worker.cancel()
+            grace = CANCEL_GRACE_SECONDS if wait_on_cancel else timeout
+            finish = asyncio.ensure_future(self._finish_cancelled(worker, call, grace))
+            if wait_on_cancel:
+                await asyncio.shield(finish)
+            raise
+        except WorkerCrashed:
+            self._replace(worker, call, "процесс завершился аварийно")
+            raise
+        except Exception:
+            # Ошибка самой задачи - процесс исправен
+            self._release(worker)
+            raise
+        self._release(worker)
+        return result
+
+    async def _finish_cancelled(self, worker: _Worker, call: asyncio.Future, timeout: Optional[float]):
+        """Дожидается отмененной задачи; не завершилась за timeout - убивает процесс"""
+        try:
+            await asyncio.wait_for(asyncio.shield(call), timeout)
+        except asyncio.TimeoutError:
+            self._replace(worker, call, "отмененная задача не остановилась")
+            return
+        except WorkerCrashed:
+            self._replace(worker, call, "процесс завершился аварийно")
+            return
+        except Exception:
+            pass
+        self._release(worker)
+
+    def queue_depth(self) -> int:
+        """Сколько задач ждет свободного процесса"""
+        return len(self._waiters)
+
+    def shutdown(self):
+        self._closed = True
+        idle = set(self._idle)
+        self._idle.clear()
+        for worker in list(self._workers):
+            # Свободные завершаются сами, занятые задачей - убиваются
+            self._retire(worker, kill=worker not in idle)
+        self._calls.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessBackend:
+    """Наборы рабочих процессов для поиска, извлечения информации и скачивания"""
+
+    def __init__(self, search_workers: int, info_workers: int, download_workers: int, max_tasks_per_child: int):
+        self.search = ProcessExtractionBackend('search', search_workers, max_tasks_per_child)
+        self.info = ProcessExtractionBackend('info', info_workers, max_tasks_per_child)
+        self.downloads = ProcessExtractionBackend('download', download_workers, max_tasks_per_child)
+
+    async def extract(self, profile: str, opts: Dict, url: str, timeout: float) -> Optional[Dict]:
+        """Извлекает информацию (profile: 'search' или 'info')"""
+        backend = self.search if profile == 'search' else self.info
+        return await backend.run(_worker_extract, profile, opts, url, timeout=timeout)
+
+    async def download(self, opts: Dict, url: str, info: Optional[Dict], user_dir: str,
+                       progress_callback: Optional[Callable[[int], None]], timeout: float,
+                       ratelimit: Optional[int] = None) -> Optional[str]:
+        """Скачивает трек в рабочем процессе; при отмене возвращается, только когда процесс
+        перестал писать в user_dir"""
+        return await self.downloads.run(
+            _worker_download, opts, url, trim_info(info), user_dir, ratelimit,
+            timeout=timeout, on_progress=progress_callback, wait_on_cancel=True
+        )
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Сколько задач ждет свободного процесса в каждом пуле"""
+        return {
+            'search': self.search.queue_depth(),
+            'info': self.info.queue_depth(),
+            'download': self.downloads.queue_depth(),
+        }
+
+    def shutdown(self):
+        for backend in (self.search, self.info, self.downloads):
+            backend.shutdown()
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """Нормализует поисковый запрос: регистр и лишние пробелы не важны"""
+    return ' '.join(query.lower().split())
+
+
+def _approx_size(obj) -> int:
+    """Приблизительный размер объекта в памяти (с вложенными списками и словарями)"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_approx_size(k) + _approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_approx_size(item) for item in obj)
+    return size
+
+
+class SearchCache:
+    """Кэш результатов поиска с TTL и вытеснением по LRU.
+
+    Ключ - нормализованный запрос и лимит. Если указан disk_path, результаты
+    дополнительно сохраняются в SQLite и переживают перезапуск бота.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, disk_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[str, int], Tuple[float, List[Dict], int]]' = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if disk_path:
+            db_dir = os.path.dirname(disk_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS search_results ('
+                ' query TEXT NOT NULL,'
+                ' result_limit INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' tracks TEXT NOT NULL,'
+                ' PRIMARY KEY (query, result_limit)'
+                ')'
+            )
+            self._db.commit()
+
+    def get(self, query: str, limit: int) -> Optional[List[Dict]]:
+        """Возвращает сохраненные результаты поиска или None"""
+        key = (normalize_query(query), limit)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            self._remove(key)
+
+        tracks = self._disk_get(key)
+        if tracks is not None:
+            self.disk_hits += 1
+            return list(tracks)
+
+        self.misses += 1
+        return None
+
+    def contains(self, query: str, limit: int) -> bool:
+        """Есть ли свежие результаты в памяти (без учета в статистике)"""
+        entry = self._entries.get((normalize_query(query), limit))
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def set(self, query: str, limit: int, tracks: List[Dict]):
+        """Сохраняет результаты поиска"""
+        key = (normalize_query(query), limit)
+        created_at = time.time()
+        self._store(key, created_at, tracks)
+        if self._db is not None:
+            self._disk_set(key, created_at, tracks)
+
+    def _store(self, key: Tuple[str, int], created_at: float, tracks: List[Dict]):
+        """Кладет результаты в память с вытеснением самых старых по использованию"""
+        if key in self._entries:
+            self._remove(key)
+
+        size = _approx_size(tracks)
+        self._entries[key] = (created_at, list(tracks), size)
+        self.memory_bytes += size
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple[str, int]):
+        entry = self._entries.pop(key)
+        self.memory_bytes -= entry[2]
+
+    def _disk_get(self, key: Tuple[str, int]) -> Optional[List[Dict]]:
+        """Ищет результаты в SQLite и переносит их в память"""
+        if self._db is None:
+            return None
+
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT created_at, tracks FROM search_results WHERE query = ? AND result_limit = ?', key
+            ).fetchone()
+        if row is None:
+            return None
+
+        created_at, data = row
+        if time.time() - created_at >= self.ttl:
+            with self._db_lock:
+                self._db.execute('DELETE FROM search_results WHERE query = ? AND result_limit = ?', key)
+                self._db.commit()
+            return None
+
+        tracks = json.loads(data)
+        self._store(key, created_at, tracks)
+        return tracks
+
+    def _disk_set(self, key: Tuple[str, int], created_at: float, tracks: List[Dict]):
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO search_results (query, result_limit, created_at, tracks) VALUES (?, ?, ?, ?)',
+                    (key[0], key[1], created_at, json.dumps(tracks, ensure_ascii=False))
+                )
+                # Заодно чистим устаревшие записи
+                self._db.execute('DELETE FROM search_results WHERE created_at < ?', (time.time() - self.ttl,))
+                self._db.commit()
+        except Exception as e:
+            logger.warning(f"Ошибка сохранения результатов поиска на диск: {e}")
+
+    def stats(self) -> Dict:
+        """Статистика кэша: попадания, промахи, занимаемая память"""
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'memory_bytes': self.memory_bytes,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+        }
@@ -0,0 +1,136 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple
+
+
+class TrackRecord:
+    """Компактное описание трека: только поля, нужные клавиатуре и скачиванию"""
+    __slots__ = ('title', 'uploader', 'duration', 'url', 'source')
+
+    def __init__(self, title: str, uploader: str, duration, url: str, source: str):
+        self.title = title
+        self.uploader = uploader
+        self.duration = duration
+        self.url = url
+        self.source = sys.intern(source)
+
+    @classmethod
+    def from_dict(cls, track: Dict) -> 'TrackRecord':
+        return cls(
+            track.get('title', 'Unknown'),
+            track.get('uploader', 'Unknown'),
+            track.get('duration') or 0,
+            track['url'],
+            track.get('source', 'Other'),
+        )
+
+    # Доступ как к словарю, чтобы запись можно было передавать туда же, куда и результаты поиска
+    def __getitem__(self, name: str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name: str, default=None):
+        return getattr(self, name, default)
+
+    def approx_size(self) -> int:
+        return (sys.getsizeof(self) + sys.getsizeof(self.title) + sys.getsizeof(self.uploader)
+                + sys.getsizeof(self.url) + sys.getsizeof(self.duration))
+
+
+class SearchSession:
+    """Результаты поиска пользователя"""
+    __slots__ = ('query', 'tracks', 'current_page', 'touched_at', 'size')
+
+    def __init__(self, query: str, tracks: Tuple[TrackRecord, ...]):
+        self.query = query
+        self.tracks = tracks
+        self.current_page = 0
+        self.touched_at = time.monotonic()
+        self.size = (sys.getsizeof(self) + sys.getsizeof(query) + sys.getsizeof(tracks)
+                     + sum(track.approx_size() for track in tracks))
+
+
+class SessionStore:
+    """Хранилище результатов поиска с TTL и ограничением числа пользователей (LRU)"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions: 'OrderedDict[int, SearchSession]' = OrderedDict()
+        self.memory_bytes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, user_id: int) -> Optional[SearchSession]:
+        """Возвращает результаты поиска пользователя (или None, если их нет или они устарели)"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+
+        now = time.monotonic()
+        if now - session.touched_at > self.ttl:
+            self._remove(user_id)
+            self.expired += 1
+            return None
+
+        session.touched_at = now
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def set(self, user_id: int, query: str, tracks: List[Dict]) -> SearchSession:
+        """Сохраняет новые результаты поиска пользователя"""
+        self.pop(user_id)
+        session = SearchSession(query, tuple(TrackRecord.from_dict(track) for track in tracks))
+        self._sessions[user_id] = session
+        self.memory_bytes += session.size
+        self._purge()
+        return session
+
+    def set_page(self, user_id: int, page: int):
+        """Запоминает текущую страницу результатов пользователя"""
+        session = self._sessions.get(user_id)
+        if session is not None:
+            session.current_page = page
+
+    def pop(self, user_id: int) -> Optional[SearchSession]:
+        """Удаляет результаты поиска пользователя"""
+        if user_id not in self._sessions:
+            return None
+        return self._remove(user_id)
+
+    def _remove(self, user_id: int) -> SearchSession:
+        session = self._sessions.pop(user_id)
+        self.memory_bytes -= session.size
+        return session
+
+    def _purge(self):
+        """Удаляет устаревшие записи и самые давние сверх лимита"""
+        now = time.monotonic()
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.touched_at > self.ttl:
+                self._remove(user_id)
+                self.expired += 1
+            elif len(self._sessions) > self.max_entries:
+                self._remove(user_id)
+                self.evicted += 1
+            else:
+                break
+
+    def stats(self) -> Dict:
+        """Статистика хранилища"""
+        return {
+            'sessions': len(self._sessions),
+            'memory_bytes': self.memory_bytes,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
@@ -1,82 +1,558 @@
 import os
+import re
+import time
+import shutil
+import tempfile
 import asyncio
-import yt_dlp
+import threading
+import importlib
+import contextvars
 import logging
-from typing import Optional, Dict, List
-from config import YTDL_OPTIONS, DOWNLOADS_DIR, TEMP_DIR, MAX_DOWNLOAD_SIZE_MB
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple, Callable, AsyncIterator, TYPE_CHECKING
+from urllib.parse import urlsplit, urlunsplit
+from config import (
+    YTDL_OPTIONS, DOWNLOADS_DIR, TEMP_DIR, MAX_DOWNLOAD_SIZE_MB,
+    INFO_CACHE_TTL_SECONDS, INFO_CACHE_MAX_ENTRIES,
+    SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_DB,
+    SEARCH_PARALLEL, SEARCH_BACKEND_TIMEOUT_SECONDS, SEARCH_FLAT, ENRICH_CONCURRENCY,
+    SEARCH_WORKERS, INFO_WORKERS, DOWNLOAD_WORKERS, DOWNLOAD_TIMEOUT_SECONDS, INFO_TIMEOUT_SECONDS,
+    EXTRACTION_BACKEND, PROCESS_MAX_TASKS_PER_CHILD, BATCH_MAX_TRACKS, PLAYLIST_TIMEOUT_SECONDS,
+    SHORT_LINK_TIMEOUT_SECONDS, SHORT_LINK_CACHE_TTL_SECONDS, SHORT_LINK_CACHE_MAX_ENTRIES,
+    SEARCH_HEDGE, SEARCH_PROBE_QUERY
+)
+from file_id_cache import canonical_track_key
+from search_cache import SearchCache
+from ytdl_pool import YoutubeDLPool
+from process_backend import ProcessBackend, WorkerCrashed
+from metrics import timed, observe_stage, count_error, SEARCH_BACKEND_REQUESTS
+from backend_health import BackendHealth
+from audio_formats import select_audio_format, estimate_size, is_playable, convert_for_telegram
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+# yt_dlp (и requests) импортируются при первом использовании: импорт yt_dlp долгий,
+# а бот должен как можно раньше начать принимать обновления (см. start_warm_up)
 
 logger = logging.getLogger(__name__)
 
+# Префикс папки отдельного скачивания внутри папки пользователя
+JOB_DIR_PREFIX = 'job_'
+
+# Ссылка на SoundCloud в тексте сообщения (в том числе короткая on.soundcloud.com)
+SOUNDCLOUD_LINK_RE = re.compile(r'https?://(?:www\.|m\.|on\.)?soundcloud\.com/[^\s<>"]+', re.IGNORECASE)
+SOUNDCLOUD_SHORT_HOST = 'on.soundcloud.com'
+# Разделы профиля и сайта, которые не являются треками: soundcloud.com/<пользователь>/<раздел>
+SOUNDCLOUD_NON_TRACK_PATHS = {
+    'albums', 'comments', 'followers', 'following', 'likes', 'popular-tracks', 'reposts', 'spotlight', 'toptracks', 'tracks'
+}
+SOUNDCLOUD_NON_USER_PATHS = {'charts', 'discover', 'pages', 'search', 'stations', 'stream', 'tags', 'upload', 'you'}
+
+
+def soundcloud_link_kind(url: str) -> Optional[str]:
+    """Тип ссылки на SoundCloud: 'track', 'set' или None (профиль, раздел сайта, другой сайт)"""
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host not in ('soundcloud.com', 'www.soundcloud.com', 'm.soundcloud.com'):
+        return None
+    path = [segment for segment in parts.path.split('/') if segment]
+    if len(path) < 2 or path[0].lower() in SOUNDCLOUD_NON_USER_PATHS:
+        return None
+    if path[1].lower() == 'sets':
+        return 'set' if len(path) >= 3 else None
+    if path[1].lower() in SOUNDCLOUD_NON_TRACK_PATHS:
+        return None
+    return 'track'
+
+# Бэкенды поиска в порядке приоритета: (имя для метрик, шаблон запроса)
+SEARCH_BACKENDS = [
+    ('soundcloud', "scsearch{limit}:{query}"),  # Прямой поиск по SoundCloud
+    ('youtube_soundcloud', "ytsearch{limit}:{query} soundcloud"),  # Поиск через YouTube с упоминанием SoundCloud
+    ('youtube', "ytsearch{limit}:{query}"),  # Общий поиск
+]
+# Приоритет бэкенда при объединении результатов (порядок опроса может отличаться)
+BACKEND_PRIORITY = {backend: index for index, (backend, _) in enumerate(SEARCH_BACKENDS)}
+
 class SoundCloudDownloader:
     def __init__(self):
         self.ytdl_opts = YTDL_OPTIONS.copy()
+        self._info_cache = OrderedDict()  # Полная информация о треках из поиска: ключ -> (время, info)
+        self.search_cache = SearchCache(SEARCH_CACHE_TTL_SECONDS, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_DB)
+        self._resolving: Dict[str, asyncio.Future] = {}  # Треки, информация о которых извлекается сейчас
+        self._short_links = OrderedDict()  # Короткая ссылка -> (время, полная ссылка)
+        # Задержки и ошибки бэкендов поиска: порядок опроса, отключение неисправных, хеджирование
+        self.backend_health = BackendHealth([backend for backend, _ in SEARCH_BACKENDS], self._probe_backend)
+        self._enrich_semaphore = asyncio.Semaphore(ENRICH_CONCURRENCY)
         self._ensure_directories()
+        
+        # Отдельные пулы потоков и экземпляров YoutubeDL для поиска, извлечения информации
+        # и скачивания, чтобы долгие скачивания не задерживали поиск
+        search_opts = {'quiet': True, 'no_warnings': True}
+        if SEARCH_FLAT:
+            # Только метаданные результатов; полная информация извлекается для выбранного трека
+            search_opts['extract_flat'] = 'in_playlist'
+        self.search_pool = YoutubeDLPool('search', search_opts, SEARCH_WORKERS)
+        # Для сетов извлекаются не больше BATCH_MAX_TRACKS треков
+        self.info_pool = YoutubeDLPool('info', {'quiet': True, 'no_warnings': True, 'playlistend': BATCH_MAX_TRACKS}, INFO_WORKERS)
+        self.download_pool = YoutubeDLPool('download', self.ytdl_opts, DOWNLOAD_WORKERS)
+        self.search_executor = ThreadPoolExecutor(SEARCH_WORKERS, thread_name_prefix='ytdl-search')
+        self.info_executor = ThreadPoolExecutor(INFO_WORKERS, thread_name_prefix='ytdl-info')
+        self.download_executor = ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix='ytdl-download')
+        
+        # Опционально yt-dlp выполняется в пуле процессов, чтобы не держать GIL event loop
+        # (пул создается при прогреве: запуск процессов задержал бы старт бота)
+        self.process_backend = None
+        self._warm_up_task: Optional[asyncio.Task] = None
+    
+    def warm_up(self):
+        """Импортирует yt_dlp и заранее создает пул процессов или экземпляры YoutubeDL всех пулов
+        (блокирующий вызов)"""
+        with timed('startup', 'import_yt_dlp'):
+            importlib.import_module('yt_dlp')
+        if EXTRACTION_BACKEND == 'process':
+            # Экземпляры YoutubeDL создаются в рабочих процессах
+            self.process_backend = ProcessBackend(SEARCH_WORKERS, INFO_WORKERS, DOWNLOAD_WORKERS, PROCESS_MAX_TASKS_PER_CHILD)
+            return
+        for pool in (self.search_pool, self.info_pool, self.download_pool):
+            pool.warm()
+    
+    def start_warm_up(self) -> asyncio.Task:
+        """Запускает прогрев в фоне; повторные вызовы возвращают ту же задачу"""
+        if self._warm_up_task is None:
+            loop = asyncio.get_running_loop()
+            # Пустой контекст: прогрев не попадает в разбивку запроса, который его запустил
+            self._warm_up_task = loop.create_task(self._warm_up(), context=contextvars.Context())
+        return self._warm_up_task
+    
+    async def _warm_up(self):
+        with timed('startup', 'warm_up'):
+            await asyncio.get_running_loop().run_in_executor(None, self.warm_up)
+    
+    @property
+    def ready(self) -> bool:
+        """Прогрев завершен"""
+        return self._warm_up_task is not None and self._warm_up_task.done()
+    
+    async def _ensure_backend(self):
+        """В режиме процессов дожидается пула процессов (он создается при прогреве)"""
+        if EXTRACTION_BACKEND == 'process' and self.process_backend is None:
+            with timed('startup', 'warm_up_wait'):
+                await asyncio.shield(self.start_warm_up())
+    
+    def close(self):
+        """Останавливает пулы потоков и процессов, закрывает экземпляры YoutubeDL"""
+        self.backend_health.close()
+        for executor in (self.search_executor, self.info_executor, self.download_executor):
+            executor.shutdown(wait=False, cancel_futures=True)
+        for pool in (self.search_pool, self.info_pool, self.download_pool):
+            pool.close()
+        if self.process_backend:
+            self.process_backend.shutdown()
+    
+    def queue_depths(self) -> Dict[str, int]:
+        """Сколько задач ждет свободного потока (или процесса) в каждом пуле"""
+        if self.process_backend:
+            return self.process_backend.queue_depths()
+        return {
+            'search': self.search_executor._work_queue.qsize(),
+            'info': self.info_executor._work_queue.qsize(),
+            'download': self.download_executor._work_queue.qsize(),
+        }
+    
+    async def _extract(self, profile: str, url: str, timeout: float) -> Optional[Dict]:
+        """Извлечение информации профилем 'search' или 'info' в потоке или в процессе"""
+        pool, executor = {
+            'search': (self.search_pool, self.search_executor),
+            'info': (self.info_pool, self.info_executor),
+        }[profile]
+        await self._ensure_backend()
+        if self.process_backend:
+            return await self.process_backend.extract(profile, pool.opts, url, timeout)
+        return await asyncio.wait_for(
+            asyncio.get_event_loop().run_in_executor(executor, self._pooled_extract, pool, url),
+            timeout
+        )
+    
+    @staticmethod
+    def _pooled_extract(pool: YoutubeDLPool, url: str) -> Optional[Dict]:
+        """Извлечение информации экземпляром YoutubeDL из пула (выполняется в потоке)"""
+        with pool.lease() as ydl:
+            return ydl.extract_info(url, download=False)
     
     def _ensure_directories(self):
         """Создает необходимые директории"""
         os.makedirs(DOWNLOADS_DIR, exist_ok=True)
         os.makedirs(TEMP_DIR, exist_ok=True)
     
-    async def search_tracks(self, query: str, limit: int = 5) -> List[Dict]:
-        """Поиск треков на SoundCloud"""
-        try:
-            # Пробуем несколько вариантов поиска
-            search_queries = [
-                f"scsearch{limit}:{query}",  # Прямой поиск по SoundCloud
-                f"ytsearch{limit}:{query} soundcloud",  # Поиск через YouTube с упоминанием SoundCloud
-                f"ytsearch{limit}:{query}"  # Общий поиск
-            ]
-            
-            tracks = []
-            
-            for search_url in search_queries:
+    def _remember_info(self, info: Dict):
+        """Запоминает полную информацию о треке, чтобы не извлекать ее повторно при скачивании"""
+        key = canonical_track_key(info.get('webpage_url', ''))
+        if not key or not info.get('formats'):
+            return
+        
+        self._info_cache[key] = (time.monotonic(), info)
+        self._info_cache.move_to_end(key)
+        while len(self._info_cache) > INFO_CACHE_MAX_ENTRIES:
+            self._info_cache.popitem(last=False)
+    
+    def _take_info(self, url: str) -> Optional[Dict]:
+        """Достает сохраненную информацию о треке (ссылки на поток живут недолго)"""
+        cached = self._info_cache.pop(canonical_track_key(url), None)
+        if cached and time.monotonic() - cached[0] < INFO_CACHE_TTL_SECONDS:
+            return cached[1]
+        return None
+    
+    async def _resolve_info(self, url: str) -> Optional[Dict]:
+        """Извлекает полную информацию о треке; одновременные запросы одного трека объединяются"""
+        key = canonical_track_key(url)
+        future = self._resolving.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._extract_info(url))
+            self._resolving[key] = future
+            future.add_done_callback(lambda _: self._resolving.pop(key, None))
+        return await asyncio.shield(future)
+    
+    async def _extract_info(self, url: str) -> Optional[Dict]:
+        with timed('info', 'extract'):
+            info = await self._extract('info', url, INFO_TIMEOUT_SECONDS)
+        if info:
+            self._remember_info(info)
+        return info
+    
+    def has_info(self, url: str) -> bool:
+        """Есть ли сохраненная полная информация о треке (скачивание обойдется без извлечения)"""
+        cached = self._info_cache.get(canonical_track_key(url))
+        return cached is not None and time.monotonic() - cached[0] < INFO_CACHE_TTL_SECONDS
+    
+    async def enrich_tracks(self, tracks: List[Dict]):
+        """Фоново извлекает полную информацию о треках (например, видимой страницы результатов),
+        чтобы скачивание выбранного трека началось без извлечения"""
+        async def enrich(track: Dict):
+            if canonical_track_key(track['url']) in self._info_cache:
+                return
+            async with self._enrich_semaphore:
                 try:
-                    logger.info(f"Поиск с запросом: {search_url}")
-                    
-                    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-                        search_results = await asyncio.get_event_loop().run_in_executor(
-                            None, ydl.extract_info, search_url, False
-                        )
-                    
-                    if search_results and 'entries' in search_results:
-                        for entry in search_results['entries']:
-                            if entry and len(tracks) < limit:
-                                # Принимаем треки с SoundCloud или других источников
-                                webpage_url = entry.get('webpage_url', '')
-                                if webpage_url:
-                                    track_info = {
-                                        'title': entry.get('title', 'Unknown'),
-                                        'uploader': entry.get('uploader', 'Unknown'),
-                                        'duration': entry.get('duration', 0),
-                                        'url': webpage_url,
-                                        'id': entry.get('id', ''),
-                                        'thumbnail': entry.get('thumbnail', ''),
-                                        'source': 'SoundCloud' if 'soundcloud.com' in webpage_url else 'Other'
-                                    }
-                                    tracks.append(track_info)
-                    
-                    # Если нашли достаточно треков, прекращаем поиск
-                    if len(tracks) >= limit:
-                        break
-                        
-                except Exception as search_error:
-                    logger.warning(f"Ошибка поиска с запросом {search_url}: {search_error}")
+                    await self._resolve_info(track['url'])
+                except Exception as e:
+                    logger.debug(f"Не удалось получить информацию о треке {track['url']}: {e}")
+        
+        await asyncio.gather(*(enrich(track) for track in tracks))
+    
+    @staticmethod
+    def _estimate_filesize(info: Dict) -> int:
+        """Размер выбранного формата в байтах, для HLS - по битрейту и длительности (0 если неизвестен)"""
+        return estimate_size(info)
+    
+    @staticmethod
+    def _entry_to_track(entry: Dict) -> Optional[Dict]:
+        """Преобразует результат поиска yt-dlp в описание трека"""
+        # Принимаем треки с SoundCloud или других источников.
+        # При плоском поиске ссылка на страницу может быть только в url
+        webpage_url = entry.get('webpage_url') or entry.get('url') or ''
+        if not webpage_url.startswith('http'):
+            return None
+        return {
+            'title': entry.get('title', 'Unknown'),
+            'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown',
+            'duration': entry.get('duration') or 0,
+            'url': webpage_url,
+            'id': entry.get('id', ''),
+            'thumbnail': entry.get('thumbnail', ''),
+            'source': 'SoundCloud' if 'soundcloud.com' in webpage_url else 'Other'
+        }
+    
+    @staticmethod
+    def _title_key(track: Dict) -> str:
+        """Нормализованные название и исполнитель для поиска дублей"""
+        text = f"{track.get('title', '')} {track.get('uploader', '')}".lower()
+        return ' '.join(''.join(ch if ch.isalnum() else ' ' for ch in text).split())
+    
+    def _merge_results(self, results: List[List[Dict]], limit: int) -> List[Dict]:
+        """Объединяет результаты бэкендов в порядке приоритета без дублей"""
+        tracks = []
+        seen = set()
+        for backend_tracks in results:
+            for track in backend_tracks:
+                keys = (canonical_track_key(track['url']), self._title_key(track))
+                if any(key in seen for key in keys):
                     continue
+                seen.update(keys)
+                tracks.append(track)
+                if len(tracks) >= limit:
+                    return tracks
+        return tracks
+    
+    async def _search_backend(self, backend: str, search_url: str, limit: int) -> List[Dict]:
+        """Поиск через один бэкенд yt-dlp (исход и задержка учитываются в состоянии бэкендов)"""
+        logger.info(f"Поиск с запросом: {search_url}")
+        
+        started = time.perf_counter()
+        try:
+            with timed('search', f'backend.{backend}'):
+                search_results = await self._extract('search', search_url, SEARCH_BACKEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            SEARCH_BACKEND_REQUESTS.inc(backend=backend, result='timeout')
+            self.backend_health.record(backend, time.perf_counter() - started, ok=False)
+            raise
+        except asyncio.CancelledError:
+            SEARCH_BACKEND_REQUESTS.inc(backend=backend, result='cancelled')
+            raise
+        except WorkerCrashed as e:
+            # Упал рабочий процесс бота, а не бэкенд - в его состоянии не учитываем
+            SEARCH_BACKEND_REQUESTS.inc(backend=backend, result='error')
+            count_error('search', e)
+            raise
+        except Exception as e:
+            SEARCH_BACKEND_REQUESTS.inc(backend=backend, result='error')
+            self.backend_health.record(backend, time.perf_counter() - started, ok=False)
+            count_error('search', e)
+            raise
+        self.backend_health.record(backend, time.perf_counter() - started, ok=True)
+        
+        tracks = []
+        if search_results and 'entries' in search_results:
+            for entry in search_results['entries']:
+                if entry and len(tracks) < limit:
+                    track_info = self._entry_to_track(entry)
+                    if track_info:
+                        tracks.append(track_info)
+                        self._remember_info(entry)
+        SEARCH_BACKEND_REQUESTS.inc(backend=backend, result='ok' if tracks else 'empty')
+        return tracks
+    
+    async def _probe_backend(self, backend: str):
+        """Пробный запрос к отключенному бэкенду (его исход включает или снова отключает бэкенд)"""
+        template = dict(SEARCH_BACKENDS)[backend]
+        await self._search_backend(backend, template.format(limit=1, query=SEARCH_PROBE_QUERY), 1)
+    
+    async def _search_sequential(self, search_urls: List[Tuple[str, str]], limit: int) -> AsyncIterator[List[Dict]]:
+        """Опрашивает бэкенды по очереди, пока не наберется limit треков; после каждого
+        ответившего бэкенда отдает объединенные результаты.
+
+        Если бэкенд не ответил за свой p95 (SEARCH_HEDGE), следующий запускается,
+        не дожидаясь его: отвечает тот, кто быстрее. Результаты объединяются в
+        порядке приоритета SEARCH_BACKENDS, а не в порядке опроса.
+        """
+        queue = list(search_urls)
+        results: Dict[str, List[Dict]] = {}
+        running: Dict[asyncio.Task, str] = {}
+        last: List[Dict] = []
+        current = None  # Последний запущенный бэкенд
+        hedge_at = None  # Когда запускать следующий бэкенд, не дожидаясь ответа
+        
+        try:
+            while queue or running:
+                if not running or (hedge_at is not None and time.monotonic() >= hedge_at):
+                    if running:
+                        # Текущий бэкенд отвечает дольше обычного - следующий запускается параллельно
+                        self.backend_health.hedged(current)
+                    current, search_url = queue.pop(0)
+                    running[asyncio.create_task(self._search_backend(current, search_url, limit))] = current
+                    hedge_at = time.monotonic() + self.backend_health.hedge_delay(current) if SEARCH_HEDGE and queue else None
+                
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = running.pop(task)
+                    try:
+                        results[backend] = task.result()
+                    except Exception as search_error:
+                        logger.warning(f"Ошибка поиска бэкендом {backend}: {search_error}")
+                        results[backend] = []
+                
+                tracks = self._merge_results(
+                    [results[backend] for backend in sorted(results, key=BACKEND_PRIORITY.get)], limit
+                )
+                if tracks and tracks != last:
+                    last = tracks
+                    yield tracks
+                
+                # Если нашли достаточно треков, прекращаем поиск
+                if len(tracks) >= limit:
+                    return
+                if not running:
+                    # Ответили все запущенные - следующий бэкенд запускается сразу
+                    hedge_at = None
+        finally:
+            for task in running:
+                task.cancel()
+    
+    async def _search_parallel(self, search_urls: List[Tuple[str, str]], limit: int) -> AsyncIterator[List[Dict]]:
+        """Опрашивает все бэкенды одновременно и отдает объединенные результаты по мере ответов.
+
+        Как только бэкенды с наивысшим приоритетом набрали limit треков,
+        остальные запросы отменяются (поток yt-dlp при этом доработает в фоне,
+        но его результат уже не ждем).
+        """
+        tasks = [
+            asyncio.create_task(self._search_backend(backend, search_url, limit))
+            for backend, search_url in search_urls
+        ]
+        results: List[Optional[List[Dict]]] = [None] * len(tasks)
+        pending = set(tasks)
+        last: List[Dict] = []
+        
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    idx = tasks.index(task)
+                    try:
+                        results[idx] = task.result()
+                    except asyncio.TimeoutError:
+                        logger.warning(f"Таймаут поиска с запросом {search_urls[idx][1]}")
+                        results[idx] = []
+                    except Exception as search_error:
+                        logger.warning(f"Ошибка поиска с запросом {search_urls[idx][1]}: {search_error}")
+                        results[idx] = []
+                
+                # Ответившие бэкенды объединяются в порядке приоритета: более приоритетные
+                # результаты, пришедшие позже, встают выше
+                tracks = self._merge_results([r for r in results if r is not None], limit)
+                if tracks and tracks != last:
+                    last = tracks
+                    yield tracks
+                
+                # Готовые бэкенды с наивысшим приоритетом уже дали достаточно треков
+                ready = []
+                for backend_tracks in results:
+                    if backend_tracks is None:
+                        break
+                    ready.append(backend_tracks)
+                if pending and len(self._merge_results(ready, limit)) >= limit:
+                    return
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def search_tracks_iter(self, query: str, limit: int = 5) -> AsyncIterator[List[Dict]]:
+        """Поиск треков на SoundCloud по мере ответов бэкендов.
+
+        Отдает накопленные объединенные результаты после каждого ответившего
+        бэкенда; последний отданный список совпадает с результатом search_tracks.
+        """
+        # Недавние запросы отдаем из кэша
+        with timed('search', 'cache'):
+            cached = self.search_cache.get(query, limit)
+        if cached is not None:
+            logger.info(f"Результаты поиска '{query}' взяты из кэша")
+            yield cached
+            return
+        
+        tracks: List[Dict] = []
+        try:
+            # Пробуем несколько вариантов поиска, пропуская отключенные бэкенды: поочередно - в порядке
+            # по их состоянию, одновременно - в порядке приоритета (по нему объединяются результаты)
+            templates = dict(SEARCH_BACKENDS)
+            backends = self.backend_health.order()
+            if SEARCH_PARALLEL:
+                backends.sort(key=BACKEND_PRIORITY.get)
+            search_urls = [(backend, templates[backend].format(limit=limit, query=query)) for backend in backends]
+            search = self._search_parallel if SEARCH_PARALLEL else self._search_sequential
             
-            logger.info(f"Найдено треков: {len(tracks)}")
-            return tracks[:limit]
+            started = time.perf_counter()
+            with timed('search', 'backends'):
+                async for tracks in search(search_urls, limit):
+                    if started is not None:
+                        observe_stage('search', 'first_result', time.perf_counter() - started)
+                        started = None
+                    yield tracks
             
         except Exception as e:
             logger.error(f"Общая ошибка поиска: {e}")
+            count_error('search', e)
+            return
+        
+        logger.info(f"Найдено треков: {len(tracks)}")
+        if tracks:
+            self.search_cache.set(query, limit, tracks)
+    
+    async def search_tracks(self, query: str, limit: int = 5) -> List[Dict]:
+        """Поиск треков на SoundCloud"""
+        tracks: List[Dict] = []
+        async for tracks in self.search_tracks_iter(query, limit):
+            pass
+        return tracks
+    
+    async def parse_link(self, text: str) -> Optional[Tuple[str, str]]:
+        """Находит в тексте ссылку на трек или сет SoundCloud: (тип, ссылка) или None.
+
+        Короткие ссылки on.soundcloud.com раскрываются (с кэшем), параметры
+        ссылки (utm-метки и т.п.) отбрасываются.
+        """
+        match = SOUNDCLOUD_LINK_RE.search(text)
+        if not match:
+            return None
+        url = match.group(0)
+        if urlsplit(url).netloc.lower() == SOUNDCLOUD_SHORT_HOST:
+            url = await self.resolve_short_link(url)
+            if not url:
+                return None
+        parts = urlsplit(url)
+        url = urlunsplit(('https', parts.netloc, parts.path, '', ''))
+        kind = soundcloud_link_kind(url)
+        return (kind, url) if kind else None
+    
+    async def resolve_short_link(self, url: str) -> Optional[str]:
+        """Полная ссылка, на которую ведет короткая ссылка on.soundcloud.com (None при ошибке)"""
+        key = canonical_track_key(url)
+        cached = self._short_links.get(key)
+        if cached and time.monotonic() - cached[0] < SHORT_LINK_CACHE_TTL_SECONDS:
+            self._short_links.move_to_end(key)
+            return cached[1]
+        
+        def resolve() -> str:
+            import requests
+            # Тело страницы не нужно - только адрес после перенаправлений
+            with requests.get(url, allow_redirects=True, stream=True, timeout=SHORT_LINK_TIMEOUT_SECONDS) as response:
+                return response.url
+        
+        try:
+            with timed('link', 'resolve'):
+                resolved = await asyncio.get_event_loop().run_in_executor(self.info_executor, resolve)
+        except Exception as e:
+            logger.warning(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+            count_error('link', e)
+            return None
+        
+        self._short_links[key] = (time.monotonic(), resolved)
+        self._short_links.move_to_end(key)
+        while len(self._short_links) > SHORT_LINK_CACHE_MAX_ENTRIES:
+            self._short_links.popitem(last=False)
+        logger.info(f"Короткая ссылка {url} ведет на {resolved}")
+        return resolved
+    
+    async def get_playlist_tracks(self, url: str, limit: int) -> List[Dict]:
+        """Треки плейлиста (сета SoundCloud) без скачивания.
+
+        Извлекается полная информация о треках: при плоском извлечении у треков
+        сета нет названий, а так скачивание выбранных треков обойдется без
+        повторного извлечения.
+        """
+        try:
+            with timed('playlist', 'extract'):
+                info = await self._extract('info', url, PLAYLIST_TIMEOUT_SECONDS)
+        except Exception as e:
+            logger.error(f"Ошибка получения плейлиста {url}: {e}")
+            count_error('playlist', e)
             return []
+        
+        tracks = []
+        for entry in (info or {}).get('entries') or []:
+            if entry and len(tracks) < limit:
+                track_info = self._entry_to_track(entry)
+                if track_info:
+                    tracks.append(track_info)
+                    self._remember_info(entry)
+        logger.info(f"В плейлисте {url} найдено треков: {len(tracks)}")
+        return tracks
     
     async def get_track_info(self, url: str) -> Optional[Dict]:
         """Получение информации о треке"""
         try:
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info = await asyncio.get_event_loop().run_in_executor(
-                    None, ydl.extract_info, url, False
-                )
+            info = await self._resolve_info(url)
             
             if info:
                 return {
@@ -84,68 +560,222 @@ class SoundCloudDownloader:
                     'uploader': info.get('uploader', 'Unknown'),
                     'duration': info.get('duration', 0),
                     'url': info.get('webpage_url', url),
-                    'filesize': info.get('filesize', 0),
+                    'filesize': self._estimate_filesize(info),
                     'thumbnail': info.get('thumbnail', '')
                 }
             return None
             
         except Exception as e:
             logger.error(f"Ошибка получения информации: {e}")
+            count_error('info', e)
             return None
     
-    async def download_track(self, url: str, user_id: int) -> Optional[str]:
-        """Скачивание трека"""
+    @staticmethod
+    def _progress_percentage(d: Dict) -> Optional[int]:
+        """Процент скачивания по данным progress hook yt-dlp (None - неизвестен)"""
+        status = d.get('status')
+        if status == 'finished':
+            return 100
+        if status != 'downloading':
+            return None
+        
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if total:
+            percentage = int(d.get('downloaded_bytes', 0) * 100 / total)
+        elif d.get('fragment_count'):
+            percentage = int((d.get('fragment_index') or 0) * 100 / d['fragment_count'])
+        else:
+            return None
+        return min(percentage, 99)
+    
+    @classmethod
+    def _make_progress_hook(cls, loop: asyncio.AbstractEventLoop,
+                            progress_callback: Optional[Callable[[int], None]], deadline: float,
+                            cancelled: Optional[threading.Event] = None):
+        """Создает progress hook для yt-dlp: передает процент скачивания в event loop
+        и прерывает скачивание после deadline или после отмены (cancelled)"""
+        from yt_dlp.utils import DownloadCancelled
+        last_percentage = [-1]
+        
+        def hook(d: Dict):
+            if time.monotonic() > deadline:
+                raise DownloadCancelled(f"Превышено время скачивания ({DOWNLOAD_TIMEOUT_SECONDS} сек.)")
+            if cancelled is not None and cancelled.is_set():
+                raise DownloadCancelled("Скачивание отменено")
+            
+            percentage = cls._progress_percentage(d)
+            # Хук вызывается из потока yt-dlp - передаем только изменения процента
+            if progress_callback and percentage is not None and percentage != last_percentage[0]:
+                last_percentage[0] = percentage
+                loop.call_soon_threadsafe(progress_callback, percentage)
+        
+        return hook
+    
+    async def download_track(self, url: str, user_id: int, info: Optional[Dict] = None,
+                             progress_callback: Optional[Callable[[int], None]] = None,
+                             ratelimit: Optional[int] = None) -> Optional[str]:
+        """Скачивание трека.
+
+        Страница трека извлекается не более одного раза: можно передать info,
+        полученную ранее (например, при поиске), тогда скачивание обходится без
+        повторного извлечения. progress_callback получает процент скачивания
+        (вызывается в event loop), ratelimit ограничивает скорость (байт/сек.).
+        Отмена ожидания прерывает и само скачивание.
+        
+        Каждое скачивание идет в своей папке внутри папки пользователя: одновременные
+        скачивания треков с одинаковым названием не пишут в один файл, а при ошибке
+        или отмене удаляется только эта папка. Скачанный файл переносит вызывающий,
+        после чего вызывает release_download().
+        """
+        # Создаем уникальную папку скачивания в папке пользователя
+        user_dir = os.path.join(DOWNLOADS_DIR, str(user_id))
+        os.makedirs(user_dir, exist_ok=True)
+        job_dir = tempfile.mkdtemp(prefix=JOB_DIR_PREFIX, dir=user_dir)
+        worker = None  # Поток скачивания (в режиме потоков)
+        cancelled = threading.Event()
         try:
-            # Создаем уникальную папку для пользователя
-            user_dir = os.path.join(DOWNLOADS_DIR, str(user_id))
-            os.makedirs(user_dir, exist_ok=True)
+            loop = asyncio.get_event_loop()
             
-            # Настройки для скачивания
-            opts = self.ytdl_opts.copy()
-            opts['outtmpl'] = os.path.join(user_dir, '%(title)s.%(ext)s')
+            if info is None:
+                info = self._take_info(url)
+            if info is None and canonical_track_key(url) in self._resolving:
+                # Информация о треке уже извлекается в фоне - дожидаемся ее
+                try:
+                    with timed('download', 'info_wait'):
+                        await self._resolve_info(url)
+                except Exception:
+                    pass  # Извлечем заново ниже
+                info = self._take_info(url)
             
-            # Проверяем размер файла перед скачиванием
-            info = await self.get_track_info(url)
-            if info and info.get('filesize', 0) > MAX_DOWNLOAD_SIZE_MB * 1024 * 1024:
-                raise Exception(f"Файл слишком большой (>{MAX_DOWNLOAD_SIZE_MB}MB)")
+            await self._ensure_backend()
+            if self.process_backend:
+                # Зависший или упавший процесс будет убит по таймауту
+                with timed('download', 'fetch'):
+                    return await self.process_backend.download(
+                        self.ytdl_opts, url, info, job_dir, progress_callback, DOWNLOAD_TIMEOUT_SECONDS, ratelimit
+                    )
             
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                # Скачиваем файл
-                await asyncio.get_event_loop().run_in_executor(
-                    None, ydl.download, [url]
-                )
-                
-                # Ищем скачанный файл
-                for file in os.listdir(user_dir):
-                    if file.endswith(('.mp3', '.wav', '.m4a', '.flac')):
-                        file_path = os.path.join(user_dir, file)
-                        
-                        # Проверяем размер скачанного файла
-                        if os.path.getsize(file_path) > MAX_DOWNLOAD_SIZE_MB * 1024 * 1024:
-                            os.remove(file_path)
-                            raise Exception(f"Скачанный файл слишком большой (>{MAX_DOWNLOAD_SIZE_MB}MB)")
-                        
-                        return file_path
+            # Поток прервать нельзя: скачивание останавливает progress hook после deadline,
+            # а ожидание извлечения ограничено тем же таймаутом
+            deadline = time.monotonic() + DOWNLOAD_TIMEOUT_SECONDS
+            progress_hook = self._make_progress_hook(loop, progress_callback, deadline, cancelled)
+            # Контекст копируется, чтобы этапы внутри потока попали в разбивку текущего запроса
+            context = contextvars.copy_context()
+            worker = loop.run_in_executor(
+                self.download_executor, context.run, self._download_blocking,
+                url, info, job_dir, progress_hook, ratelimit
+            )
+            with timed('download', 'fetch'):
+                return await asyncio.wait_for(asyncio.shield(worker), DOWNLOAD_TIMEOUT_SECONDS)
             
+        except BaseException as e:
+            if isinstance(e, Exception):
+                logger.error(f"Ошибка скачивания: {e}")
+                count_error('download', e)
+            # Поток остановится на следующем вызове progress hook
+            cancelled.set()
+            self._remove_job_dir(job_dir, worker)
+            raise
+    
+    @staticmethod
+    def _remove_job_dir(job_dir: str, worker: Optional[asyncio.Future] = None):
+        """Удаляет папку скачивания; если поток скачивания еще пишет в нее - после его завершения"""
+        if worker is None or worker.done():
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return
+        
+        def cleanup(future: asyncio.Future):
+            if not future.cancelled():
+                future.exception()  # Результат уже никому не нужен
+            shutil.rmtree(job_dir, ignore_errors=True)
+        
+        worker.add_done_callback(cleanup)
+    
+    def release_download(self, file_path: str):
+        """Удаляет папку скачивания после того, как скачанный файл из нее перенесен"""
+        job_dir = os.path.dirname(file_path)
+        if os.path.basename(job_dir).startswith(JOB_DIR_PREFIX):
+            shutil.rmtree(job_dir, ignore_errors=True)
+    
+    def _download_blocking(self, url: str, info: Optional[Dict], user_dir: str,
+                           progress_hook: Optional[Callable[[Dict], None]],
+                           ratelimit: Optional[int] = None) -> Optional[str]:
+        """Извлечение (если нужно) и скачивание трека экземпляром YoutubeDL из пула (выполняется в потоке)"""
+        outtmpl = os.path.join(user_dir, '%(title)s.%(ext)s')
+        with self.download_pool.lease(outtmpl=outtmpl, progress_hook=progress_hook, ratelimit=ratelimit) as ydl:
+            return self._extract_and_download(ydl, url, info, user_dir)
+    
+    @classmethod
+    def _extract_and_download(cls, ydl: 'yt_dlp.YoutubeDL', url: str, info: Optional[Dict], user_dir: str) -> Optional[str]:
+        """Скачивает трек по готовой информации, а если ее нет или она устарела - извлекает один раз"""
+        from yt_dlp.utils import DownloadError
+        if info is not None:
+            try:
+                return cls._download_with_info(ydl, info, user_dir)
+            except DownloadError as e:
+                # Ссылки на поток могли устареть - извлекаем трек заново
+                logger.warning(f"Не удалось скачать по сохраненной информации, извлекаем заново: {e}")
+        
+        with timed('download', 'extract'):
+            info = ydl.extract_info(url, download=False)
+        return cls._download_with_info(ydl, info, user_dir)
+    
+    @classmethod
+    def _download_with_info(cls, ydl: 'yt_dlp.YoutubeDL', info: Dict, user_dir: str) -> Optional[str]:
+        """Выбор формата, проверка размера и скачивание по уже извлеченной информации (без сети до загрузки)"""
+        max_bytes = MAX_DOWNLOAD_SIZE_MB * 1024 * 1024
+        # Выбираем аудиоформат, который Telegram воспроизводит без перекодирования и который
+        # по оценке укладывается в лимит (иначе - с меньшим битрейтом)
+        with timed('download', 'format_select'):
+            fmt = select_audio_format(info, max_bytes)
+            if fmt is None:
+                # Списка аудиоформатов нет - формат выбирает yt-dlp по настройкам скачивания
+                info = ydl.process_ie_result(dict(info), download=False)
+                if cls._estimate_filesize(info) > max_bytes:
+                    raise Exception(f"Файл слишком большой (>{MAX_DOWNLOAD_SIZE_MB}MB)")
+        
+        # Скачиваем выбранный формат
+        default_selector = ydl.format_selector
+        if fmt is not None:
+            ydl.format_selector = lambda ctx: [f for f in ctx['formats'] if f.get('format_id') == fmt['format_id']][:1]
+        try:
+            with timed('download', 'transfer'):
+                result = ydl.process_ie_result(dict(info), download=True)
+        finally:
+            ydl.format_selector = default_selector
+        
+        file_path = None
+        downloads = result.get('requested_downloads') or []
+        if downloads and downloads[0].get('filepath'):
+            file_path = downloads[0]['filepath']
+        else:
+            # Ищем скачанный файл
+            for file in os.listdir(user_dir):
+                if file.endswith(('.mp3', '.wav', '.m4a', '.flac')):
+                    file_path = os.path.join(user_dir, file)
+                    break
+        
+        if not file_path or not os.path.exists(file_path):
             return None
-            
-        except Exception as e:
-            logger.error(f"Ошибка скачивания: {e}")
-            # Очищаем папку пользователя при ошибке
-            user_dir = os.path.join(DOWNLOADS_DIR, str(user_id))
-            if os.path.exists(user_dir):
-                for file in os.listdir(user_dir):
-                    try:
-                        os.remove(os.path.join(user_dir, file))
-                    except:
-                        pass
-            raise e
+        
+        # Формат, который Telegram не воспроизводит (например, opus), перепаковывается или перекодируется
+        if fmt is not None and not is_playable(fmt):
+            file_path = convert_for_telegram(file_path, fmt)
+        
+        # Проверяем размер скачанного файла
+        if os.path.getsize(file_path) > MAX_DOWNLOAD_SIZE_MB * 1024 * 1024:
+            os.remove(file_path)
+            raise Exception(f"Скачанный файл слишком большой (>{MAX_DOWNLOAD_SIZE_MB}MB)")
+        
+        return file_path
     
     def cleanup_user_files(self, user_id: int):
-        """Очистка файлов пользователя"""
+        """Очистка файлов пользователя (папки идущих скачиваний не трогаются - их убирают сами скачивания)"""
         user_dir = os.path.join(DOWNLOADS_DIR, str(user_id))
         if os.path.exists(user_dir):
             for file in os.listdir(user_dir):
+                if not os.path.isfile(os.path.join(user_dir, file)):
+                    continue
                 try:
                     os.remove(os.path.join(user_dir, file))
                 except Exception as e:
@@ -0,0 +1,510 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Optional, Dict, List, Tuple, Callable
+from audio_cache import CacheEntry, MemoryCacheIndex
+from file_id_cache import FileIdCache
+from session_store import SessionStore, SearchSession, TrackRecord
+
+logger = logging.getLogger(__name__)
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    """Соединение с SQLite, которое безопасно делят несколько процессов"""
+    db_dir = os.path.dirname(db_path)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SqliteSessionStore:
+    """Результаты поиска пользователей в SQLite, общие для всех процессов бота.
+
+    Интерфейс совпадает с SessionStore: кнопка, нажатая в сообщении одного
+    процесса, может быть обработана другим.
+    """
+
+    def __init__(self, db_path: str, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expired = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS search_sessions ('
+            ' user_id INTEGER PRIMARY KEY,'
+            ' query TEXT NOT NULL,'
+            ' tracks TEXT NOT NULL,'
+            ' current_page INTEGER NOT NULL DEFAULT 0,'
+            ' touched_at REAL NOT NULL'
+            ')'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS search_sessions_touched ON search_sessions (touched_at)')
+        self._conn.commit()
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM search_sessions').fetchone()[0]
+
+    def get(self, user_id: int) -> Optional[SearchSession]:
+        """Возвращает результаты поиска пользователя (или None, если их нет или они устарели)"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT query, tracks, current_page, touched_at FROM search_sessions WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            query, data, current_page, touched_at = row
+            if now - touched_at > self.ttl:
+                self._conn.execute('DELETE FROM search_sessions WHERE user_id = ?', (user_id,))
+                self._conn.commit()
+                self.expired += 1
+                return None
+
+            self._conn.execute('UPDATE search_sessions SET touched_at = ? WHERE user_id = ?', (now, user_id))
+            self._conn.commit()
+
+        session = SearchSession(query, tuple(TrackRecord.from_dict(track) for track in json.loads(data)))
+        session.current_page = current_page
+        return session
+
+    def set(self, user_id: int, query: str, tracks: List[Dict]) -> SearchSession:
+        """Сохраняет новые результаты поиска пользователя"""
+        session = SearchSession(query, tuple(TrackRecord.from_dict(track) for track in tracks))
+        data = json.dumps([
+            {name: track[name] for name in TrackRecord.__slots__} for track in session.tracks
+        ], ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO search_sessions (user_id, query, tracks, current_page, touched_at) '
+                'VALUES (?, ?, ?, 0, ?)',
+                (user_id, query, data, time.time())
+            )
+            self._purge()
+            self._conn.commit()
+        return session
+
+    def set_page(self, user_id: int, page: int):
+        """Запоминает текущую страницу результатов пользователя"""
+        with self._lock:
+            self._conn.execute('UPDATE search_sessions SET current_page = ? WHERE user_id = ?', (page, user_id))
+            self._conn.commit()
+
+    def pop(self, user_id: int) -> Optional[SearchSession]:
+        """Удаляет результаты поиска пользователя"""
+        session = self.get(user_id)
+        if session is not None:
+            with self._lock:
+                self._conn.execute('DELETE FROM search_sessions WHERE user_id = ?', (user_id,))
+                self._conn.commit()
+        return session
+
+    def _purge(self):
+        """Удаляет устаревшие записи и самые давние сверх лимита (вызывается под блокировкой)"""
+        self.expired += self._conn.execute(
+            'DELETE FROM search_sessions WHERE touched_at < ?', (time.time() - self.ttl,)
+        ).rowcount
+        self.evicted += self._conn.execute(
+            'DELETE FROM search_sessions WHERE user_id IN ('
+            ' SELECT user_id FROM search_sessions ORDER BY touched_at DESC LIMIT -1 OFFSET ?'
+            ')', (self.max_entries,)
+        ).rowcount
+
+    def stats(self) -> Dict:
+        """Статистика хранилища (memory_bytes - объем сохраненных результатов в SQLite: в памяти процесса их нет)"""
+        with self._lock:
+            stored_bytes = self._conn.execute(
+                'SELECT COALESCE(SUM(LENGTH(CAST(query AS BLOB)) + LENGTH(CAST(tracks AS BLOB))), 0) FROM search_sessions'
+            ).fetchone()[0]
+        return {
+            'sessions': len(self),
+            'memory_bytes': stored_bytes,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LocalDownloadLocks:
+    """Блокировки скачиваний одного процесса: одинаковые скачивания и так объединяет планировщик"""
+
+    def acquire(self, track_key: str) -> bool:
+        return True
+
+    def release(self, track_key: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteDownloadLocks:
+    """Блокировки скачиваний в SQLite: трек скачивает только один процесс бота.
+
+    Блокировка выдается на ttl секунд, чтобы упавший процесс не держал трек вечно.
+    """
+
+    def __init__(self, db_path: str, ttl: float):
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS download_locks ('
+            ' track_key TEXT PRIMARY KEY,'
+            ' owner TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL'
+            ')'
+        )
+        self._conn.commit()
+
+    def acquire(self, track_key: str) -> bool:
+        """Пытается взять блокировку трека (False - трек скачивает другой процесс)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM download_locks WHERE track_key = ? AND expires_at < ?', (track_key, now)
+            )
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO download_locks (track_key, owner, expires_at) VALUES (?, ?, ?)',
+                (track_key, self.owner, now + self.ttl)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def release(self, track_key: str):
+        """Снимает блокировку трека, взятую этим процессом"""
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM download_locks WHERE track_key = ? AND owner = ?', (track_key, self.owner)
+            )
+            self._conn.commit()
+
+    def close(self):
+        """Снимает все блокировки процесса и закрывает соединение"""
+        with self._lock:
+            self._conn.execute('DELETE FROM download_locks WHERE owner = ?', (self.owner,))
+            self._conn.commit()
+            self._conn.close()
+
+
+class LocalBatchRegistry:
+    """Пакетные скачивания одного процесса: их и так отслеживает бот"""
+
+    shared = False
+
+    def start(self, user_id: int) -> bool:
+        return True
+
+    def poll(self, user_id: int) -> bool:
+        return False
+
+    def request_cancel(self, user_id: int) -> bool:
+        return False
+
+    def finish(self, user_id: int):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteBatchRegistry:
+    """Идущие пакетные скачивания в SQLite, общие для всех процессов бота.
+
+    У пользователя один пакет на все процессы, а /cancel, пришедший в другой
+    процесс, ставит пакету отметку отмены: процесс пакета проверяет ее в poll().
+    poll() же продлевает запись; запись упавшего процесса устаревает через ttl секунд.
+    """
+
+    shared = True
+
+    def __init__(self, db_path: str, ttl: float):
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS batches ('
+            ' user_id INTEGER PRIMARY KEY,'
+            ' owner TEXT NOT NULL,'
+            ' cancel_requested INTEGER NOT NULL DEFAULT 0,'
+            ' heartbeat_at REAL NOT NULL'
+            ')'
+        )
+        self._conn.commit()
+
+    def start(self, user_id: int) -> bool:
+        """Отмечает пакет пользователя (False - у него уже идет пакет в каком-либо процессе)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM batches WHERE user_id = ? AND heartbeat_at < ?', (user_id, now - self.ttl))
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO batches (user_id, owner, heartbeat_at) VALUES (?, ?, ?)',
+                (user_id, self.owner, now)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def poll(self, user_id: int) -> bool:
+        """Продлевает запись о пакете этого процесса и возвращает, просили ли его отменить"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE batches SET heartbeat_at = ? WHERE user_id = ? AND owner = ?', (time.time(), user_id, self.owner)
+            )
+            self._conn.commit()
+            row = self._conn.execute(
+                'SELECT cancel_requested FROM batches WHERE user_id = ? AND owner = ?', (user_id, self.owner)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def request_cancel(self, user_id: int) -> bool:
+        """Просит отменить пакет пользователя, идущий в любом процессе (False - пакета нет)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE batches SET cancel_requested = 1 WHERE user_id = ? AND heartbeat_at >= ?',
+                (user_id, time.time() - self.ttl)
+            )
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def finish(self, user_id: int):
+        """Снимает отметку пакета этого процесса"""
+        with self._lock:
+            self._conn.execute('DELETE FROM batches WHERE user_id = ? AND owner = ?', (user_id, self.owner))
+            self._conn.commit()
+
+    def close(self):
+        """Снимает отметки всех пакетов процесса и закрывает соединение"""
+        with self._lock:
+            self._conn.execute('DELETE FROM batches WHERE owner = ?', (self.owner,))
+            self._conn.commit()
+            self._conn.close()
+
+
+class SqliteCacheIndex:
+    """Индекс кэша аудио в SQLite, общий для всех процессов бота.
+
+    Интерфейс совпадает с MemoryCacheIndex. Бюджет кэша и порядок вытеснения
+    общие, а файл, который отправляет один процесс, не вытеснит другой. Защита
+    упавшего процесса перестает действовать через pin_ttl секунд.
+    """
+
+    shared = True  # Индекс видят все процессы бота
+
+    def __init__(self, db_path: str, cache_dir: str, pin_ttl: float):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.pin_ttl = pin_ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn = _connect(db_path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS audio_cache_files ('
+            ' cache_dir TEXT NOT NULL,'
+            ' digest TEXT NOT NULL,'
+            ' path TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' used_at REAL NOT NULL,'
+            ' PRIMARY KEY (cache_dir, digest)'
+            ')'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS audio_cache_files_used ON audio_cache_files (cache_dir, used_at)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS audio_cache_pins ('
+            ' cache_dir TEXT NOT NULL,'
+            ' digest TEXT NOT NULL,'
+            ' owner TEXT NOT NULL,'
+            ' refs INTEGER NOT NULL,'
+            ' pinned_at REAL NOT NULL,'
+            ' PRIMARY KEY (cache_dir, digest, owner)'
+            ')'
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM audio_cache_files WHERE cache_dir = ?', (self.cache_dir,)
+            ).fetchone()[0]
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM audio_cache_files WHERE cache_dir = ?', (self.cache_dir,)
+            ).fetchone()[0]
+
+    def get(self, digest: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT path, size FROM audio_cache_files WHERE cache_dir = ? AND digest = ?', (self.cache_dir, digest)
+            ).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def add(self, digest: str, entry: CacheEntry, used_at: Optional[float] = None):
+        """Добавляет файл (или заменяет прежний); used_at - время использования (по умолчанию - сейчас)"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO audio_cache_files (cache_dir, digest, path, size, used_at) VALUES (?, ?, ?, ?, ?)',
+                (self.cache_dir, digest, entry.path, entry.size, time.time() if used_at is None else used_at)
+            )
+            self._conn.commit()
+
+    def touch(self, digest: str):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE audio_cache_files SET used_at = ? WHERE cache_dir = ? AND digest = ?',
+                (time.time(), self.cache_dir, digest)
+            )
+            self._conn.commit()
+
+    def remove(self, digest: str, unpinned_only: bool = False) -> Optional[CacheEntry]:
+        """Убирает файл из индекса (unpinned_only - только если его не защитил ни один процесс) и возвращает его"""
+        with self._lock:
+            # Проверка защиты и удаление - в одной транзакции с записью, чтобы другой процесс не защитил файл между ними
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT path, size FROM audio_cache_files WHERE cache_dir = ? AND digest = ?', (self.cache_dir, digest)
+                ).fetchone()
+                if row is not None and unpinned_only and self._pinned(digest):
+                    row = None
+                if row is not None:
+                    self._conn.execute(
+                        'DELETE FROM audio_cache_files WHERE cache_dir = ? AND digest = ?', (self.cache_dir, digest)
+                    )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return CacheEntry(*row) if row else None
+
+    def pin(self, digest: str):
+        now = time.time()
+        with self._lock:
+            # Защиты упавших процессов
+            self._conn.execute('DELETE FROM audio_cache_pins WHERE pinned_at < ?', (now - self.pin_ttl,))
+            self._conn.execute(
+                'INSERT INTO audio_cache_pins (cache_dir, digest, owner, refs, pinned_at) VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (cache_dir, digest, owner) DO UPDATE SET refs = refs + 1, pinned_at = excluded.pinned_at',
+                (self.cache_dir, digest, self.owner, now)
+            )
+            self._conn.commit()
+
+    def unpin(self, digest: str):
+        key = (self.cache_dir, digest, self.owner)
+        with self._lock:
+            self._conn.execute(
+                'UPDATE audio_cache_pins SET refs = refs - 1 WHERE cache_dir = ? AND digest = ? AND owner = ?', key
+            )
+            self._conn.execute(
+                'DELETE FROM audio_cache_pins WHERE cache_dir = ? AND digest = ? AND owner = ? AND refs <= 0', key
+            )
+            self._conn.commit()
+
+    def pinned(self, digest: str) -> bool:
+        with self._lock:
+            return self._pinned(digest)
+
+    def _pinned(self, digest: str) -> bool:
+        """Защищен ли файл каким-либо процессом (вызывается под блокировкой)"""
+        return self._conn.execute(
+            'SELECT 1 FROM audio_cache_pins WHERE cache_dir = ? AND digest = ? AND pinned_at >= ? LIMIT 1',
+            (self.cache_dir, digest, time.time() - self.pin_ttl)
+        ).fetchone() is not None
+
+    def pinned_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(DISTINCT p.digest) FROM audio_cache_pins p JOIN audio_cache_files f'
+                ' ON f.cache_dir = p.cache_dir AND f.digest = p.digest'
+                ' WHERE p.cache_dir = ? AND p.pinned_at >= ?',
+                (self.cache_dir, time.time() - self.pin_ttl)
+            ).fetchone()[0]
+
+    def lru(self) -> List[Tuple[str, CacheEntry]]:
+        """Файлы от давно не использовавшихся к недавним (по всем процессам)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT digest, path, size FROM audio_cache_files WHERE cache_dir = ? ORDER BY used_at', (self.cache_dir,)
+            ).fetchall()
+        return [(digest, CacheEntry(path, size)) for digest, path, size in rows]
+
+    def close(self):
+        """Снимает все защиты процесса и закрывает соединение"""
+        with self._lock:
+            self._conn.execute('DELETE FROM audio_cache_pins WHERE owner = ?', (self.owner,))
+            self._conn.commit()
+            self._conn.close()
+
+
+class StateBackend:
+    """Состояние бота, которое должно быть общим для всех его процессов:
+    результаты поиска, file_id отправленных треков, блокировки скачиваний,
+    идущие пакетные скачивания и индексы кэшей аудио"""
+
+    def __init__(self, sessions, file_ids: FileIdCache, download_locks, batches,
+                 cache_index: Callable[[str], object]):
+        self.sessions = sessions
+        self.file_ids = file_ids
+        self.download_locks = download_locks
+        self.batches = batches
+        self._cache_index = cache_index
+        self._cache_indexes: List = []
+
+    def audio_cache_index(self, cache_dir: str):
+        """Индекс для кэша аудио в папке cache_dir"""
+        index = self._cache_index(cache_dir)
+        self._cache_indexes.append(index)
+        return index
+
+    def close(self):
+        for part in (self.sessions, self.file_ids, self.download_locks, self.batches, *self._cache_indexes):
+            close = getattr(part, 'close', None)
+            if close:
+                try:
+                    close()
+                except Exception as e:
+                    logger.debug(f"Ошибка закрытия хранилища состояния: {e}")
+
+
+def create_state_backend(kind: str) -> StateBackend:
+    """Создает хранилище состояния по настройке STATE_BACKEND ('memory' или 'sqlite')"""
+    from config import (
+        STATE_DB_PATH, FILE_ID_CACHE_DB, SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES, DOWNLOAD_LOCK_TTL_SECONDS,
+        AUDIO_CACHE_PIN_TTL_SECONDS, BATCH_STALE_SECONDS
+    )
+
+    file_ids = FileIdCache(FILE_ID_CACHE_DB)  # SQLite и так общий для процессов
+    if kind == 'memory':
+        return StateBackend(
+            SessionStore(SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES), file_ids, LocalDownloadLocks(), LocalBatchRegistry(),
+            lambda cache_dir: MemoryCacheIndex()
+        )
+    if kind == 'sqlite':
+        logger.info(f"Общее состояние процессов бота хранится в {STATE_DB_PATH}")
+        return StateBackend(
+            SqliteSessionStore(STATE_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES),
+            file_ids,
+            SqliteDownloadLocks(STATE_DB_PATH, DOWNLOAD_LOCK_TTL_SECONDS),
+            SqliteBatchRegistry(STATE_DB_PATH, BATCH_STALE_SECONDS),
+            lambda cache_dir: SqliteCacheIndex(STATE_DB_PATH, cache_dir, AUDIO_CACHE_PIN_TTL_SECONDS),
+        )
+    raise ValueError(f"Неизвестное хранилище состояния: {kind}")
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Лимит семафора PTB: он берется до do_process_update, то есть до блокировки пользователя,
+# поэтому настоящий лимит проверяется уже под ней
+_UNLIMITED_UPDATES = 2 ** 31 - 1
+
+
+class _UserLock:
+    """Блокировка пользователя со счетчиком ожидающих обновлений"""
+    __slots__ = ('lock', 'waiters')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiters = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя обрабатываются строго по очереди, чтобы
+    результаты поиска и папка загрузок пользователя оставались согласованными.
+    Общее число одновременно обрабатываемых обновлений ограничено
+    max_concurrent_updates; слот занимается только после блокировки
+    пользователя, так что обновления, ждущие своей очереди, не мешают другим
+    пользователям. Порядок соблюдается в пределах процесса: если несколько
+    процессов бота слушают один порт, обновления пользователя могут попасть в
+    разные процессы и обрабатываться одновременно.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(_UNLIMITED_UPDATES)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должно быть положительным")
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks: Dict[int, _UserLock] = {}
+
+    @staticmethod
+    def _get_user_id(update: object) -> Optional[int]:
+        """Определяет пользователя, от которого пришло обновление"""
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """Обрабатывает обновление под блокировкой его пользователя"""
+        user_id = self._get_user_id(update)
+        if user_id is None or (isinstance(update, Update) and update.inline_query):
+            # Встроенные запросы не меняют состояние пользователя, а устаревшие отменяет
+            # сам обработчик - не заставляем их ждать скачиваний пользователя
+            async with self._slots:
+                await coroutine
+            return
+
+        user_lock = self._user_locks.get(user_id)
+        if user_lock is None:
+            user_lock = self._user_locks[user_id] = _UserLock()
+
+        user_lock.waiters += 1
+        try:
+            async with user_lock.lock, self._slots:
+                await coroutine
+        finally:
+            user_lock.waiters -= 1
+            if user_lock.waiters == 0:
+                # Никто больше не ждет - освобождаем память
+                del self._user_locks[user_id]
+
+    @property
+    def active_users(self) -> int:
+        """Количество пользователей с обновлениями в обработке"""
+        return len(self._user_locks)
+
+    async def initialize(self) -> None:
+        """Ничего не делает"""
+
+    async def shutdown(self) -> None:
+        """Ничего не делает"""
@@ -0,0 +1,132 @@
+import json
+import signal
+import asyncio
+import logging
+from typing import Optional, List, Tuple, Callable
+import tornado.web
+import tornado.httpserver
+from telegram import Update
+from telegram.ext import Application
+from metrics import MetricsRegistry, StartupTimer
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Принимает обновления от Telegram и кладет их в очередь приложения"""
+
+    def initialize(self, bot_application: Application, secret_token: Optional[str], startup: Optional[StartupTimer]):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+        self.startup = startup
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            raise tornado.web.HTTPError(403)
+
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            raise tornado.web.HTTPError(400)
+
+        if update is not None:
+            if self.startup:
+                self.startup.mark('first_update')
+            await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, tornado.web.HTTPError):
+            return
+        logger.error(f"Ошибка обработки webhook: {value}")
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Метрики в текстовом формате Prometheus"""
+
+    def initialize(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.registry.render())
+
+
+class ReadinessHandler(tornado.web.RequestHandler):
+    """Проверка готовности для балансировщика или хостинга: 200 - бот готов, 503 - еще запускается"""
+
+    def initialize(self, is_ready: Callable[[], bool]):
+        self.is_ready = is_ready
+
+    def get(self):
+        ready = self.is_ready()
+        self.set_status(200 if ready else 503)
+        self.write({'ready': ready})
+
+
+class WebhookServer:
+    """HTTP-сервер webhook на tornado с дополнительными адресами (метрики и т.п.) на том же порту.
+
+    Повторяет жизненный цикл Application.run_webhook: инициализация,
+    post_init, установка webhook, обработка обновлений до сигнала остановки,
+    затем остановка приложения и post_shutdown. Порт открывается до
+    инициализации: обновления, пришедшие во время запуска, ждут в очереди.
+    Этапы запуска отмечаются в startup. С reuse_port несколько процессов бота
+    слушают один порт, и ядро распределяет между ними соединения (для этого
+    состояние должно быть общим, STATE_BACKEND = 'sqlite').
+    """
+
+    def __init__(self, application: Application, listen: str, port: int, webhook_url: str,
+                 webhook_path: str = '/webhook', secret_token: Optional[str] = None,
+                 extra_handlers: Optional[List[Tuple]] = None, startup: Optional[StartupTimer] = None,
+                 reuse_port: bool = False):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.startup = startup
+        self.reuse_port = reuse_port
+        handlers = [(webhook_path, TelegramWebhookHandler,
+                     {'bot_application': application, 'secret_token': secret_token, 'startup': startup})]
+        handlers.extend(extra_handlers or [])
+        self.app = tornado.web.Application(handlers)
+        self._server: Optional[tornado.httpserver.HTTPServer] = None
+
+    async def serve(self, allowed_updates: Optional[List[str]] = None):
+        """Работает до SIGINT/SIGTERM"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass  # Windows
+
+        self._server = tornado.httpserver.HTTPServer(self.app, xheaders=True)
+        self._server.listen(self.port, self.listen, reuse_port=self.reuse_port)
+        logger.info(f"Webhook-сервер слушает {self.listen}:{self.port}")
+        if self.startup:
+            self.startup.mark('listening')
+
+        application = self.application
+        try:
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            await application.bot.set_webhook(
+                url=self.webhook_url, allowed_updates=allowed_updates, secret_token=self.secret_token
+            )
+            await application.start()
+            if self.startup:
+                self.startup.mark('started')
+            await stop.wait()
+        finally:
+            logger.info("Остановка webhook-сервера")
+            self._server.stop()
+            if application.running:
+                await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+            await application.shutdown()
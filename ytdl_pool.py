@@ -0,0 +1,97 @@
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+# Экстракторы, которые создаются заранее при прогреве
+WARM_EXTRACTORS = ('Soundcloud', 'SoundcloudSearch', 'YoutubeSearch', 'Youtube')
+
+
+class YoutubeDLPool:
+    """Пул экземпляров YoutubeDL с одинаковыми настройками.
+
+    Экземпляр выдается одному потоку за раз и после использования возвращается
+    в пул, поэтому экстракторы, cookies и HTTP-соединения создаются один раз.
+    Размер пула должен совпадать с числом потоков исполнителя, который его использует.
+    """
+
+    def __init__(self, name: str, opts: Dict, size: int):
+        self.name = name
+        self.opts = opts
+        self.size = size
+        self._idle: 'queue.LifoQueue[yt_dlp.YoutubeDL]' = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._instances = []
+
+    def _create(self) -> 'yt_dlp.YoutubeDL':
+        # Долгий импорт yt_dlp - при создании первого экземпляра (обычно при прогреве)
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(dict(self.opts))
+        ydl.pool_progress_hook = None
+        # Один постоянный hook, который вызывает обработчик текущего арендатора
+        ydl.add_progress_hook(lambda d: ydl.pool_progress_hook and ydl.pool_progress_hook(d))
+        self._instances.append(ydl)
+        return ydl
+
+    def warm(self):
+        """Создает все экземпляры пула и их основные экстракторы заранее"""
+        with self._lock:
+            while self._created < self.size:
+                ydl = self._create()
+                for ie_key in WARM_EXTRACTORS:
+                    try:
+                        ydl.get_info_extractor(ie_key)
+                    except Exception as e:
+                        logger.debug(f"Не удалось прогреть экстрактор {ie_key}: {e}")
+                self._created += 1
+                self._idle.put(ydl)
+
+    def _acquire(self) -> 'yt_dlp.YoutubeDL':
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._create()
+
+        # Все экземпляры заняты - ждем освобождения
+        return self._idle.get()
+
+    @contextmanager
+    def lease(self, outtmpl: Optional[str] = None, progress_hook: Optional[Callable[[Dict], None]] = None,
+              ratelimit: Optional[int] = None):
+        """Выдает экземпляр YoutubeDL текущему потоку (ratelimit - ограничение скорости скачивания, байт/сек.)"""
+        ydl = self._acquire()
+        default_outtmpl = ydl.params['outtmpl']['default']
+        default_ratelimit = ydl.params.get('ratelimit')
+        if outtmpl:
+            ydl.params['outtmpl']['default'] = outtmpl
+        if ratelimit:
+            ydl.params['ratelimit'] = ratelimit
+        ydl.pool_progress_hook = progress_hook
+        try:
+            yield ydl
+        finally:
+            ydl.params['outtmpl']['default'] = default_outtmpl
+            ydl.params['ratelimit'] = default_ratelimit
+            ydl.pool_progress_hook = None
+            self._idle.put(ydl)
+
+    def close(self):
+        """Закрывает все экземпляры пула"""
+        for ydl in self._instances:
+            try:
+                ydl.close()
+            except Exception as e:
+                logger.debug(f"Ошибка закрытия YoutubeDL ({self.name}): {e}")
+        self._instances.clear()